@@ -0,0 +1,248 @@
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import sparse, stats
+from scipy.special import expit
+
+from tracing import traced
+
+# Enrollment depends strongly on ChronicCondition, so the raw control vs
+# treatment difference is confounded. These estimators adjust for it.
+TREATMENT = 'EnrolledInProgram'
+COVARIATES = ['Age', 'Gender', 'Ethnicity', 'SocioeconomicStatus', 'ChronicCondition']
+NUMERIC_COVARIATES = ['Age']
+CUPED_COVARIATE = 'PriorVisits'
+DEFAULT_OUTCOMES = ['IsReadmission', 'Satisfaction']
+
+# Rows turned into a sparse design matrix at a time; the fit itself only
+# keeps p x p matrices, so memory does not grow with the row count
+DEFAULT_CHUNK_ROWS = 500000
+MAX_ITERATIONS = 25
+TOLERANCE = 1e-8
+
+def frame_chunks(data, chunk_rows=DEFAULT_CHUNK_ROWS):
+    # data is a DataFrame, or a callable returning a fresh iterator of frame
+    # chunks (e.g. data_loading.iter_data_chunks) for tables that do not fit in memory
+    if callable(data):
+        yield from data()
+        return
+    for start in range(0, len(data), chunk_rows):
+        yield data.iloc[start:start + chunk_rows]
+
+def covariate_levels(data, covariates=COVARIATES, chunk_rows=DEFAULT_CHUNK_ROWS):
+    levels = {c: set() for c in covariates if c not in NUMERIC_COVARIATES}
+    for chunk in frame_chunks(data, chunk_rows):
+        for covariate, seen in levels.items():
+            seen.update(chunk[covariate].dropna().astype(object).unique())
+    # The first level of each covariate is its reference and gets no column
+    return {covariate: sorted(seen) for covariate, seen in levels.items()}
+
+def design_names(levels, covariates=COVARIATES, treatment=TREATMENT):
+    # treatment=None leaves the treatment column out, e.g. to model the treatment itself
+    names = ['Intercept'] + ([treatment] if treatment else []) + [c for c in covariates if c in NUMERIC_COVARIATES]
+    for covariate in covariates:
+        if covariate not in NUMERIC_COVARIATES:
+            names += [f'{covariate}[{level}]' for level in levels[covariate][1:]]
+    return names
+
+def design_matrix(chunk, outcome, levels, covariates=COVARIATES, treatment=TREATMENT):
+    # Sparse one-hot design: at most 3 + len(categoricals) non-zeros per row.
+    # Rows missing the outcome, the treatment or a covariate are left out.
+    y = pd.to_numeric(chunk[outcome]).to_numpy(dtype=float, na_value=np.nan)
+    keep = ~np.isnan(y) & chunk[treatment or outcome].notna().to_numpy()
+    numeric = [pd.to_numeric(chunk[c]).to_numpy(dtype=float, na_value=np.nan) for c in covariates
+               if c in NUMERIC_COVARIATES]
+    codes = [pd.Categorical(chunk[c].astype(object), categories=levels[c]).codes
+             for c in covariates if c not in NUMERIC_COVARIATES]
+    for values in numeric:
+        keep &= ~np.isnan(values)
+    for code in codes:
+        keep &= code >= 0
+
+    rows = np.flatnonzero(keep)
+    n = len(rows)
+    dense = [np.ones(n)] + ([chunk[treatment].to_numpy()[rows].astype(float)] if treatment else [])
+    dense += [values[rows] for values in numeric]
+    row_index = [np.arange(n)] * len(dense)
+    col_index = [np.full(n, j) for j in range(len(dense))]
+    data = list(dense)
+    offset = len(dense)
+    for covariate, code in zip([c for c in covariates if c not in NUMERIC_COVARIATES], codes):
+        code = code[rows]
+        present = code > 0
+        row_index.append(np.flatnonzero(present))
+        col_index.append(offset + code[present] - 1)
+        data.append(np.ones(int(present.sum())))
+        offset += len(levels[covariate]) - 1
+
+    X = sparse.csr_matrix(
+        (np.concatenate(data), (np.concatenate(row_index), np.concatenate(col_index))), shape=(n, offset)
+    )
+    return X, y[rows]
+
+def iter_designs(data, outcome, levels, covariates=COVARIATES, chunk_rows=DEFAULT_CHUNK_ROWS, treatment=TREATMENT):
+    for chunk in frame_chunks(data, chunk_rows):
+        X, y = design_matrix(chunk, outcome, levels, covariates, treatment)
+        if X.shape[0]:
+            yield X, y
+
+def solve(matrix, vector):
+    try:
+        return np.linalg.solve(matrix, vector)
+    except np.linalg.LinAlgError:
+        # A level present in no row makes the system singular
+        return np.linalg.lstsq(matrix, vector, rcond=None)[0]
+
+def fit_ols(data, outcome, levels, covariates=COVARIATES, chunk_rows=DEFAULT_CHUNK_ROWS):
+    # Normal equations accumulated chunk by chunk, then heteroskedasticity-
+    # robust (HC1) standard errors from a second pass over the residuals
+    xtx = xty = None
+    n = 0
+    for X, y in iter_designs(data, outcome, levels, covariates, chunk_rows):
+        part_xtx = (X.T @ X).toarray()
+        part_xty = X.T @ y
+        xtx = part_xtx if xtx is None else xtx + part_xtx
+        xty = part_xty if xty is None else xty + part_xty
+        n += X.shape[0]
+    if xtx is None:
+        raise ValueError(f"No complete rows to fit {outcome}.")
+    beta = solve(xtx, xty)
+
+    meat = np.zeros_like(xtx)
+    for X, y in iter_designs(data, outcome, levels, covariates, chunk_rows):
+        residual = y - X @ beta
+        meat += (X.T @ sparse.diags(residual ** 2) @ X).toarray()
+    bread = np.linalg.pinv(xtx)
+    p = xtx.shape[0]
+    covariance = bread @ meat @ bread * n / max(n - p, 1)
+    return beta, covariance, n
+
+def fit_logistic(data, outcome, levels, covariates=COVARIATES, chunk_rows=DEFAULT_CHUNK_ROWS,
+                 max_iterations=MAX_ITERATIONS, tolerance=TOLERANCE, treatment=TREATMENT):
+    # Newton-Raphson (IRLS): every iteration is one pass accumulating the
+    # gradient X'(y - p) and the Hessian X'WX
+    p = len(design_names(levels, covariates, treatment))
+    beta = np.zeros(p)
+    for iteration in range(1, max_iterations + 1):
+        hessian = np.zeros((p, p))
+        gradient = np.zeros(p)
+        n = 0
+        for X, y in iter_designs(data, outcome, levels, covariates, chunk_rows, treatment):
+            mu = expit(X @ beta)
+            gradient += X.T @ (y - mu)
+            hessian += (X.T @ sparse.diags(mu * (1 - mu)) @ X).toarray()
+            n += X.shape[0]
+        if n == 0:
+            raise ValueError(f"No complete rows to fit {outcome}.")
+        step = solve(hessian, gradient)
+        beta += step
+        if np.max(np.abs(step)) < tolerance:
+            break
+    else:
+        logging.warning(f"Logistic regression for {outcome} did not converge in {max_iterations} iterations")
+    return beta, np.linalg.pinv(hessian), n, iteration
+
+def average_risk_difference(data, outcome, levels, beta, covariance, covariates=COVARIATES,
+                            chunk_rows=DEFAULT_CHUNK_ROWS):
+    # Mean predicted risk with everyone treated minus everyone untreated, with
+    # a delta-method standard error
+    t = 1
+    total = 0.0
+    gradient = np.zeros(len(beta))
+    n = 0
+    for X, y in iter_designs(data, outcome, levels, covariates, chunk_rows):
+        eta0 = X @ beta - X[:, t].toarray().ravel() * beta[t]
+        p0 = expit(eta0)
+        p1 = expit(eta0 + beta[t])
+        total += (p1 - p0).sum()
+        w0, w1 = p0 * (1 - p0), p1 * (1 - p1)
+        part = X.T @ (w1 - w0)
+        part[t] = w1.sum()
+        gradient += part
+        n += X.shape[0]
+    gradient /= n
+    return float(total / n), float(np.sqrt(gradient @ covariance @ gradient))
+
+def coefficient_summary(beta, covariance, names):
+    se = np.sqrt(np.clip(np.diag(covariance), 0, None))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = beta / se
+    return pd.DataFrame({'coefficient': beta, 'se': se, 'z': z, 'p_value': 2 * stats.norm.sf(np.abs(z))},
+                        index=names)
+
+def cuped(df, outcome, covariate=CUPED_COVARIATE):
+    # Y - theta * (X - mean X), with theta = cov(X, Y) / var(X) pooled over both arms.
+    # X is measured before enrollment, so the adjustment does not bias the effect.
+    frame = df[[outcome, covariate, TREATMENT]].dropna()
+    y = frame[outcome].to_numpy(dtype=float)
+    x = frame[covariate].to_numpy(dtype=float)
+    treated = frame[TREATMENT].to_numpy(dtype=bool)
+    variance = x.var()
+    theta = np.cov(x, y)[0, 1] / variance if variance > 0 else 0.0
+    adjusted = y - theta * (x - x.mean())
+
+    def difference(values):
+        a, b = values[treated], values[~treated]
+        return a.mean() - b.mean(), np.sqrt(a.var(ddof=1) / len(a) + b.var(ddof=1) / len(b))
+
+    naive, naive_se = difference(y)
+    effect, se = difference(adjusted)
+    return {
+        'theta': theta,
+        'naive_effect': naive,
+        'naive_se': naive_se,
+        'effect': effect,
+        'se': se,
+        'p_value': 2 * stats.norm.sf(abs(effect / se)) if se > 0 else np.nan,
+        'variance_reduction': 1 - (se / naive_se) ** 2 if naive_se > 0 else np.nan,
+    }
+
+def is_binary(data, outcome):
+    sample = next(frame_chunks(data, 1000), None)
+    return sample is not None and pd.api.types.is_bool_dtype(sample[outcome])
+
+@traced()
+def adjusted_effects(data, outcomes=None, covariates=COVARIATES, chunk_rows=DEFAULT_CHUNK_ROWS):
+    # data: a patient-level DataFrame, or a callable returning an iterator of
+    # chunks. CUPED needs the PriorVisits column and an in-memory frame.
+    try:
+        outcomes = outcomes or DEFAULT_OUTCOMES
+        levels = covariate_levels(data, covariates, chunk_rows)
+        names = design_names(levels, covariates)
+        results = {}
+        for outcome in outcomes:
+            result = {}
+            beta, covariance, n = fit_ols(data, outcome, levels, covariates, chunk_rows)
+            ols = coefficient_summary(beta, covariance, names)
+            result['ols'] = {'n': n, **ols.loc[TREATMENT].to_dict()}
+            logging.info(f"{outcome}: adjusted linear effect {ols.loc[TREATMENT, 'coefficient']:.4f} "
+                         f"(SE {ols.loc[TREATMENT, 'se']:.4f}, p={ols.loc[TREATMENT, 'p_value']:.4g})")
+
+            if is_binary(data, outcome):
+                beta, covariance, n, iterations = fit_logistic(data, outcome, levels, covariates, chunk_rows)
+                logistic = coefficient_summary(beta, covariance, names)
+                risk_difference, rd_se = average_risk_difference(data, outcome, levels, beta, covariance,
+                                                                 covariates, chunk_rows)
+                result['logistic'] = {
+                    'n': n,
+                    'iterations': iterations,
+                    **logistic.loc[TREATMENT].to_dict(),
+                    'odds_ratio': float(np.exp(logistic.loc[TREATMENT, 'coefficient'])),
+                    'risk_difference': risk_difference,
+                    'risk_difference_se': rd_se,
+                }
+                logging.info(f"{outcome}: adjusted odds ratio {result['logistic']['odds_ratio']:.4f} "
+                             f"(p={logistic.loc[TREATMENT, 'p_value']:.4g}), risk difference "
+                             f"{risk_difference:.4f} (SE {rd_se:.4f}) after {iterations} iterations")
+
+            if isinstance(data, pd.DataFrame) and CUPED_COVARIATE in data:
+                result['cuped'] = cuped(data, outcome)
+                logging.info(f"{outcome}: CUPED effect {result['cuped']['effect']:.4f} (SE {result['cuped']['se']:.4f}, "
+                             f"naive SE {result['cuped']['naive_se']:.4f}, variance reduction "
+                             f"{result['cuped']['variance_reduction']:.1%})")
+            results[outcome] = result
+        return results
+    except Exception as e:
+        logging.error(f"Error in adjusted_effects: {e}")
+        raise
@@ -2,8 +2,32 @@ import pandas as pd
 import numpy as np
 from scipy import stats
 import logging
+from adjusted import adjusted_effects
+from bootstrap import DEFAULT_SEED, bootstrap_inference, permutation_test
+from matching import MATCH_WEIGHT, matched_effects, reused_control_rows
+from metric_tests import ARM_DEFINITIONS, analyze_metrics
+from stat_tests import chi2_2x2, moments
+from subgroups import DEFAULT_DIMENSIONS, analyze_subgroups
+from survival import survival_analysis
+from tracing import traced
 
-def analyze_results(df):
+# Per-arm results with the matched outcome they come from on a matched cohort
+MATCHED_ARM_RESULTS = [('readmission_rates', 'IsReadmission'), ('satisfaction_scores', 'Satisfaction'),
+                       ('days_to_readmission', 'DaysToReadmission')]
+
+def check_matched_analyses(n_bootstrap=0, n_permutations=0, metrics=None, adjusted_outcomes=None, survival=False):
+    # These treat every row as an independent patient and ignore MatchWeight,
+    # so a control matched twice would count as two patients
+    requested = [name for name, wanted in [('bootstrap', n_bootstrap), ('permutation', n_permutations),
+                                           ('metric', metrics is not None), ('adjusted', adjusted_outcomes is not None),
+                                           ('survival', survival)] if wanted]
+    if requested:
+        raise ValueError(f"The {', '.join(requested)} analyses ignore MatchWeight and cannot run on a matched "
+                         f"cohort; run them on the unmatched patients")
+
+@traced()
+def analyze_results(df, n_bootstrap=0, n_permutations=0, seed=DEFAULT_SEED, workers=None,
+                    metrics=None, arm_definitions=ARM_DEFINITIONS, adjusted_outcomes=None, survival=False):
     results = {}
     try:
         control_group = df[df['EnrolledInProgram'] == False]
@@ -12,8 +36,19 @@ def analyze_results(df):
         if control_group.empty or treatment_group.empty:
             raise ValueError("One or both groups are empty. Cannot perform analysis.")
 
-        control_readmission_rate = control_group['IsReadmission'].mean()
-        treatment_readmission_rate = treatment_group['IsReadmission'].mean()
+        matched = MATCH_WEIGHT in df
+        if matched:
+            check_matched_analyses(n_bootstrap, n_permutations, metrics, adjusted_outcomes, survival)
+            # A matched cohort (matching.match_patients): the headline figures
+            # weight controls by MatchWeight and use match-aware standard errors
+            effects = matched_effects(df)
+            results['matched_effects'] = effects.to_dict('records')
+            readmission = effects.set_index('outcome').loc['IsReadmission']
+            control_readmission_rate = readmission['mean_control']
+            treatment_readmission_rate = readmission['mean_treatment']
+        else:
+            control_readmission_rate = control_group['IsReadmission'].mean()
+            treatment_readmission_rate = treatment_group['IsReadmission'].mean()
 
         results['control_readmission_rate'] = control_readmission_rate
         results['treatment_readmission_rate'] = treatment_readmission_rate
@@ -21,8 +56,12 @@ def analyze_results(df):
         logging.info(f"Control group readmission rate: {control_readmission_rate:.2%}")
         logging.info(f"Treatment group readmission rate: {treatment_readmission_rate:.2%}")
 
-        contingency_table = pd.crosstab(df['EnrolledInProgram'], df['IsReadmission'])
-        chi2, p_value, dof, expected = stats.chi2_contingency(contingency_table)
+        if matched:
+            # The square of the matched z statistic, on 1 degree of freedom
+            chi2, p_value = readmission['z'] ** 2, readmission['p_value']
+        else:
+            contingency_table = pd.crosstab(df['EnrolledInProgram'], df['IsReadmission'])
+            chi2, p_value, dof, expected = stats.chi2_contingency(contingency_table)
 
         results['chi2'] = chi2
         results['p_value'] = p_value
@@ -34,16 +73,47 @@ def analyze_results(df):
         results['relative_risk_reduction'] = relative_risk_reduction
         logging.info(f"Relative Risk Reduction: {relative_risk_reduction:.2%}")
 
-        results['readmission_rates'] = analyze_readmission_rates(df)
-        results['satisfaction_scores'] = analyze_patient_satisfaction(df)
-        results['days_to_readmission'] = analyze_days_to_readmission(df)
+        if matched:
+            for row in effects.itertuples(index=False):
+                logging.info(f"Matched {row.outcome}: {row.mean_treatment:.4f} vs {row.mean_control:.4f}, effect "
+                             f"{row.effect:.4f} (SE {row.se:.4f}, p={row.p_value:.4g}) over "
+                             f"{row.n_control_patients} distinct controls")
+            reused, control_rows = reused_control_rows(df)
+            logging.info(f"{reused} of {control_rows} control rows repeat a control matched more than once")
+
+            by_outcome = effects.set_index('outcome')
+            for key, outcome in MATCHED_ARM_RESULTS:
+                if outcome in by_outcome.index:
+                    row = by_outcome.loc[outcome]
+                    results[key] = {False: row['mean_control'], True: row['mean_treatment']}
+                else:
+                    results[key] = {False: np.nan, True: np.nan}
+        else:
+            results['readmission_rates'] = analyze_readmission_rates(df)
+            results['satisfaction_scores'] = analyze_patient_satisfaction(df)
+            results['days_to_readmission'] = analyze_days_to_readmission(df)
         results['subgroup_results'] = perform_subgroup_analysis(df)
 
+        if n_bootstrap:
+            results['bootstrap'] = bootstrap_inference(df, n_bootstrap, seed, workers)
+        if n_permutations:
+            results['permutation'] = permutation_test(df, n_permutations, seed, workers)
+        if metrics is not None:
+            # An empty list tests every default metric the frame has
+            results['metric_tests'] = analyze_metrics(df, metrics or None, arm_definitions).to_dict('records')
+        if adjusted_outcomes is not None:
+            # An empty list adjusts the default outcomes
+            results['adjusted'] = adjusted_effects(df, adjusted_outcomes or None)
+        if survival:
+            # Censored time to readmission; needs the columns from load_data(study_end=...)
+            results['survival'] = survival_analysis(df)
+
         return results
     except Exception as e:
         logging.error(f"Error in analyze_results: {e}")
         raise
 
+@traced()
 def analyze_readmission_rates(df):
     try:
         readmission_rates = df.groupby('EnrolledInProgram')['IsReadmission'].mean()
@@ -64,6 +134,7 @@ def analyze_readmission_rates(df):
         logging.error(f"Error in analyze_readmission_rates: {e}")
         raise
 
+@traced()
 def analyze_patient_satisfaction(df):
     try:
         satisfaction = df.groupby('EnrolledInProgram')['Satisfaction'].mean()
@@ -80,6 +151,7 @@ def analyze_patient_satisfaction(df):
         logging.error(f"Error in analyze_patient_satisfaction: {e}")
         raise
 
+@traced()
 def analyze_days_to_readmission(df):
     try:
         days_to_readmission = df.groupby('EnrolledInProgram')['DaysToReadmission'].mean()
@@ -96,22 +168,140 @@ def analyze_days_to_readmission(df):
         logging.error(f"Error in analyze_days_to_readmission: {e}")
         raise
 
-def perform_subgroup_analysis(df):
+@traced()
+def perform_subgroup_analysis(df, dimensions=None, method='fdr_bh', counts=None):
     try:
+        dimensions = dimensions or DEFAULT_DIMENSIONS
+        table = analyze_subgroups(df, dimensions, method, counts=counts)
         subgroup_results = {}
-        for condition in df['ChronicCondition'].unique():
-            subgroup = df[df['ChronicCondition'] == condition]
-            control_rate = subgroup[subgroup['EnrolledInProgram'] == False]['IsReadmission'].mean()
-            treatment_rate = subgroup[subgroup['EnrolledInProgram'] == True]['IsReadmission'].mean()
-            subgroup_results[condition] = {
-                'control_rate': control_rate,
-                'treatment_rate': treatment_rate
+        for row in table.itertuples(index=False):
+            key = tuple(getattr(row, d) for d in dimensions)
+            key = key[0] if len(key) == 1 else key
+            subgroup_results[key] = {
+                'control_rate': row.control_rate,
+                'treatment_rate': row.treatment_rate,
+                'p_value': row.p_value,
+                'p_adjusted': row.p_adjusted,
             }
-            logging.info(f"\nSubgroup: {condition}")
-            logging.info(f"Control readmission rate: {control_rate:.2%}")
-            logging.info(f"Treatment readmission rate: {treatment_rate:.2%}")
+            logging.info(f"\nSubgroup: {key}")
+            logging.info(f"Control readmission rate: {row.control_rate:.2%}")
+            logging.info(f"Treatment readmission rate: {row.treatment_rate:.2%}")
+            logging.info(f"{row.test} p-value: {row.p_value:.4f} (adjusted: {row.p_adjusted:.4f})")
         return subgroup_results
     except Exception as e:
         logging.error(f"Error in perform_subgroup_analysis: {e}")
         raise
 
+# Aggregate-pushdown mode: the same results as analyze_results, computed from
+# the per-arm sufficient statistics of data_loading.load_arm_statistics
+
+def overall_arm_statistics(arm_stats):
+    overall = arm_stats[~arm_stats['is_subgroup'].astype(bool)].set_index('EnrolledInProgram')
+    # A readmission flag is 0/1, so its sum of squares equals its sum
+    overall = overall.assign(
+        readmission_n=overall['n'],
+        readmission_sum=overall['readmissions'].astype(float),
+        readmission_sumsq=overall['readmissions'].astype(float),
+    )
+    return overall
+
+def arm_summary(overall, metric):
+    n = overall[f'{metric}_n'].astype(float)
+    mean, variance = moments(n, overall[f'{metric}_sum'].astype(float), overall[f'{metric}_sumsq'].astype(float))
+    return mean, np.sqrt(variance), n
+
+@traced()
+def analyze_metric_from_stats(overall, metric, title):
+    try:
+        mean, std, n = arm_summary(overall, metric)
+        logging.info(f"\n{title}:")
+        logging.info(mean)
+
+        if n.loc[True] > 1 and n.loc[False] > 1:
+            t_stat, p_value = stats.ttest_ind_from_stats(
+                mean.loc[True], std.loc[True], n.loc[True], mean.loc[False], std.loc[False], n.loc[False]
+            )
+            logging.info(f"T-statistic: {t_stat}, P-value: {p_value}")
+        else:
+            logging.warning("Not enough data to perform t-test")
+
+        return mean.to_dict()
+    except Exception as e:
+        logging.error(f"Error in analyze_metric_from_stats ({metric}): {e}")
+        raise
+
+@traced()
+def analyze_results_from_stats(arm_stats):
+    results = {}
+    try:
+        overall = overall_arm_statistics(arm_stats)
+        if False not in overall.index or True not in overall.index:
+            raise ValueError("One or both groups are empty. Cannot perform analysis.")
+
+        control, treatment = overall.loc[False], overall.loc[True]
+        control_readmission_rate = control['readmissions'] / control['n']
+        treatment_readmission_rate = treatment['readmissions'] / treatment['n']
+
+        results['control_readmission_rate'] = control_readmission_rate
+        results['treatment_readmission_rate'] = treatment_readmission_rate
+
+        logging.info(f"Control group readmission rate: {control_readmission_rate:.2%}")
+        logging.info(f"Treatment group readmission rate: {treatment_readmission_rate:.2%}")
+
+        contingency_table = np.array([
+            [control['n'] - control['readmissions'], control['readmissions']],
+            [treatment['n'] - treatment['readmissions'], treatment['readmissions']],
+        ])
+        chi2, p_value, dof, expected = stats.chi2_contingency(contingency_table)
+
+        results['chi2'] = chi2
+        results['p_value'] = p_value
+
+        logging.info(f"Chi-square statistic: {chi2:.4f}")
+        logging.info(f"p-value: {p_value:.4f}")
+
+        relative_risk_reduction = (control_readmission_rate - treatment_readmission_rate) / control_readmission_rate
+        results['relative_risk_reduction'] = relative_risk_reduction
+        logging.info(f"Relative Risk Reduction: {relative_risk_reduction:.2%}")
+
+        results['readmission_rates'] = analyze_metric_from_stats(overall, 'readmission', 'Readmission Rates')
+        results['satisfaction_scores'] = analyze_metric_from_stats(overall, 'satisfaction', 'Average Satisfaction Scores')
+        results['days_to_readmission'] = analyze_metric_from_stats(overall, 'days', 'Average Days to Readmission')
+        results['subgroup_results'] = perform_subgroup_analysis(
+            None, counts=arm_stats[arm_stats['is_subgroup'].astype(bool)]
+        )
+
+        return results
+    except Exception as e:
+        logging.error(f"Error in analyze_results_from_stats: {e}")
+        raise
+
+@traced()
+def analyze_rolling_windows(rolling_stats):
+    # Readmission rates and the chi-square test of every window at once, from
+    # the stacked per-window arm statistics of load_rolling_arm_statistics
+    try:
+        overall = rolling_stats[~rolling_stats['is_subgroup'].astype(bool)]
+        table = overall.pivot_table(index=['WindowStart', 'WindowEnd'], columns='EnrolledInProgram',
+                                    values=['n', 'readmissions'], aggfunc='sum', fill_value=0)
+        n_c, n_t = table[('n', False)], table[('n', True)]
+        r_c, r_t = table[('readmissions', False)], table[('readmissions', True)]
+        chi2, p_value = chi2_2x2(n_c - r_c, r_c, n_t - r_t, r_t)
+        windows = pd.DataFrame({
+            'n_control': n_c,
+            'n_treatment': n_t,
+            'control_readmission_rate': r_c / n_c,
+            'treatment_readmission_rate': r_t / n_t,
+            'chi2': chi2,
+            'p_value': p_value,
+        }, index=table.index).reset_index()
+        windows['relative_risk_reduction'] = 1 - windows['treatment_readmission_rate'] / windows['control_readmission_rate']
+
+        for row in windows.itertuples(index=False):
+            logging.info(f"{row.WindowStart} to {row.WindowEnd}: control {row.control_readmission_rate:.2%}, "
+                         f"treatment {row.treatment_readmission_rate:.2%}, RRR {row.relative_risk_reduction:.2%}, "
+                         f"p={row.p_value:.4f}")
+        return windows
+    except Exception as e:
+        logging.error(f"Error in analyze_rolling_windows: {e}")
+        raise
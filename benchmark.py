@@ -0,0 +1,218 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from database_utils import BACKENDS, close_pool, db_config, execute_query
+
+DEFAULT_SIZES = [10000, 100000, 1000000, 10000000]
+DEFAULT_TOLERANCE = 0.2
+DEFAULT_SEED = 12345
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+POPULATED_TABLES = ['patients', 'program_enrollment', 'hospital_visits', 'survey_responses', 'medications']
+
+# Each stage runs as its own `main.py` process, so wall time and peak RSS are
+# measured per stage; intermediate results pass through the artifacts directory.
+# Peak RSS is that of the stage's largest single process (the main.py process or
+# one of its pool workers), not the sum over the processes of the stage.
+def pipeline_stages(size, seed, pushdown):
+    load = ['load', '--no-cache'] + (['--pushdown'] if pushdown else [])
+    analyze = ['analyze'] + (['--pushdown'] if pushdown else [])
+    return [
+        ('create_tables', ['create-tables']),
+        ('populate', ['populate', '--patients', str(size), '--seed', str(seed)]),
+        ('load_data', load),
+        ('analyze_results', analyze),
+        ('create_visualizations', ['plot', '--force']),
+    ]
+
+def admin_connection():
+    import psycopg2
+
+    config = dict(db_config(), dbname=os.environ.get('DB_ADMIN_NAME', 'postgres'))
+    conn = psycopg2.connect(**config)
+    conn.autocommit = True  # CREATE/DROP DATABASE cannot run in a transaction
+    return conn
+
+def create_database(name):
+    conn = admin_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'DROP DATABASE IF EXISTS "{name}"')
+            cur.execute(f'CREATE DATABASE "{name}"')
+    finally:
+        conn.close()
+
+def drop_database(name):
+    close_pool()
+    conn = admin_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'DROP DATABASE IF EXISTS "{name}"')
+    finally:
+        conn.close()
+
+def run_stage(args, env):
+    command = [sys.executable, os.path.join(SCRIPT_DIR, 'main.py')] + args
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env, cwd=env['BENCHMARK_WORKDIR'])
+    # wait4 gives the resource usage of this stage's processes alone. CPU time
+    # sums over the process and its waited-for children; ru_maxrss is the
+    # largest of their peaks, not their total.
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        'wall_seconds': time.perf_counter() - start,
+        'cpu_seconds': usage.ru_utime + usage.ru_stime,
+        'peak_rss_mb': usage.ru_maxrss / 1024,  # ru_maxrss is in KiB on Linux
+        'exit_code': process.returncode,
+    }
+
+def table_rows(tables):
+    query = " UNION ALL ".join(f"SELECT COUNT(*) AS n FROM {table}" for table in tables)
+    try:
+        return int(execute_query(f"SELECT SUM(n) AS total FROM ({query}) counts")['total'].iloc[0])
+    finally:
+        # A DuckDB file admits one process at a time; let the next stage open it
+        close_pool()
+
+def backend_database(size, backend, workdir):
+    # Environment pointing every stage at a fresh database for this size
+    if backend == 'duckdb':
+        path = os.path.join(workdir, f"patientcare_bench_{size}.duckdb")
+        if os.path.exists(path):
+            os.remove(path)
+        return {'READMISSION_BACKEND': 'duckdb', 'DUCKDB_PATH': path}
+    database = f"patientcare_bench_{size}"
+    create_database(database)
+    return {'READMISSION_BACKEND': 'postgres', 'DB_NAME': database}
+
+def drop_backend_database(database):
+    if database['READMISSION_BACKEND'] == 'duckdb':
+        close_pool()
+        if os.path.exists(database['DUCKDB_PATH']):
+            os.remove(database['DUCKDB_PATH'])
+    else:
+        drop_database(database['DB_NAME'])
+
+@contextmanager
+def environment(values):
+    # The row counts are queried in this process, through database_utils,
+    # which reads its configuration from the environment; restore it afterwards
+    saved = {name: os.environ.get(name) for name in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        close_pool()
+
+def benchmark_size(size, seed, pushdown, workdir, backend='postgres'):
+    database = backend_database(size, backend, workdir)
+    env = dict(os.environ, **database, READMISSION_CACHE='0', BENCHMARK_WORKDIR=workdir)
+    with environment(database):
+        close_pool()
+        return run_benchmark(size, seed, pushdown, backend, database, env)
+
+def run_benchmark(size, seed, pushdown, backend, database, env):
+    records = []
+    try:
+        for stage, stage_args in pipeline_stages(size, seed, pushdown):
+            logging.info(f"[{size}] {stage}")
+            record = {'size': size, 'backend': backend, 'stage': stage, **run_stage(stage_args, env)}
+            if record['exit_code'] != 0:
+                records.append(record)
+                logging.error(f"[{size}] {stage} failed with exit code {record['exit_code']}")
+                break
+            if stage == 'populate':
+                record['rows'] = table_rows(POPULATED_TABLES)
+            elif stage != 'create_tables':
+                record['rows'] = table_rows(['patients'])
+            if record.get('rows'):
+                record['rows_per_sec'] = record['rows'] / record['wall_seconds']
+            records.append(record)
+            logging.info(f"[{size}] {stage}: {record['wall_seconds']:.2f}s, "
+                         f"largest process peak RSS {record['peak_rss_mb']:.0f} MiB")
+    finally:
+        drop_backend_database(database)
+    return records
+
+def compare(records, baseline, tolerance):
+    key = lambda r: (r['size'], r.get('backend', 'postgres'), r['stage'])
+    reference = {key(r): r for r in baseline}
+    regressions = []
+    for record in records:
+        base = reference.get(key(record))
+        if base is None:
+            continue
+        for metric in ('wall_seconds', 'peak_rss_mb'):
+            if base.get(metric) and record[metric] > base[metric] * (1 + tolerance):
+                regressions.append({
+                    'size': record['size'],
+                    'backend': record['backend'],
+                    'stage': record['stage'],
+                    'metric': metric,
+                    'baseline': base[metric],
+                    'current': record[metric],
+                    'change': record[metric] / base[metric] - 1,
+                })
+    for r in regressions:
+        logging.warning(f"Regression: {r['stage']} at {r['size']} patients on {r['backend']}, {r['metric']} "
+                        f"{r['baseline']:.2f} -> {r['current']:.2f} ({r['change']:+.0%})")
+    return regressions
+
+def write_report(records, path):
+    with open(path, 'w') as f:
+        json.dump(records, f, indent=2)
+    csv_path = os.path.splitext(path)[0] + '.csv'
+    columns = ['size', 'backend', 'stage', 'wall_seconds', 'cpu_seconds', 'peak_rss_mb', 'rows', 'rows_per_sec', 'exit_code']
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(records)
+    logging.info(f"Wrote {path} and {csv_path}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline end to end against throwaway databases.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="Cohort sizes in patients")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--backend', choices=BACKENDS, nargs='+', default=['postgres'],
+                        help="Backends to benchmark; duckdb uses a throwaway database file per size")
+    parser.add_argument('--pushdown', action='store_true',
+                        help="Benchmark the aggregate-pushdown load and analyze stages")
+    parser.add_argument('--output', default='benchmark_report.json',
+                        help="JSON report path; a CSV with the same name is written next to it")
+    parser.add_argument('--baseline', default=None,
+                        help="Earlier JSON report to compare against")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed relative slowdown or memory growth before flagging a regression")
+    args = parser.parse_args(argv)
+
+    records = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for backend in args.backend:
+            for size in args.sizes:
+                records.extend(benchmark_size(size, args.seed, args.pushdown, workdir, backend))
+    write_report(records, args.output)
+
+    failed = any(r['exit_code'] != 0 for r in records)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(records, json.load(f), args.tolerance)
+        if regressions:
+            return 1
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
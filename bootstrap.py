@@ -0,0 +1,173 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from tracing import traced
+
+DEFAULT_REPLICATES = 10000
+DEFAULT_SEED = 12345
+# Upper bound on the index and gathered-value matrices of one batch
+DEFAULT_BATCH_BYTES = 256 * 1024 ** 2
+# Bytes per resampled patient: int32 index plus a float64 gather per pass
+BYTES_PER_DRAW = 4 + 8 * 2
+
+METRICS = ['control_readmission_rate', 'treatment_readmission_rate', 'relative_risk_reduction',
+           'satisfaction_difference', 'days_to_readmission_difference']
+
+# Set once per worker process by init_worker, so the arrays are pickled per
+# worker rather than per batch
+_arrays = None
+
+def prepare_arrays(df):
+    arm = df['EnrolledInProgram']
+    keep = arm.notna().to_numpy()
+    treatment = arm.to_numpy()[keep].astype(bool)
+    if treatment.all() or not treatment.any():
+        raise ValueError("One or both groups are empty. Cannot perform analysis.")
+    columns = {
+        'readmission': df['IsReadmission'].to_numpy()[keep].astype(np.float64),
+        'satisfaction': df['Satisfaction'].to_numpy()[keep].astype(np.float64),
+        'days': df['DaysToReadmission'].to_numpy()[keep].astype(np.float64),
+    }
+    arrays = {'treatment': treatment}
+    for name, values in columns.items():
+        valid = ~np.isnan(values)
+        arrays[name] = np.where(valid, values, 0.0)
+        arrays[f'{name}_valid'] = valid.astype(np.float64)
+    return arrays
+
+def init_worker(arrays):
+    global _arrays
+    _arrays = arrays
+
+def batch_sizes(total, n, max_bytes):
+    size = max(1, min(total, max_bytes // max(1, n * BYTES_PER_DRAW)))
+    sizes = [size] * (total // size)
+    if total % size:
+        sizes.append(total % size)
+    return sizes
+
+def nan_mean(sums, counts):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums / counts
+
+def arm_means(arrays, rows):
+    # rows: (replicates x n) matrix of row indices into one arm
+    means = {}
+    for name in ('readmission', 'satisfaction', 'days'):
+        sums = arrays[name][rows].sum(axis=1)
+        counts = arrays[f'{name}_valid'][rows].sum(axis=1)
+        means[name] = nan_mean(sums, counts)
+    return means
+
+def statistics(control, treatment):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rrr = (control['readmission'] - treatment['readmission']) / control['readmission']
+    return {
+        'control_readmission_rate': control['readmission'],
+        'treatment_readmission_rate': treatment['readmission'],
+        'relative_risk_reduction': rrr,
+        'satisfaction_difference': treatment['satisfaction'] - control['satisfaction'],
+        'days_to_readmission_difference': treatment['days'] - control['days'],
+    }
+
+def bootstrap_batch(task):
+    seed, size = task
+    rng = np.random.default_rng(seed)
+    arms = {}
+    # Resample within each arm so both arm sizes stay fixed
+    for name, members in (('control', ~_arrays['treatment']), ('treatment', _arrays['treatment'])):
+        positions = np.flatnonzero(members).astype(np.int32)
+        rows = positions[rng.integers(0, len(positions), (size, len(positions)), dtype=np.int32)]
+        arms[name] = arm_means(_arrays, rows)
+        del rows
+    return statistics(arms['control'], arms['treatment'])
+
+def permutation_batch(task):
+    seed, size = task
+    rng = np.random.default_rng(seed)
+    n = len(_arrays['treatment'])
+    # Each row of the label matrix is an independent shuffle of the arm labels
+    labels = rng.permuted(np.broadcast_to(_arrays['treatment'], (size, n)), axis=1).astype(np.float64)
+    arms = {'control': {}, 'treatment': {}}
+    for name in ('readmission', 'satisfaction', 'days'):
+        values, valid = _arrays[name], _arrays[f'{name}_valid']
+        treated_sum, treated_count = labels @ values, labels @ valid
+        arms['treatment'][name] = nan_mean(treated_sum, treated_count)
+        arms['control'][name] = nan_mean(values.sum() - treated_sum, valid.sum() - treated_count)
+    del labels
+    return statistics(arms['control'], arms['treatment'])
+
+def run_batches(function, arrays, replicates, seed, workers, max_bytes):
+    sizes = batch_sizes(replicates, len(arrays['treatment']), max_bytes)
+    # Batch seeds depend only on the seed and batch layout, not on the worker count
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = list(zip(seeds, sizes))
+    workers = workers or os.cpu_count() or 1
+    logging.info(f"Running {replicates} replicates in {len(sizes)} batches of up to {sizes[0]} on {workers} workers")
+
+    if workers <= 1:
+        init_worker(arrays)
+        results = [function(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(arrays,)) as pool:
+            results = list(pool.map(function, tasks))
+    return {metric: np.concatenate([r[metric] for r in results]) for metric in METRICS}
+
+def observed_statistics(arrays):
+    treatment = arrays['treatment']
+    arms = {}
+    for name, members in (('control', ~treatment), ('treatment', treatment)):
+        arms[name] = {
+            metric: nan_mean(arrays[metric][members].sum(), arrays[f'{metric}_valid'][members].sum())
+            for metric in ('readmission', 'satisfaction', 'days')
+        }
+    return statistics(arms['control'], arms['treatment'])
+
+@traced()
+def bootstrap_inference(df, replicates=DEFAULT_REPLICATES, seed=DEFAULT_SEED, workers=None,
+                        confidence=0.95, max_bytes=DEFAULT_BATCH_BYTES):
+    try:
+        arrays = prepare_arrays(df)
+        observed = observed_statistics(arrays)
+        samples = run_batches(bootstrap_batch, arrays, replicates, seed, workers, max_bytes)
+        tail = (1 - confidence) / 2 * 100
+        results = {}
+        for metric in METRICS:
+            values = samples[metric][~np.isnan(samples[metric])]
+            low, high = np.percentile(values, [tail, 100 - tail]) if values.size else (np.nan, np.nan)
+            results[metric] = {
+                'estimate': float(observed[metric]),
+                'ci_low': float(low),
+                'ci_high': float(high),
+                'se': float(values.std(ddof=1)) if values.size > 1 else np.nan,
+            }
+            logging.info(f"{metric}: {results[metric]['estimate']:.4f} "
+                         f"({confidence:.0%} CI {low:.4f} to {high:.4f})")
+        return results
+    except Exception as e:
+        logging.error(f"Error in bootstrap_inference: {e}")
+        raise
+
+@traced()
+def permutation_test(df, permutations=DEFAULT_REPLICATES, seed=DEFAULT_SEED, workers=None,
+                     max_bytes=DEFAULT_BATCH_BYTES):
+    try:
+        arrays = prepare_arrays(df)
+        observed = observed_statistics(arrays)
+        samples = run_batches(permutation_batch, arrays, permutations, seed, workers, max_bytes)
+        results = {}
+        for metric in ('relative_risk_reduction', 'satisfaction_difference', 'days_to_readmission_difference'):
+            values = samples[metric][~np.isnan(samples[metric])]
+            extreme = np.count_nonzero(np.abs(values) >= abs(observed[metric]))
+            results[metric] = {
+                'estimate': float(observed[metric]),
+                'p_value': (extreme + 1) / (values.size + 1),
+            }
+            logging.info(f"{metric}: permutation p-value {results[metric]['p_value']:.4f}")
+        return results
+    except Exception as e:
+        logging.error(f"Error in permutation_test: {e}")
+        raise
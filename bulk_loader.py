@@ -0,0 +1,153 @@
+import csv
+import io
+import logging
+import time
+from datetime import date, datetime
+
+import pandas as pd
+
+try:
+    from psycopg2.extras import execute_values
+except ImportError:
+    execute_values = None
+
+from create_tables import PARTITION_KEYS, create_month_partitions, existing_partitions
+from database_utils import backend_name
+
+DEFAULT_BATCH_SIZE = 10000
+
+def format_value(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+def iter_csv_batches(rows, batch_size=DEFAULT_BATCH_SIZE):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    count = 0
+    for row in rows:
+        writer.writerow([format_value(v) for v in row])
+        count += 1
+        if count == batch_size:
+            yield buffer.getvalue(), count
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            count = 0
+    if count:
+        yield buffer.getvalue(), count
+
+def iter_file_batches(path, batch_size=DEFAULT_BATCH_SIZE):
+    # Spooled CSV files hold one row per line, so batches are split on lines
+    with open(path, newline='') as f:
+        lines = []
+        for line in f:
+            lines.append(line)
+            if len(lines) == batch_size:
+                yield ''.join(lines), len(lines)
+                lines = []
+        if lines:
+            yield ''.join(lines), len(lines)
+
+def batch_months(text, columns, key):
+    # First days of the months in the batch's key column; dates are ISO strings
+    values = pd.read_csv(io.StringIO(text), header=None, usecols=[columns.index(key)], dtype=str).iloc[:, 0]
+    return {date.fromisoformat(f"{month}-01") for month in values.dropna().str[:7].unique()}
+
+def copy_batch(cur, table, columns, text):
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        io.StringIO(text)
+    )
+
+def insert_batch(cur, table, columns, text, batch_size):
+    # Empty CSV fields are NULLs, matching what COPY does in csv format
+    values = [[v if v != '' else None for v in row] for row in csv.reader(io.StringIO(text))]
+    execute_values(
+        cur,
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s",
+        values,
+        page_size=batch_size
+    )
+
+def append_batch(conn, table, columns, text):
+    # DuckDB has no COPY FROM STDIN; the batch is parsed into a frame and
+    # appended in one vectorized INSERT, empty fields again becoming NULLs
+    frame = pd.read_csv(io.StringIO(text), header=None, names=columns, dtype=str, keep_default_na=False)
+    conn.register('batch', frame.replace('', None))
+    try:
+        conn.execute(f"INSERT INTO {table} ({', '.join(columns)}) SELECT * FROM batch")
+    finally:
+        conn.unregister('batch')
+
+def load_table(conn, table, columns, batches, method='copy', batch_size=DEFAULT_BATCH_SIZE):
+    if method not in ('copy', 'insert'):
+        raise ValueError(f"Unknown load method: {method}")
+
+    start = time.perf_counter()
+    rows = 0
+    try:
+        if backend_name() == 'duckdb':
+            # DuckDB cursors are separate connections, so the batches go through conn's own transaction
+            conn.begin()
+            for text, count in batches:
+                append_batch(conn, table, columns, text)
+                rows += count
+        else:
+            with conn.cursor() as cur:
+                # Partitioned tables get a partition for every month before its rows arrive
+                partitions = existing_partitions(cur, table) if table in PARTITION_KEYS else None
+                for text, count in batches:
+                    if partitions is not None:
+                        create_month_partitions(cur, table, batch_months(text, columns, PARTITION_KEYS[table]),
+                                                partitions)
+                    if method == 'copy':
+                        copy_batch(cur, table, columns, text)
+                    else:
+                        insert_batch(cur, table, columns, text, batch_size)
+                    rows += count
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logging.error(f"Error loading {table}: {e}")
+        raise
+
+    elapsed = time.perf_counter() - start
+    logging.info(f"Loaded {rows} rows into {table} in {elapsed:.2f}s")
+    return {'table': table, 'rows': rows, 'seconds': elapsed}
+
+def load_rows(conn, table, columns, rows, method='copy', batch_size=DEFAULT_BATCH_SIZE):
+    return load_table(conn, table, columns, iter_csv_batches(rows, batch_size), method, batch_size)
+
+def load_file(conn, table, columns, path, method='copy', batch_size=DEFAULT_BATCH_SIZE):
+    if method == 'copy' and backend_name() == 'duckdb':
+        return copy_file(conn, table, columns, path)
+    return load_table(conn, table, columns, iter_file_batches(path, batch_size), method, batch_size)
+
+def copy_file(conn, table, columns, path):
+    # DuckDB reads the spooled CSV file itself, in parallel
+    start = time.perf_counter()
+    try:
+        rows = conn.execute(
+            f"COPY {table} ({', '.join(columns)}) FROM '{path}' (FORMAT csv, HEADER false)"
+        ).fetchone()[0]
+    except Exception as e:
+        logging.error(f"Error loading {table}: {e}")
+        raise
+
+    elapsed = time.perf_counter() - start
+    logging.info(f"Loaded {rows} rows into {table} in {elapsed:.2f}s")
+    return {'table': table, 'rows': rows, 'seconds': elapsed}
+
+def log_load_summary(stats):
+    total_rows = sum(s['rows'] for s in stats)
+    total_seconds = sum(s['seconds'] for s in stats)
+    logging.info("\nLoad summary:")
+    for s in stats:
+        rate = s['rows'] / s['seconds'] if s['seconds'] > 0 else float('inf')
+        logging.info(f"{s['table']:<20} {s['rows']:>12} rows {s['seconds']:>9.2f}s {rate:>14,.0f} rows/sec")
+    rate = total_rows / total_seconds if total_seconds > 0 else float('inf')
+    logging.info(f"{'total':<20} {total_rows:>12} rows {total_seconds:>9.2f}s {rate:>14,.0f} rows/sec")
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+except ImportError:
+    pa = None
+
+import duckdb_backend
+from database_utils import backend_name, database_identity, execute_query
+
+DEFAULT_CACHE_DIR = os.path.join('.cache', 'queries')
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# Per-table freshness watermark from the catalog, with no table scanned: the
+# change counter that create_tables' triggers bump in every writing
+# transaction (and create_tables bumps on view refreshes), plus the relation
+# filenodes, which change on TRUNCATE, rewrites and rebuilds. Partitioned tables
+# list the filenodes of their partitions. The counters are transactional, so
+# they never lag behind a commit, unlike the statistics collector's.
+CHANGE_COUNTERS_QUERY = "SELECT to_regclass('table_changes') IS NOT NULL AS present"
+
+WATERMARK_QUERY = """
+    WITH relations AS (
+        SELECT c.relname, c.oid
+        FROM pg_class c
+        WHERE c.relname = ANY(%(tables)s) AND pg_table_is_visible(c.oid)
+        UNION ALL
+        SELECT parent.relname, i.inhrelid
+        FROM pg_class parent
+        JOIN pg_inherits i ON i.inhparent = parent.oid
+        WHERE parent.relname = ANY(%(tables)s) AND pg_table_is_visible(parent.oid)
+    )
+    SELECT
+        r.relname AS relname,
+        STRING_AGG(pg_relation_filenode(r.oid)::text, ',' ORDER BY r.oid) AS filenode,
+        COALESCE(MAX(t.version), 0) AS version
+    FROM relations r
+    LEFT JOIN table_changes t ON t.relname = r.relname
+    GROUP BY r.relname
+    ORDER BY r.relname
+    """
+
+def cache_dir():
+    return os.environ.get('READMISSION_CACHE_DIR', DEFAULT_CACHE_DIR)
+
+def cache_max_bytes():
+    return int(os.environ.get('READMISSION_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+
+def cache_enabled():
+    if os.environ.get('READMISSION_CACHE', '1') == '0':
+        return False
+    if pa is None:
+        logging.warning("pyarrow is not installed; the query cache is disabled.")
+        return False
+    return True
+
+def cache_trusted():
+    # Serve existing entries without asking the database whether they are fresh
+    return os.environ.get('READMISSION_CACHE_TRUST', '0') == '1'
+
+def cache_key(query, params=None, variant=''):
+    payload = json.dumps([database_identity(), ' '.join(query.split()), params, variant], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def table_watermark(tables):
+    if not tables:
+        return []
+    if backend_name() == 'duckdb':
+        return duckdb_backend.table_watermark(tables)
+    if not execute_query(CHANGE_COUNTERS_QUERY)['present'].iloc[0]:
+        # A database from before the counters: nothing tells whether an entry is fresh
+        logging.warning("No change counters in this database (run create-tables); the query cache is bypassed.")
+        return None
+    df = execute_query(WATERMARK_QUERY, {'tables': [t.lower() for t in tables]})
+    return df.astype(str).values.tolist()
+
+def entry_paths(key):
+    base = os.path.join(cache_dir(), key)
+    return base + '.arrow', base + '.json'
+
+def read_entry(path):
+    # Memory-map the Arrow IPC file so reading does not copy it through Python buffers
+    with pa.memory_map(path) as source:
+        table = ipc.open_file(source).read_all()
+    return table.to_pandas()
+
+def write_entry(key, df, watermark):
+    data_path, meta_path = entry_paths(key)
+    os.makedirs(cache_dir(), exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    tmp_path = f"{data_path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, data_path)
+    with open(meta_path, 'w') as f:
+        json.dump({'watermark': watermark, 'created': time.time()}, f)
+
+def evict(max_bytes=None):
+    max_bytes = cache_max_bytes() if max_bytes is None else max_bytes
+    directory = cache_dir()
+    if not os.path.isdir(directory):
+        return
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith('.arrow'):
+            path = os.path.join(directory, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    # Hits touch the entry's mtime, so the oldest mtime is the least recently used
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        for stale in (path, path[:-len('.arrow')] + '.json'):
+            if os.path.exists(stale):
+                os.remove(stale)
+        total -= size
+        logging.info(f"Evicted cache entry {os.path.basename(path)}")
+
+def cached_frame(query, params, tables, compute, variant=''):
+    if not cache_enabled():
+        return compute()
+
+    key = cache_key(query, params, variant)
+    data_path, meta_path = entry_paths(key)
+    # None: the database cannot tell whether an entry is fresh, so it is neither read nor written
+    watermark = None if cache_trusted() else table_watermark(tables)
+    if watermark is None and not cache_trusted():
+        return compute()
+    try:
+        if os.path.exists(data_path) and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if cache_trusted() or meta['watermark'] == watermark:
+                start = time.perf_counter()
+                df = read_entry(data_path)
+                os.utime(data_path)
+                logging.info(f"Cache hit {key[:12]}: {len(df)} rows in {time.perf_counter() - start:.3f}s")
+                return df
+    except (OSError, ValueError, pa.ArrowException) as e:
+        logging.warning(f"Ignoring unreadable cache entry {key[:12]}: {e}")
+
+    if watermark is None:
+        watermark = table_watermark(tables)
+        if watermark is None:
+            return compute()
+    df = compute()
+    try:
+        write_entry(key, df, watermark)
+        evict()
+    except (OSError, pa.ArrowException) as e:
+        logging.warning(f"Could not write cache entry {key[:12]}: {e}")
+    return df
+
+def cached_query(query, params=None, tables=()):
+    return cached_frame(query, params, tables, lambda: execute_query(query, params))
@@ -0,0 +1,269 @@
+import logging
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+# Constants and lists
+GENDERS = [("Male", 48), ("Female", 48), ("Non-binary", 2), ("Other", 2)]
+ETHNICITIES = [("Caucasian", 60), ("African American", 13), ("Hispanic", 18), ("Asian", 6), ("Other", 3)]
+CHRONIC_CONDITIONS = ["None", "Diabetes", "Hypertension", "Heart Disease", "COPD", "Asthma", "Arthritis", "Cancer", "Depression", "Anxiety"]
+SOCIOECONOMIC_STATUS = ["Low", "Medium", "High"]
+PROGRAMS = ["Diabetes Management", "Cardiac Care", "Respiratory Health", "Mental Health Support", "Weight Management"]
+DEPARTMENTS = ["Emergency", "Internal Medicine", "Cardiology", "Pulmonology", "Oncology", "Orthopedics", "Neurology", "Psychiatry"]
+ADMISSION_REASONS = ["Chest Pain", "Shortness of Breath", "Abdominal Pain", "Fever", "Injury", "Chronic Disease Management"]
+MEDICATIONS = ["Metformin", "Lisinopril", "Atorvastatin", "Albuterol", "Sertraline", "Ibuprofen", "Omeprazole", "Gabapentin"]
+RECOMMENDATIONS = [("Yes", 70), ("No", 10), ("Maybe", 20)]
+LOW_SATISFACTION_RECOMMENDATIONS = [("Yes", 10), ("No", 60), ("Maybe", 30)]
+
+VISIT_COUNT_WEIGHTS = [40, 30, 20, 10]
+MEDICATION_COUNT_WEIGHTS = [20, 40, 30, 10]
+
+# Program assigned to an enrolled patient by condition; -1 means a random program
+CONDITION_PROGRAMS = np.array([
+    -1,  # None
+    0,   # Diabetes
+    1,   # Hypertension
+    1,   # Heart Disease
+    2,   # COPD
+    2,   # Asthma
+    -1,  # Arthritis
+    -1,  # Cancer
+    3,   # Depression
+    3,   # Anxiety
+])
+
+VISIT_START = np.datetime64('2023-01-01')
+VISIT_END = np.datetime64('2024-06-30')
+ENROLLMENT_START = np.datetime64('2024-01-01')
+ENROLLMENT_END = np.datetime64('2024-06-30')
+
+# Survey response rate as a fraction, 3/5 = 60%
+SURVEY_RATE = (3, 5)
+
+# Shard boundaries depend only on the shard size, never on the worker count,
+# so a given seed always produces the same cohort.
+DEFAULT_SHARD_SIZE = 100000
+
+TABLE_COLUMNS = {
+    'patients': ['PatientID', 'Age', 'Gender', 'Ethnicity', 'SocioeconomicStatus', 'ChronicCondition'],
+    'program_enrollment': ['PatientID', 'EnrolledInProgram', 'ProgramType', 'EnrollmentDate'],
+    'hospital_visits': ['VisitID', 'PatientID', 'AdmissionDate', 'DischargeDate', 'Department', 'AdmissionReason', 'IsReadmission'],
+    'survey_responses': ['ResponseID', 'PatientID', 'SurveyDate', 'Satisfaction', 'Recommendation', 'CareQuality', 'CommunicationRating'],
+    'medications': ['PatientID', 'Medication', 'StartDate', 'EndDate'],
+}
+
+# Order in which tables must be loaded to satisfy foreign keys
+TABLES = list(TABLE_COLUMNS)
+
+STREAMS = ['patients', 'program_enrollment', 'visit_counts', 'hospital_visits', 'survey_responses', 'medications']
+
+def probabilities(choices):
+    weights = np.array([w for c, w in choices], dtype=float)
+    return weights / weights.sum()
+
+def labels(choices):
+    return np.array([c for c, w in choices], dtype=object)
+
+def shard_streams(seed, shard_index):
+    children = np.random.SeedSequence([seed, shard_index]).spawn(len(STREAMS))
+    return {name: np.random.default_rng(child) for name, child in zip(STREAMS, children)}
+
+def random_dates(rng, start, end, size):
+    return start + rng.integers(0, (end - start).astype(int) + 1, size)
+
+def format_ids(prefix, numbers, width):
+    return prefix + pd.Series(numbers).astype(str).str.zfill(width)
+
+def segment_starts(counts):
+    return np.cumsum(counts) - counts
+
+def draw_visit_counts(rng, n):
+    return rng.choice(len(VISIT_COUNT_WEIGHTS), size=n, p=probabilities(enumerate(VISIT_COUNT_WEIGHTS)))
+
+def make_shards(num_patients, shard_size=DEFAULT_SHARD_SIZE):
+    return [
+        (index, start, min(start + shard_size, num_patients))
+        for index, start in enumerate(range(0, num_patients, shard_size))
+    ]
+
+def survey_range(start, stop):
+    numerator, denominator = SURVEY_RATE
+    return start * numerator // denominator, stop * numerator // denominator
+
+def shard_visit_total(task):
+    seed, (index, start, stop) = task
+    rng = shard_streams(seed, index)['visit_counts']
+    return int(draw_visit_counts(rng, stop - start).sum())
+
+def generate_shard(seed, shard, visit_offset):
+    index, start, stop = shard
+    n = stop - start
+    rngs = shard_streams(seed, index)
+    patient_ids = format_ids('P', np.arange(start + 1, stop + 1), 4)
+
+    # Patients
+    rng = rngs['patients']
+    age = rng.integers(18, 86, n)
+    gender = rng.choice(len(GENDERS), size=n, p=probabilities(GENDERS))
+    ethnicity = rng.choice(len(ETHNICITIES), size=n, p=probabilities(ETHNICITIES))
+    ses = rng.integers(0, len(SOCIOECONOMIC_STATUS), n)
+    # Age-appropriate chronic conditions; patients 50 and under draw from the first five only
+    condition = np.where(age > 50, rng.integers(0, len(CHRONIC_CONDITIONS), n), rng.integers(0, 5, n))
+    has_condition = condition != 0
+
+    patients = pd.DataFrame({
+        'PatientID': patient_ids,
+        'Age': age,
+        'Gender': labels(GENDERS)[gender],
+        'Ethnicity': labels(ETHNICITIES)[ethnicity],
+        'SocioeconomicStatus': np.array(SOCIOECONOMIC_STATUS, dtype=object)[ses],
+        'ChronicCondition': np.array(CHRONIC_CONDITIONS, dtype=object)[condition],
+    })
+
+    # Program enrollment
+    rng = rngs['program_enrollment']
+    enrolled = rng.random(n) < np.where(has_condition, 0.6, 0.2)
+    program = CONDITION_PROGRAMS[condition]
+    program = np.where(program >= 0, program, rng.integers(0, len(PROGRAMS), n))
+    enrollment_date = random_dates(rng, ENROLLMENT_START, ENROLLMENT_END, n)
+
+    enrollment = pd.DataFrame({
+        'PatientID': patient_ids,
+        'EnrolledInProgram': enrolled,
+        'ProgramType': np.where(enrolled, np.array(PROGRAMS, dtype=object)[program], None),
+        'EnrollmentDate': np.where(enrolled, enrollment_date, np.datetime64('NaT')),
+    })
+
+    # Hospital visits, built as chains: each admission follows the previous
+    # discharge by a 30-180 day gap, so dates are per-patient cumulative sums
+    num_visits = draw_visit_counts(rngs['visit_counts'], n)
+    rng = rngs['hospital_visits']
+    total_visits = int(num_visits.sum())
+    visit_patient = np.repeat(np.arange(n), num_visits)
+    first_visit = np.repeat(segment_starts(num_visits), num_visits)
+    is_first = np.arange(total_visits) == first_visit
+
+    los = rng.integers(1, 15, total_visits)
+    first_admission = rng.integers(0, (VISIT_END - VISIT_START).astype(int) + 1, total_visits)
+    gap = rng.integers(30, 181, total_visits)
+    step = np.where(is_first, first_admission, gap)
+    step[1:] += np.where(is_first[1:], 0, los[:-1])
+    has_visits = num_visits > 0
+    starts = segment_starts(num_visits)[has_visits]
+    offsets = np.cumsum(step)
+    offsets -= np.repeat(offsets[starts] - step[starts], num_visits[has_visits])
+    admission_date = VISIT_START + offsets
+    readmission_rate = np.where(has_condition[visit_patient], 0.2, 0.1)
+
+    visits = pd.DataFrame({
+        'VisitID': format_ids('V', np.arange(visit_offset + 1, visit_offset + total_visits + 1), 5),
+        'PatientID': patient_ids.to_numpy()[visit_patient],
+        'AdmissionDate': admission_date,
+        'DischargeDate': admission_date + los,
+        'Department': np.array(DEPARTMENTS, dtype=object)[rng.integers(0, len(DEPARTMENTS), total_visits)],
+        'AdmissionReason': np.array(ADMISSION_REASONS, dtype=object)[rng.integers(0, len(ADMISSION_REASONS), total_visits)],
+        'IsReadmission': rng.random(total_visits) < readmission_rate,
+    })
+
+    # Survey responses, sampled from this shard's patients
+    rng = rngs['survey_responses']
+    survey_start, survey_stop = survey_range(start, stop)
+    m = survey_stop - survey_start
+    respondent = rng.integers(0, n, m)
+    satisfaction = rng.integers(1, 11, m)
+    adjusted = np.clip(satisfaction + rng.integers(-2, 3, m), 1, 10)
+    satisfaction = np.where(num_visits[respondent] > 0, adjusted, satisfaction)  # Adjust based on visit history
+    u = rng.random(m)
+    recommendation = np.where(
+        satisfaction < 5,
+        np.searchsorted(np.cumsum(probabilities(LOW_SATISFACTION_RECOMMENDATIONS)), u, side='right'),
+        np.searchsorted(np.cumsum(probabilities(RECOMMENDATIONS)), u, side='right')
+    )
+    recommendation = np.minimum(recommendation, len(RECOMMENDATIONS) - 1)
+
+    surveys = pd.DataFrame({
+        'ResponseID': format_ids('R', np.arange(survey_start + 1, survey_stop + 1), 4),
+        'PatientID': patient_ids.to_numpy()[respondent],
+        'SurveyDate': random_dates(rng, ENROLLMENT_START, ENROLLMENT_END, m),
+        'Satisfaction': satisfaction,
+        'Recommendation': labels(RECOMMENDATIONS)[recommendation],
+        'CareQuality': rng.integers(1, 11, m),
+        'CommunicationRating': rng.integers(1, 11, m),
+    })
+
+    # Medications; patients with a chronic condition take at least one
+    rng = rngs['medications']
+    num_medications = rng.choice(len(MEDICATION_COUNT_WEIGHTS), size=n, p=probabilities(enumerate(MEDICATION_COUNT_WEIGHTS)))
+    num_medications = np.where(has_condition, np.maximum(num_medications, 1), num_medications)
+    total_medications = int(num_medications.sum())
+    start_date = random_dates(rng, ENROLLMENT_START, ENROLLMENT_END, total_medications)
+    end_date = start_date + rng.integers(30, 366, total_medications)
+    has_end = rng.random(total_medications) < 0.3
+
+    medications = pd.DataFrame({
+        'PatientID': np.repeat(patient_ids.to_numpy(), num_medications),
+        'Medication': np.array(MEDICATIONS, dtype=object)[rng.integers(0, len(MEDICATIONS), total_medications)],
+        'StartDate': start_date,
+        'EndDate': np.where(has_end, end_date, np.datetime64('NaT')),
+    })
+
+    return {
+        'patients': patients,
+        'program_enrollment': enrollment,
+        'hospital_visits': visits,
+        'survey_responses': surveys,
+        'medications': medications,
+    }
+
+def generate_shard_csv(task):
+    seed, shard, visit_offset = task
+    frames = generate_shard(seed, shard, visit_offset)
+    return {
+        table: (frame[TABLE_COLUMNS[table]].to_csv(index=False, header=False, date_format='%Y-%m-%d'), len(frame))
+        for table, frame in frames.items()
+    }
+
+def resolve_seed(seed=None):
+    if seed is None:
+        return int(np.random.SeedSequence().entropy % (2 ** 63))
+    return seed
+
+def run_tasks(function, tasks, workers):
+    if workers <= 1:
+        yield from map(function, tasks)
+        return
+    pool = Pool(workers)
+    try:
+        for result in pool.imap(function, tasks):
+            yield result
+    finally:
+        pool.terminate()
+
+def generate_cohort(num_patients, spool_dir, seed=None, workers=None, shard_size=DEFAULT_SHARD_SIZE):
+    seed = resolve_seed(seed)
+    workers = workers or os.cpu_count() or 1
+    shards = make_shards(num_patients, shard_size)
+    logging.info(f"Generating {num_patients} patients in {len(shards)} shards with {workers} workers (seed={seed})")
+
+    # Visit counts come from their own random stream, so the VisitID offset
+    # of every shard is known before any shard is generated in full
+    visit_totals = list(run_tasks(shard_visit_total, [(seed, shard) for shard in shards], workers))
+    visit_offsets = np.cumsum([0] + visit_totals[:-1])
+
+    paths = {table: os.path.join(spool_dir, f"{table}.csv") for table in TABLES}
+    row_counts = dict.fromkeys(TABLES, 0)
+    files = {table: open(path, 'w', newline='') for table, path in paths.items()}
+    try:
+        tasks = [(seed, shard, int(offset)) for shard, offset in zip(shards, visit_offsets)]
+        for shard_csv in run_tasks(generate_shard_csv, tasks, workers):
+            for table, (text, count) in shard_csv.items():
+                files[table].write(text)
+                row_counts[table] += count
+    finally:
+        for f in files.values():
+            f.close()
+
+    logging.info(f"Generated rows: {row_counts}")
+    return {'seed': seed, 'paths': paths, 'rows': row_counts}
@@ -1,11 +1,140 @@
-import psycopg2
-from psycopg2 import sql
-from database_utils import get_db_connection
+import argparse
+from datetime import date
+from database_utils import backend_name, get_db_connection
+from data_loading import PATIENT_OUTCOMES_QUERY, PATIENT_OUTCOMES_VERSION, PATIENT_OUTCOMES_VERSION_QUERIES
+from stats_store import SURVEY_SEQUENCE, VISIT_SEQUENCE
 
-def create_tables():
-    conn = get_db_connection()
+# Indexes backing the per-patient joins and aggregates in load_data
+INDEXES = [
+    """CREATE INDEX IF NOT EXISTS idx_hospital_visits_patient_admission
+       ON hospital_visits (PatientID, AdmissionDate) INCLUDE (DischargeDate, IsReadmission)""",
+    """CREATE INDEX IF NOT EXISTS idx_program_enrollment_patient
+       ON program_enrollment (PatientID) INCLUDE (EnrolledInProgram)""",
+    """CREATE INDEX IF NOT EXISTS idx_program_enrollment_enrolled
+       ON program_enrollment (EnrolledInProgram)""",
+    """CREATE INDEX IF NOT EXISTS idx_survey_responses_patient
+       ON survey_responses (PatientID) INCLUDE (Satisfaction)""",
+    """CREATE INDEX IF NOT EXISTS idx_medications_patient
+       ON medications (PatientID)""",
+    # Row-ID watermarks of the incremental statistics store
+    f"""CREATE INDEX IF NOT EXISTS idx_hospital_visits_sequence
+       ON hospital_visits (({VISIT_SEQUENCE}))""",
+    f"""CREATE INDEX IF NOT EXISTS idx_survey_responses_sequence
+       ON survey_responses (({SURVEY_SEQUENCE}))""",
+]
+
+# Change counters behind the query cache's freshness check on Postgres. A
+# statement-level trigger bumps the table's counter in the writing transaction,
+# so the new value is visible exactly when the write commits. A COPY or a bulk
+# INSERT bumps it once. Reading the counters needs no table scan.
+CHANGE_TRACKED_TABLES = ['patients', 'program_enrollment', 'hospital_visits', 'survey_responses', 'medications']
+
+CHANGE_COUNTER_STATEMENTS = [
+    """CREATE TABLE IF NOT EXISTS table_changes (
+       relname TEXT PRIMARY KEY,
+       version BIGINT NOT NULL
+    )""",
+    """CREATE OR REPLACE FUNCTION bump_table_change() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO table_changes (relname, version) VALUES (lower(TG_TABLE_NAME), 1)
+        ON CONFLICT (relname) DO UPDATE SET version = table_changes.version + 1;
+        RETURN NULL;
+    END
+    $$""",
+] + [
+    f"""CREATE OR REPLACE TRIGGER {table}_changes
+       AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+       FOR EACH STATEMENT EXECUTE FUNCTION bump_table_change()"""
+    for table in CHANGE_TRACKED_TABLES
+]
+
+def bump_change_counter(cur, table):
+    # For writes no trigger sees, e.g. materialized view refreshes
+    cur.execute("""
+        INSERT INTO table_changes (relname, version) VALUES (%s, 1)
+        ON CONFLICT (relname) DO UPDATE SET version = table_changes.version + 1
+    """, (table,))
+
+# Monthly range partitions on Postgres; new months get their partition when
+# rows for them are loaded, see bulk_loader. DuckDB has no table partitioning
+# and prunes row groups by their min/max zone maps instead.
+PARTITION_KEYS = {
+    'hospital_visits': 'AdmissionDate',
+    'survey_responses': 'SurveyDate',
+}
+
+def is_partitioned(table):
+    return backend_name() == 'postgres' and table in PARTITION_KEYS
+
+def primary_key(table, column):
+    # Every unique constraint of a partitioned table must include its partition key
+    if is_partitioned(table):
+        return f"PRIMARY KEY ({column}, {PARTITION_KEYS[table]})"
+    return f"PRIMARY KEY ({column})"
+
+def partition_clause(table):
+    return f" PARTITION BY RANGE ({PARTITION_KEYS[table]})" if is_partitioned(table) else ""
+
+def create_default_partition(cur, table):
+    # Holds the rows of months that have no partition yet
+    if is_partitioned(table):
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT;")
 
-    with conn.cursor() as cur:
+def next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def partition_name(table, month):
+    return f"{table}_y{month.year}m{month.month:02d}"
+
+def existing_partitions(cur, table):
+    # None when the table is not partitioned, e.g. created before partitioning
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    if row is None or row[0] != 'p':
+        return None
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    """, (table,))
+    return {name for name, in cur.fetchall()}
+
+def create_month_partitions(cur, table, months, existing=None):
+    # months: first days of the months to cover. Returns the updated set of partition names.
+    existing = existing_partitions(cur, table) if existing is None else existing
+    if existing is None:
+        return None
+    key = PARTITION_KEYS[table]
+    for month in sorted(months):
+        name = partition_name(table, month)
+        if name in existing:
+            continue
+        bounds = f"FROM ('{month.isoformat()}') TO ('{next_month(month).isoformat()}')"
+        condition = f"{key} >= '{month.isoformat()}' AND {key} < '{next_month(month).isoformat()}'"
+        cur.execute(f"SELECT 1 FROM {table}_default WHERE {condition} LIMIT 1")
+        if cur.fetchone() is None:
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES {bounds};")
+        else:
+            # The month already has rows in the default partition, which would
+            # clash with the new bounds: move them into the partition first
+            cur.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);")
+            cur.execute(f"INSERT INTO {name} SELECT * FROM {table}_default WHERE {condition};")
+            cur.execute(f"DELETE FROM {table}_default WHERE {condition};")
+            cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES {bounds};")
+        existing.add(name)
+    return existing
+
+def id_column(cur, table, column):
+    # DuckDB has no SERIAL; a sequence default does the same job
+    if backend_name() == 'duckdb':
+        sequence = f"{table}_{column.lower()}_seq"
+        cur.execute(f"CREATE SEQUENCE IF NOT EXISTS {sequence};")
+        return f"{column} INTEGER DEFAULT nextval('{sequence}') PRIMARY KEY"
+    return f"{column} SERIAL PRIMARY KEY"
+
+def create_tables():
+    with get_db_connection() as conn, conn.cursor() as cur:
         # Create Patients table
         cur.execute("""
         CREATE TABLE IF NOT EXISTS patients (
@@ -20,9 +149,9 @@ def create_tables():
         print("Patients table created successfully")
 
         # Create Program Enrollment table
-        cur.execute("""
+        cur.execute(f"""
         CREATE TABLE IF NOT EXISTS program_enrollment (
-            EnrollmentID SERIAL PRIMARY KEY,
+            {id_column(cur, 'program_enrollment', 'EnrollmentID')},
             PatientID VARCHAR(50) REFERENCES patients(PatientID),
             EnrolledInProgram BOOLEAN,
             ProgramType VARCHAR(150),
@@ -31,38 +160,42 @@ def create_tables():
         """)
         print("Program Enrollment table created successfully")
 
-        # Create Hospital Visits table
-        cur.execute("""
+        # Create Hospital Visits table, partitioned by admission month
+        cur.execute(f"""
         CREATE TABLE IF NOT EXISTS hospital_visits (
-            VisitID VARCHAR(6) PRIMARY KEY,
+            VisitID VARCHAR(50),
             PatientID VARCHAR(50) REFERENCES patients(PatientID),
             AdmissionDate DATE,
             DischargeDate DATE,
             Department VARCHAR(80),
             AdmissionReason VARCHAR(150),
-            IsReadmission BOOLEAN
-        );
+            IsReadmission BOOLEAN,
+            {primary_key('hospital_visits', 'VisitID')}
+        ){partition_clause('hospital_visits')};
         """)
+        create_default_partition(cur, 'hospital_visits')
         print("Hospital Visits table created successfully")
 
-        # Create Survey Responses table
-        cur.execute("""
+        # Create Survey Responses table, partitioned by survey month
+        cur.execute(f"""
         CREATE TABLE IF NOT EXISTS survey_responses (
-            ResponseID VARCHAR(50) PRIMARY KEY,
+            ResponseID VARCHAR(50),
             PatientID VARCHAR(50) REFERENCES patients(PatientID),
             SurveyDate DATE,
             Satisfaction INTEGER,
             Recommendation VARCHAR(150),
             CareQuality INTEGER,
-            CommunicationRating INTEGER
-        );
+            CommunicationRating INTEGER,
+            {primary_key('survey_responses', 'ResponseID')}
+        ){partition_clause('survey_responses')};
         """)
+        create_default_partition(cur, 'survey_responses')
         print("Survey Responses table created successfully")
 
         # Create Medications table
-        cur.execute("""
+        cur.execute(f"""
         CREATE TABLE IF NOT EXISTS medications (
-            MedicationID SERIAL PRIMARY KEY,
+            {id_column(cur, 'medications', 'MedicationID')},
             PatientID VARCHAR(50) REFERENCES patients(PatientID),
             Medication VARCHAR(150),
             StartDate DATE,
@@ -71,9 +204,109 @@ def create_tables():
         """)
         print("Medications table created successfully")
 
-    conn.commit()
-    conn.close()
+        # DuckDB scans columns with zone maps; these B-tree style indexes would only slow its loads
+        if backend_name() == 'postgres':
+            for statement in INDEXES:
+                cur.execute(statement)
+            print("Indexes created successfully")
+            for statement in CHANGE_COUNTER_STATEMENTS:
+                cur.execute(statement)
+            print("Change counters created successfully")
+
+        create_patient_outcomes_view(cur)
+
     print("All tables created successfully")
 
+def patient_outcomes_version(cur):
+    # (exists, version stamp) of the patient_outcomes view
+    cur.execute(PATIENT_OUTCOMES_VERSION_QUERIES[backend_name()])
+    return cur.fetchone()
+
+def stamp_patient_outcomes(cur):
+    kind = 'TABLE' if backend_name() == 'duckdb' else 'MATERIALIZED VIEW'
+    cur.execute(f"COMMENT ON {kind} patient_outcomes IS '{PATIENT_OUTCOMES_VERSION}';")
+
+def drop_patient_outcomes(cur):
+    if backend_name() == 'duckdb':
+        cur.execute("DROP TABLE IF EXISTS patient_outcomes;")
+    else:
+        cur.execute("DROP MATERIALIZED VIEW IF EXISTS patient_outcomes;")
+
+def create_patient_outcomes_view(cur):
+    # IF NOT EXISTS would keep a view built from an older query, so one with
+    # another version stamp is dropped and rebuilt
+    present, version = patient_outcomes_version(cur)
+    if present and version != PATIENT_OUTCOMES_VERSION:
+        print(f"Patient Outcomes was built from another version of the query ({version}); rebuilding it")
+        drop_patient_outcomes(cur)
+
+    if backend_name() == 'duckdb':
+        # No materialized views in DuckDB; a table built from the same query stands in
+        cur.execute(f"CREATE TABLE IF NOT EXISTS patient_outcomes AS {PATIENT_OUTCOMES_QUERY};")
+        stamp_patient_outcomes(cur)
+        print("Patient Outcomes table created successfully")
+        return
+
+    # Create Patient Outcomes materialized view, holding the load_data result.
+    # The unique index is required for REFRESH ... CONCURRENTLY.
+    cur.execute(f"""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS patient_outcomes AS
+    {PATIENT_OUTCOMES_QUERY};
+    """)
+    cur.execute("""
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_patient_outcomes_patient
+    ON patient_outcomes ("PatientID");
+    """)
+    stamp_patient_outcomes(cur)
+    bump_change_counter(cur, 'patient_outcomes')
+    print("Patient Outcomes materialized view created successfully")
+
+def rebuild_patient_outcomes():
+    # Needed whenever the load_data columns change; a refresh keeps the old definition
+    with get_db_connection() as conn, conn.cursor() as cur:
+        drop_patient_outcomes(cur)
+        create_patient_outcomes_view(cur)
+
+def refresh_patient_outcomes(concurrently=True):
+    with get_db_connection() as conn, conn.cursor() as cur:
+        # CONCURRENTLY keeps the view readable while it refreshes
+        if backend_name() == 'duckdb':
+            # Replaced and stamped in one transaction, so readers never see it half built
+            cur.execute("BEGIN TRANSACTION;")
+            cur.execute(f"CREATE OR REPLACE TABLE patient_outcomes AS {PATIENT_OUTCOMES_QUERY};")
+            stamp_patient_outcomes(cur)
+            cur.execute("COMMIT;")
+        elif patient_outcomes_version(cur)[1] != PATIENT_OUTCOMES_VERSION:
+            # A refresh would rerun the old definition
+            print("Patient Outcomes was built from another version of the query; rebuilding it")
+            drop_patient_outcomes(cur)
+            create_patient_outcomes_view(cur)
+            return
+        elif concurrently:
+            cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY patient_outcomes;")
+            bump_change_counter(cur, 'patient_outcomes')
+        else:
+            cur.execute("REFRESH MATERIALIZED VIEW patient_outcomes;")
+            bump_change_counter(cur, 'patient_outcomes')
+
+    print("Patient Outcomes materialized view refreshed successfully")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create the database schema.")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Refresh the patient_outcomes materialized view instead of creating tables")
+    parser.add_argument('--blocking', action='store_true',
+                        help="Refresh without CONCURRENTLY (faster, but locks out readers)")
+    parser.add_argument('--rebuild-view', action='store_true',
+                        help="Drop and recreate the patient_outcomes materialized view")
+    args = parser.parse_args(argv)
+
+    if args.rebuild_view:
+        rebuild_patient_outcomes()
+    elif args.refresh:
+        refresh_patient_outcomes(concurrently=not args.blocking)
+    else:
+        create_tables()
+
 if __name__ == "__main__":
-    create_tables()
\ No newline at end of file
+    main()
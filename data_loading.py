@@ -1,8 +1,156 @@
-from database_utils import execute_query
+from cache import cache_trusted, cached_frame, cached_query
+from database_utils import DEFAULT_CHUNKSIZE, backend_name, close_pool, execute_query, explain_query, iter_query_chunks
+from episodes import VISITS_TEMPLATE, WINDOWS, attach_episodes, episodes_from_chunks, episodes_from_frame
+from tracing import traced
+import argparse
+import hashlib
 import logging
+import resource
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+import numpy as np
+import pandas as pd
 
-def load_data():
-    query = """
+# Each child table is aggregated per patient before the join, so patients
+# never fan out into visits x surveys rows. Aliases are quoted to keep their case.
+# The filters restrict visits and surveys to an analysis window, see window_filter.
+# The gaps to the previous discharge are computed over a look-back range before
+# the window, so a readmission whose index stay ended before the window starts
+# still counts; only admissions inside the window are then kept.
+PATIENT_OUTCOMES_TEMPLATE = """
+    WITH enrollment AS (
+        SELECT
+            PatientID,
+            BOOL_OR(EnrolledInProgram) AS EnrolledInProgram,
+            MAX(ProgramType) AS ProgramType
+        FROM program_enrollment
+        GROUP BY PatientID
+    ),
+    visit_gaps AS (
+        SELECT
+            PatientID,
+            AdmissionDate,
+            IsReadmission,
+            ROW_NUMBER() OVER patient_visits > 1 AS HasPreviousVisit,
+            AdmissionDate - LAG(DischargeDate) OVER patient_visits AS GapDays
+        FROM hospital_visits{lookback_filter}
+        WINDOW patient_visits AS (PARTITION BY PatientID ORDER BY AdmissionDate)
+    ),
+    visit_stats AS (
+        SELECT
+            PatientID,
+            BOOL_OR(HasPreviousVisit) AS Readmitted,
+            MIN(CASE WHEN IsReadmission THEN GapDays END) AS DaysToReadmission
+        FROM visit_gaps{visit_filter}
+        GROUP BY PatientID
+    ),
+    survey_stats AS (
+        SELECT
+            PatientID,
+            AVG(Satisfaction)::float8 AS Satisfaction,
+            AVG(CareQuality)::float8 AS CareQuality,
+            AVG(CommunicationRating)::float8 AS CommunicationRating,
+            AVG(CASE WHEN Recommendation = 'Yes' THEN 1 ELSE 0 END)::float8 AS WouldRecommend
+        FROM survey_responses{survey_filter}
+        GROUP BY PatientID
+    )
+    SELECT
+        p.PatientID AS "PatientID",
+        p.Age AS "Age",
+        p.Gender AS "Gender",
+        p.Ethnicity AS "Ethnicity",
+        p.ChronicCondition AS "ChronicCondition",
+        p.SocioeconomicStatus AS "SocioeconomicStatus",
+        e.EnrolledInProgram AS "EnrolledInProgram",
+        e.ProgramType AS "ProgramType",
+        COALESCE(vs.Readmitted, FALSE) AS "IsReadmission",
+        ss.Satisfaction AS "Satisfaction",
+        ss.CareQuality AS "CareQuality",
+        ss.CommunicationRating AS "CommunicationRating",
+        ss.WouldRecommend AS "WouldRecommend",
+        vs.DaysToReadmission AS "DaysToReadmission"
+    FROM
+        patients p
+    LEFT JOIN
+        enrollment e ON p.PatientID = e.PatientID
+    LEFT JOIN
+        visit_stats vs ON p.PatientID = vs.PatientID
+    LEFT JOIN
+        survey_stats ss ON p.PatientID = ss.PatientID
+    """
+
+PATIENT_OUTCOMES_QUERY = PATIENT_OUTCOMES_TEMPLATE.format(lookback_filter='', visit_filter='', survey_filter='')
+
+PATIENT_OUTCOMES_VIEW_QUERY = "SELECT * FROM patient_outcomes"
+
+# create_tables stamps the view with a hash of the query it was built from
+# (as its comment). A view built before the query gained columns is then
+# rejected instead of silently returning the old columns.
+PATIENT_OUTCOMES_VERSION = hashlib.sha256(' '.join(PATIENT_OUTCOMES_QUERY.split()).encode()).hexdigest()[:16]
+PATIENT_OUTCOMES_VERSION_QUERIES = {
+    'postgres': """
+        SELECT
+            to_regclass('patient_outcomes') IS NOT NULL AS present,
+            obj_description(to_regclass('patient_outcomes'), 'pg_class') AS version
+        """,
+    # A table in a DuckDB file; a view over patient_outcomes.parquet in a
+    # snapshot, stamped from the file written next to it
+    'duckdb': """
+        SELECT COUNT(*) > 0 AS present, MAX(comment) AS version
+        FROM (
+            SELECT table_name AS name, comment FROM duckdb_tables()
+            UNION ALL
+            SELECT view_name AS name, comment FROM duckdb_views()
+        ) relations
+        WHERE name = 'patient_outcomes'
+        """,
+}
+
+# Tables whose changes invalidate cached load_data results
+PATIENT_OUTCOMES_TABLES = ['patients', 'program_enrollment', 'hospital_visits', 'survey_responses']
+PATIENT_OUTCOMES_VIEW_TABLES = ['patient_outcomes']
+
+# Per-arm sufficient statistics of the load_data columns: overall and per
+# ChronicCondition. Everything analyze_results_from_stats needs, in a few rows.
+ARM_STATISTICS_QUERY = """
+    WITH outcomes AS ({source})
+    SELECT
+        "EnrolledInProgram",
+        "ChronicCondition",
+        GROUPING("ChronicCondition") = 0 AS is_subgroup,
+        COUNT(*) AS n,
+        COUNT(*) FILTER (WHERE "IsReadmission") AS readmissions,
+        COUNT("Satisfaction") AS satisfaction_n,
+        SUM("Satisfaction")::float8 AS satisfaction_sum,
+        SUM("Satisfaction" * "Satisfaction")::float8 AS satisfaction_sumsq,
+        COUNT("DaysToReadmission") AS days_n,
+        SUM("DaysToReadmission")::float8 AS days_sum,
+        SUM("DaysToReadmission"::float8 * "DaysToReadmission")::float8 AS days_sumsq
+    FROM outcomes
+    WHERE "EnrolledInProgram" IS NOT NULL
+    GROUP BY GROUPING SETS (("EnrolledInProgram"), ("EnrolledInProgram", "ChronicCondition"))
+    """
+
+# Counts behind the age and gender distribution plots
+AGE_BINS_QUERY = """
+    WITH outcomes AS ({source})
+    SELECT "Age", "EnrolledInProgram", COUNT(*) AS "Count"
+    FROM outcomes
+    GROUP BY "Age", "EnrolledInProgram"
+    ORDER BY "Age", "EnrolledInProgram"
+    """
+
+GENDER_COUNTS_QUERY = """
+    WITH outcomes AS ({source})
+    SELECT "Gender", "EnrolledInProgram", COUNT(*) AS "Count"
+    FROM outcomes
+    GROUP BY "Gender", "EnrolledInProgram"
+    ORDER BY "Gender", "EnrolledInProgram"
+    """
+
+# The original query: joins every child table straight onto patients and nests
+# LAG inside MIN. Kept only as the baseline for compare_feature_queries.
+LEGACY_PATIENT_OUTCOMES_QUERY = """
     SELECT 
         p.PatientID,
         p.Age,
@@ -25,11 +173,366 @@ def load_data():
     GROUP BY 
         p.PatientID, pe.EnrolledInProgram
     """
+
+# The legacy join without the nested window, which Postgres rejects; this is
+# the part of the old plan that fans out
+LEGACY_FANOUT_QUERY = """
+    SELECT
+        p.PatientID,
+        pe.EnrolledInProgram,
+        COUNT(hv.VisitID) AS VisitCount,
+        AVG(sr.Satisfaction) AS Satisfaction
+    FROM
+        patients p
+    LEFT JOIN
+        program_enrollment pe ON p.PatientID = pe.PatientID
+    LEFT JOIN
+        hospital_visits hv ON p.PatientID = hv.PatientID
+    LEFT JOIN
+        survey_responses sr ON p.PatientID = sr.PatientID
+    GROUP BY
+        p.PatientID, pe.EnrolledInProgram
+    """
+
+# Visits before the intervention period: the CUPED covariate in adjusted.py
+PRIOR_VISITS_QUERY = """
+    SELECT PatientID AS "PatientID", COUNT(*) AS "PriorVisits"
+    FROM hospital_visits
+    WHERE AdmissionDate < %(period_end)s
+    GROUP BY PatientID
+    """
+
+# Enrollment opens on this date in populate_db.py
+DEFAULT_PRIOR_PERIOD_END = date(2024, 1, 1)
+
+# How far before an analysis window visits are read to find each admission's
+# previous stay: the longest episode window (90 days) plus the stay itself,
+# and the 30-180 day gaps of the generated data, with room to spare
+LOOKBACK_DAYS = 365
+
+# Compact dtypes for the patient-level frame; the string columns are low-cardinality
+CATEGORICAL_COLUMNS = ['Gender', 'Ethnicity', 'ChronicCondition', 'SocioeconomicStatus', 'ProgramType']
+BOOLEAN_COLUMNS = ['EnrolledInProgram', 'IsReadmission']
+COMPACT_DTYPES = {
+    'Age': 'int8',
+    'Satisfaction': 'float32',
+    'CareQuality': 'float32',
+    'CommunicationRating': 'float32',
+    'WouldRecommend': 'float32',
+    'DaysToReadmission': 'float32',
+}
+
+def compact_frame(df):
+    df = df.copy()
+    for column in CATEGORICAL_COLUMNS:
+        if column in df:
+            df[column] = df[column].astype('category')
+    for column in BOOLEAN_COLUMNS:
+        if column in df:
+            df[column] = df[column].fillna(False).astype(bool)
+    for column, dtype in COMPACT_DTYPES.items():
+        if column in df:
+            df[column] = pd.to_numeric(df[column]).astype(dtype)
+    return df
+
+def concat_compact(chunks):
+    chunks = list(chunks)
+    if not chunks:
+        return pd.DataFrame()
+    # Chunks carry different category sets; unify them so concat keeps categoricals
+    for column in CATEGORICAL_COLUMNS:
+        if column in chunks[0]:
+            categories = pd.api.types.union_categoricals([chunk[column] for chunk in chunks]).categories
+            for chunk in chunks:
+                chunk[column] = chunk[column].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+def window_filter(column, start=None, end=None, lookback_days=0):
+    # [start - lookback_days, end) on a date column. The bounds are parameters
+    # (and a constant offset) compared with the partition key, so Postgres
+    # prunes the monthly partitions.
+    conditions = []
+    if start is not None and lookback_days:
+        conditions.append(f"{column} >= CAST(%(start)s AS DATE) - {int(lookback_days)}")
+    elif start is not None:
+        conditions.append(f"{column} >= %(start)s")
+    if end is not None:
+        conditions.append(f"{column} < %(end)s")
+    return f" WHERE {' AND '.join(conditions)}" if conditions else ''
+
+def window_params(start=None, end=None):
+    params = {name: value for name, value in [('start', start), ('end', end)] if value is not None}
+    return params or None
+
+def check_patient_outcomes_view():
+    row = execute_query(PATIENT_OUTCOMES_VERSION_QUERIES[backend_name()]).iloc[0]
+    if not row['present']:
+        raise ValueError("The patient_outcomes view does not exist; run create-tables first")
+    if row['version'] != PATIENT_OUTCOMES_VERSION:
+        raise ValueError(f"The patient_outcomes view was built from another version of the outcome query "
+                         f"({row['version']}, expected {PATIENT_OUTCOMES_VERSION}); rebuild it with "
+                         f"'python create_tables.py --rebuild-view', or take a new Parquet snapshot")
+
+def outcomes_query(from_view=False, start=None, end=None):
+    # The materialized view is refreshed by create_tables.refresh_patient_outcomes
+    if from_view:
+        if start is not None or end is not None:
+            raise ValueError("The patient_outcomes view covers all history; an analysis window needs the base tables")
+        # A trusted cache is served without asking the database anything
+        if not cache_trusted():
+            check_patient_outcomes_view()
+        return PATIENT_OUTCOMES_VIEW_QUERY
+    return PATIENT_OUTCOMES_TEMPLATE.format(
+        lookback_filter=window_filter('AdmissionDate', start, end, LOOKBACK_DAYS),
+        visit_filter=window_filter('AdmissionDate', start),
+        survey_filter=window_filter('SurveyDate', start, end),
+    )
+
+def iter_data_chunks(chunksize=DEFAULT_CHUNKSIZE, from_view=False, start=None, end=None):
+    query = outcomes_query(from_view, start, end)
+    for chunk in iter_query_chunks(query, window_params(start, end), chunksize=chunksize):
+        yield compact_frame(chunk)
+
+@traced()
+def load_data(stream=False, chunksize=DEFAULT_CHUNKSIZE, from_view=False, use_cache=True, readmission_window=None,
+              prior_period_end=None, start=None, end=None, study_end=None):
+    # readmission_window (30, 60 or 90) swaps the SQL readmission columns for
+    # episodes computed from the raw visits, see episodes.py. prior_period_end
+    # adds PriorVisits, the visits admitted before that date. start/end limit
+    # the visits and surveys to admissions and surveys in [start, end); every
+    # patient is still returned. study_end adds the censored time-to-readmission
+    # columns of survival.py.
     try:
-        df = execute_query(query)
+        query = outcomes_query(from_view, start, end)
+        params = window_params(start, end)
+        tables = outcomes_tables(from_view)
+        if stream:
+            compute = lambda: concat_compact(iter_data_chunks(chunksize, from_view, start, end))
+        else:
+            compute = lambda: execute_query(query, params)
+        if use_cache:
+            # Streamed frames have compact dtypes, so they are cached separately
+            df = cached_frame(query, params, tables, compute, variant='stream' if stream else '')
+        else:
+            df = compute()
         if df.empty:
             logging.warning("The query returned an empty dataset.")
+        if readmission_window is not None:
+            episodes = load_visit_episodes(stream, chunksize, use_cache, start=start, end=end)
+            df = attach_episodes(df, episodes, readmission_window)
+        if prior_period_end is not None:
+            df = attach_prior_visits(df, load_prior_visits(prior_period_end, use_cache))
+        if study_end is not None:
+            from survival import attach_survival
+            df = attach_survival(df, load_survival(study_end, stream, chunksize, use_cache, start, end))
         return df
     except Exception as e:
         logging.error(f"Error fetching data: {e}")
-        raise
\ No newline at end of file
+        raise
+
+@traced()
+def load_visit_episodes(stream=False, chunksize=DEFAULT_CHUNKSIZE, use_cache=True, windows=WINDOWS, start=None,
+                        end=None):
+    # Streaming keeps only one chunk of visits in memory; the per-patient
+    # episodes are all that is kept (and cached). Visits in the look-back
+    # range only provide the previous discharge of the first visits in the window.
+    query = visits_query(start, end, LOOKBACK_DAYS)
+    params = window_params(start, end)
+    if stream:
+        compute = lambda: episodes_from_chunks(iter_query_chunks(query, params, chunksize=chunksize), windows, start)
+    else:
+        compute = lambda: episodes_from_frame(execute_query(query, params), windows, start)
+    try:
+        if use_cache:
+            return cached_frame(query, params, ['hospital_visits'], compute,
+                                variant=f"episodes:{','.join(map(str, windows))}")
+        return compute()
+    except Exception as e:
+        logging.error(f"Error computing visit episodes: {e}")
+        raise
+
+@traced()
+def load_survival(study_end, stream=False, chunksize=DEFAULT_CHUNKSIZE, use_cache=True, start=None, end=None):
+    # Per-patient follow-up days and readmission event, from the same ordered
+    # visits as the episodes. Admissions from `end` on are never read, so
+    # follow-up is censored at whichever of study_end and end comes first.
+    # survival.py pulls in scipy.stats, so it is imported only when needed.
+    from survival import survival_from_chunks, survival_from_frame
+
+    if end is not None and end < study_end:
+        logging.info(f"Censoring follow-up at the window end {end} instead of {study_end}")
+        study_end = end
+    query = visits_query(start, end)
+    params = window_params(start, end)
+    if stream:
+        compute = lambda: survival_from_chunks(iter_query_chunks(query, params, chunksize=chunksize), study_end)
+    else:
+        compute = lambda: survival_from_frame(execute_query(query, params), study_end)
+    try:
+        if use_cache:
+            return cached_frame(query, params, ['hospital_visits'], compute, variant=f"survival:{study_end}")
+        return compute()
+    except Exception as e:
+        logging.error(f"Error computing time to readmission: {e}")
+        raise
+
+@traced()
+def load_prior_visits(period_end=DEFAULT_PRIOR_PERIOD_END, use_cache=True):
+    params = {'period_end': period_end}
+    try:
+        if use_cache:
+            return cached_query(PRIOR_VISITS_QUERY, params, tables=['hospital_visits'])
+        return execute_query(PRIOR_VISITS_QUERY, params)
+    except Exception as e:
+        logging.error(f"Error fetching prior visits: {e}")
+        raise
+
+def attach_prior_visits(df, prior_visits):
+    df = df.merge(prior_visits, on='PatientID', how='left')
+    df['PriorVisits'] = df['PriorVisits'].fillna(0).astype(np.int32)
+    return df
+
+def visits_query(start=None, end=None, lookback_days=0):
+    return VISITS_TEMPLATE.format(visit_filter=window_filter('AdmissionDate', start, end, lookback_days))
+
+def outcomes_tables(from_view=False):
+    return PATIENT_OUTCOMES_VIEW_TABLES if from_view else PATIENT_OUTCOMES_TABLES
+
+def run_aggregate_query(template, from_view=False, use_cache=True, start=None, end=None):
+    query = template.format(source=outcomes_query(from_view, start, end))
+    params = window_params(start, end)
+    if use_cache:
+        return cached_query(query, params, tables=outcomes_tables(from_view))
+    return execute_query(query, params)
+
+@traced()
+def load_arm_statistics(from_view=False, use_cache=True, start=None, end=None):
+    try:
+        stats = run_aggregate_query(ARM_STATISTICS_QUERY, from_view, use_cache, start, end)
+        if stats.empty:
+            logging.warning("The arm statistics query returned an empty dataset.")
+        return stats
+    except Exception as e:
+        logging.error(f"Error fetching arm statistics: {e}")
+        raise
+
+def add_months(day, months):
+    return (pd.Timestamp(day) + pd.DateOffset(months=months)).date()
+
+def rolling_windows(start, end, months=3, step=1):
+    # [start, start + months), moved on by `step` months until it passes end
+    window_start = start
+    while add_months(window_start, months) <= end:
+        yield window_start, add_months(window_start, months)
+        window_start = add_months(window_start, step)
+
+@traced()
+def load_rolling_arm_statistics(start, end, months=3, step=1, use_cache=True):
+    # One pushed-down arm statistics query per window; on Postgres each reads
+    # only the partitions of its months
+    try:
+        frames = [
+            load_arm_statistics(False, use_cache, window_start, window_end).assign(
+                WindowStart=window_start, WindowEnd=window_end
+            )
+            for window_start, window_end in rolling_windows(start, end, months, step)
+        ]
+        if not frames:
+            raise ValueError(f"No {months}-month window fits between {start} and {end}")
+        return pd.concat(frames, ignore_index=True)
+    except Exception as e:
+        logging.error(f"Error fetching rolling arm statistics: {e}")
+        raise
+
+@traced()
+def load_distribution_bins(from_view=False, use_cache=True, start=None, end=None):
+    try:
+        return {
+            'age': run_aggregate_query(AGE_BINS_QUERY, from_view, use_cache, start, end),
+            'gender': run_aggregate_query(GENDER_COUNTS_QUERY, from_view, use_cache, start, end),
+        }
+    except Exception as e:
+        logging.error(f"Error fetching distribution bins: {e}")
+        raise
+
+def distribution_bins(df):
+    # Client-side equivalent of load_distribution_bins for an already loaded frame
+    return {
+        'age': df.groupby(['Age', 'EnrolledInProgram'], observed=True).size().rename('Count').reset_index(),
+        'gender': df.groupby(['Gender', 'EnrolledInProgram'], observed=True).size().rename('Count').reset_index(),
+    }
+
+def measure_load_memory(task):
+    # Runs in a process of its own, so ru_maxrss is this load path's peak
+    # alone. Unlike tracemalloc it also counts the libpq, DuckDB and Arrow
+    # buffers the rows pass through. ru_maxrss is in KiB on Linux.
+    stream, chunksize = task
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    df = load_data(stream=stream, chunksize=chunksize, use_cache=False)
+    return {
+        'rows': len(df),
+        'baseline_rss_bytes': baseline,
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'frame_bytes': int(df.memory_usage(deep=True).sum()),
+    }
+
+def memory_report(chunksize=DEFAULT_CHUNKSIZE):
+    report = {}
+    for mode, stream in [('query', False), ('stream', True)]:
+        # The worker must open its own connection, not share this process's
+        close_pool()
+        with ProcessPoolExecutor(1) as pool:
+            report[mode] = pool.submit(measure_load_memory, (stream, chunksize)).result()
+        logging.info(f"{mode}: {report[mode]['rows']} rows, peak RSS {report[mode]['peak_rss_bytes'] / 2**20:.1f} MiB "
+                     f"(from {report[mode]['baseline_rss_bytes'] / 2**20:.1f} MiB before loading), "
+                     f"frame {report[mode]['frame_bytes'] / 2**20:.1f} MiB")
+    return report
+
+def max_plan_rows(node):
+    rows = node.get('Actual Rows', 0) * node.get('Actual Loops', 1)
+    return max([rows] + [max_plan_rows(child) for child in node.get('Plans', [])])
+
+def compare_feature_queries():
+    visits = int(execute_query("SELECT COUNT(*) AS visits FROM hospital_visits")['visits'].iloc[0])
+    report = {'visits': visits}
+    queries = [
+        ('legacy', LEGACY_PATIENT_OUTCOMES_QUERY),
+        ('legacy_fanout', LEGACY_FANOUT_QUERY),
+        ('preaggregated', PATIENT_OUTCOMES_QUERY),
+    ]
+    for name, query in queries:
+        try:
+            plan = explain_query(query)
+        except Exception as e:
+            logging.warning(f"{name}: EXPLAIN ANALYZE failed: {e}")
+            report[name] = None
+            continue
+        ms = plan['Execution Time']
+        report[name] = {
+            'execution_ms': ms,
+            'planning_ms': plan['Planning Time'],
+            'max_intermediate_rows': max_plan_rows(plan['Plan']),
+            'ms_per_1k_visits': ms / max(visits, 1) * 1000,
+        }
+        logging.info(f"{name}: {ms:.1f} ms for {visits} visits ({report[name]['ms_per_1k_visits']:.3f} ms per 1k visits), "
+                     f"largest plan node {report[name]['max_intermediate_rows']} rows")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the patient-level dataset.")
+    parser.add_argument('--memory-report', action='store_true',
+                        help="Compare peak RSS of the single-query and streaming load paths")
+    parser.add_argument('--explain', action='store_true',
+                        help="EXPLAIN ANALYZE the legacy and pre-aggregated feature queries")
+    parser.add_argument('--from-view', action='store_true',
+                        help="Read from the patient_outcomes materialized view")
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    args = parser.parse_args()
+
+    if args.memory_report:
+        memory_report(args.chunksize)
+    elif args.explain:
+        compare_feature_queries()
+    else:
+        df = load_data(stream=True, chunksize=args.chunksize, from_view=args.from_view)
+        logging.info(f"Loaded {len(df)} rows")
@@ -1,35 +1,174 @@
-import psycopg2
+try:
+    import psycopg2
+    from psycopg2.pool import ThreadedConnectionPool
+except ImportError:
+    psycopg2 = None
 import pandas as pd
 import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import duckdb_backend
+from tracing import record_rows, traced
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+DEFAULT_CHUNKSIZE = 100000
+
+# READMISSION_BACKEND selects where queries run: the Postgres server, or the
+# embedded DuckDB engine over a database file or Parquet snapshot (duckdb_backend.py)
+BACKENDS = ['postgres', 'duckdb']
+
+DATABASE_ERRORS = tuple(
+    error for error in (getattr(psycopg2, 'Error', None), getattr(duckdb_backend.duckdb, 'Error', None))
+    if error is not None
+) + (pd.io.sql.DatabaseError,)
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def db_config():
+    # Read at pool creation so callers (e.g. the benchmark) can point at another database
+    return {
+        'dbname': os.environ.get('DB_NAME', 'patientcare_ab_test'),
+        'user': os.environ.get('DB_USER'),
+        'password': os.environ.get('DB_PASSWORD'),
+        'host': os.environ.get('DB_HOST', 'localhost'),
+        'port': os.environ.get('DB_PORT', '5432'),
+    }
+
+def backend_name():
+    backend = os.environ.get('READMISSION_BACKEND', 'postgres')
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}; expected one of {BACKENDS}")
+    return backend
+
+def database_identity():
+    # Distinguishes cached results of different databases and backends
+    if backend_name() == 'duckdb':
+        return duckdb_backend.database_identity()
+    config = db_config()
+    return f"postgres:{config['host']}:{config['port']}/{config['dbname']}"
+
+def get_pool():
+    global _pool, _pool_pid
+    if psycopg2 is None:
+        raise ImportError("psycopg2 is not installed; it is required for the postgres backend")
+    with _pool_lock:
+        # Connections must not be shared with forked worker processes
+        if _pool is None or _pool.closed or _pool_pid != os.getpid():
+            try:
+                _pool = ThreadedConnectionPool(
+                    int(os.environ.get('DB_POOL_MIN', 1)),
+                    int(os.environ.get('DB_POOL_MAX', 10)),
+                    **db_config()
+                )
+            except psycopg2.Error as e:
+                logging.error(f"Unable to connect to the database: {e}")
+                raise
+            _pool_pid = os.getpid()
+        return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+        _pool = None
+    duckdb_backend.close_connection()
+
+@contextmanager
 def get_db_connection():
+    if backend_name() == 'duckdb':
+        with duckdb_backend.connection() as conn:
+            yield conn
+        return
+
+    pool = get_pool()
+    conn = pool.getconn()
     try:
-        return psycopg2.connect(
-            dbname="patientcare_ab_test",
-            user="[name]",
-            password="[psw]",
-            host="localhost",
-            port="5432"
-        )
-    except psycopg2.Error as e:
-        logging.error(f"Unable to connect to the database: {e}")
+        yield conn
+        conn.commit()
+    except BaseException:
+        if not conn.closed:
+            conn.rollback()
         raise
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
 
-def execute_query(query):
+@traced('execute_query')
+def execute_query(query, params=None):
+    start = time.perf_counter()
     try:
-        conn = get_db_connection()
-        df = pd.read_sql_query(query, conn)
-        logging.info(f"Query executed successfully. Columns in query result: {df.columns.tolist()}")
+        if backend_name() == 'duckdb':
+            # Columnar result straight into a frame, no row-by-row transfer
+            df = duckdb_backend.query_frame(query, params)
+        else:
+            with get_db_connection() as conn:
+                df = pd.read_sql_query(query, conn, params=params)
+        record_rows(len(df))
+        logging.info(f"Query returned {len(df)} rows in {time.perf_counter() - start:.3f}s. "
+                     f"Columns in query result: {df.columns.tolist()}")
         return df
-    except psycopg2.Error as e:
+    except DATABASE_ERRORS as e:
         logging.error(f"Database error: {e}")
         raise
-    except pd.io.sql.DatabaseError as e:
-        logging.error(f"Pandas SQL error: {e}")
+
+def iter_query_chunks(query, params=None, chunksize=DEFAULT_CHUNKSIZE):
+    # A named cursor keeps the result set on the server, so only one chunk
+    # of rows is held in memory at a time
+    start = time.perf_counter()
+    if backend_name() == 'duckdb':
+        yield from iter_duckdb_chunks(query, params, chunksize, start)
+        return
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cur:
+                cur.itersize = chunksize
+                cur.execute(query, params)
+                chunks = rows_fetched = 0
+                while True:
+                    rows = cur.fetchmany(chunksize)
+                    if not rows:
+                        break
+                    chunks += 1
+                    rows_fetched += len(rows)
+                    record_rows(len(rows))
+                    yield pd.DataFrame.from_records(rows, columns=[d[0] for d in cur.description])
+        logging.info(f"Streamed {rows_fetched} rows in {chunks} chunks of up to {chunksize} rows "
+                     f"in {time.perf_counter() - start:.3f}s.")
+    except DATABASE_ERRORS as e:
+        logging.error(f"Database error: {e}")
+        raise
+
+def iter_duckdb_chunks(query, params, chunksize, start):
+    try:
+        chunks = rows_fetched = 0
+        for chunk in duckdb_backend.iter_frames(query, params, chunksize):
+            chunks += 1
+            rows_fetched += len(chunk)
+            record_rows(len(chunk))
+            yield chunk
+        logging.info(f"Streamed {rows_fetched} rows in {chunks} chunks in {time.perf_counter() - start:.3f}s.")
+    except DATABASE_ERRORS as e:
+        logging.error(f"Database error: {e}")
+        raise
+
+def explain_query(query, params=None):
+    if backend_name() != 'postgres':
+        raise ValueError(f"EXPLAIN ANALYZE reports need the postgres backend, not {backend_name()!r}")
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", params)
+                plan = cur.fetchone()[0][0]
+            # EXPLAIN ANALYZE executes the statement; never keep its effects
+            conn.rollback()
+        logging.info(f"Query executed in {plan['Execution Time']:.1f} ms (planning {plan['Planning Time']:.1f} ms).")
+        return plan
+    except DATABASE_ERRORS as e:
+        logging.error(f"Database error: {e}")
         raise
-    finally:
-        if conn:
-            conn.close()
-            logging.info("Database connection closed.")
\ No newline at end of file
@@ -0,0 +1,221 @@
+import argparse
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Embedded columnar backend, selected with READMISSION_BACKEND=duckdb. Tables
+# live in a DuckDB file, or are read straight from a directory of Parquet
+# files (one <table>.parquet per table) when DUCKDB_PARQUET_DIR is set.
+DEFAULT_DATABASE = 'patientcare.duckdb'
+SNAPSHOT_TABLES = ['patients', 'program_enrollment', 'hospital_visits', 'survey_responses', 'medications',
+                   'patient_outcomes']
+
+# psycopg2 placeholders: %s, %(name)s and the %% escape
+PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+_conn = None
+_conn_pid = None
+_conn_lock = threading.Lock()
+
+def require_duckdb():
+    if duckdb is None:
+        raise ImportError("duckdb is not installed; it is required for READMISSION_BACKEND=duckdb")
+
+def parquet_dir():
+    return os.environ.get('DUCKDB_PARQUET_DIR')
+
+def database_path():
+    # A Parquet snapshot is read through views in an in-memory database
+    default = ':memory:' if parquet_dir() else DEFAULT_DATABASE
+    return os.environ.get('DUCKDB_PATH', default)
+
+def parquet_path(directory, table):
+    return os.path.join(directory, f'{table}.parquet')
+
+def stamp_path(directory, table):
+    # Parquet files hold no table comment, so a stamped table's comment (the
+    # patient_outcomes query version) is written next to its file
+    return os.path.join(directory, f'{table}.stamp')
+
+def write_stamp(directory, table, comment):
+    if comment:
+        with open(stamp_path(directory, table), 'w') as f:
+            f.write(comment)
+
+def attach_parquet(conn, directory):
+    for table in SNAPSHOT_TABLES:
+        path = parquet_path(directory, table)
+        if os.path.exists(path):
+            conn.execute(f"CREATE OR REPLACE VIEW {table} AS SELECT * FROM read_parquet('{path}')")
+            if os.path.exists(stamp_path(directory, table)):
+                with open(stamp_path(directory, table)) as f:
+                    comment = f.read().strip().replace("'", "''")
+                conn.execute(f"COMMENT ON VIEW {table} IS '{comment}'")
+
+def connect(path=None):
+    require_duckdb()
+    conn = duckdb.connect(path or database_path())
+    if parquet_dir():
+        attach_parquet(conn, parquet_dir())
+    return conn
+
+def get_connection():
+    global _conn, _conn_pid
+    with _conn_lock:
+        # Like the Postgres pool, a connection is never shared with forked workers
+        if _conn is None or _conn_pid != os.getpid():
+            _conn = connect()
+            _conn_pid = os.getpid()
+        return _conn
+
+def close_connection():
+    global _conn
+    with _conn_lock:
+        if _conn is not None and _conn_pid == os.getpid():
+            _conn.close()
+        _conn = None
+
+@contextmanager
+def connection():
+    # Each user gets its own cursor (a DuckDB connection to the same database),
+    # in autocommit mode; callers needing a transaction call begin() themselves
+    conn = get_connection().cursor()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def translate(query, params=None):
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        return f'${match.group(1)}' if match.group(1) else '?'
+    if params is None:
+        # Like psycopg2, a query without parameters is sent as is
+        return query, None
+    if isinstance(params, dict):
+        return PLACEHOLDER.sub(replace, query), params
+    return PLACEHOLDER.sub(replace, query), list(params)
+
+def execute(conn, query, params=None):
+    query, params = translate(query, params)
+    return conn.execute(query, params) if params is not None else conn.execute(query)
+
+def numpy_frame(df):
+    # Integer columns with NULLs come back as pandas Int64; psycopg2 frames
+    # hold them as float64 with NaN, which is what the analysis code expects
+    for column, dtype in df.dtypes.items():
+        if dtype.kind in 'iuf' and not isinstance(dtype, np.dtype):
+            df[column] = df[column].astype('float64')
+    return df
+
+def query_frame(query, params=None):
+    with connection() as conn:
+        return numpy_frame(execute(conn, query, params).df())
+
+def iter_frames(query, params=None, chunksize=100000):
+    # DuckDB produces results in vectors of 2048 rows; chunks are whole vectors
+    vectors = max(1, chunksize // 2048)
+    with connection() as conn:
+        result = execute(conn, query, params)
+        while True:
+            chunk = result.fetch_df_chunk(vectors)
+            if chunk.empty:
+                break
+            yield numpy_frame(chunk)
+
+def table_watermark(tables):
+    # A row count alone misses UPDATEs, so DuckDB tables are keyed on a checksum
+    # of every row: one columnar scan, milliseconds per million rows. Parquet
+    # files are rewritten whole, so their size and mtime change with every
+    # write and are used instead of scanning the file.
+    watermark = []
+    with connection() as conn:
+        for table in sorted(t.lower() for t in tables):
+            path = parquet_path(parquet_dir(), table) if parquet_dir() else None
+            try:
+                if path and os.path.exists(path):
+                    rows = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                    stat = os.stat(path)
+                    entry = [table, str(rows), str(stat.st_size), str(stat.st_mtime_ns)]
+                else:
+                    rows, checksum = conn.execute(f"SELECT COUNT(*), SUM(hash(t)) FROM {table} t").fetchone()
+                    entry = [table, str(rows), str(checksum)]
+            except duckdb.CatalogException:
+                continue
+            watermark.append(entry)
+    return watermark
+
+def database_identity():
+    return f"duckdb:{os.path.abspath(parquet_dir()) if parquet_dir() else database_path()}"
+
+def export_parquet(output_dir, tables=SNAPSHOT_TABLES):
+    # Writes the tables of the current DuckDB database as a Parquet snapshot
+    os.makedirs(output_dir, exist_ok=True)
+    with connection() as conn:
+        for table in tables:
+            conn.execute(f"COPY (SELECT * FROM {table}) TO '{parquet_path(output_dir, table)}' (FORMAT parquet)")
+            comment = conn.execute("SELECT MAX(comment) FROM duckdb_tables() WHERE table_name = ?", [table]).fetchone()[0]
+            write_stamp(output_dir, table, comment)
+            logging.info(f"Exported {table} to {parquet_path(output_dir, table)}")
+
+def snapshot_postgres(output_dir, tables=SNAPSHOT_TABLES, chunksize=100000):
+    # Streams each Postgres table into a scratch DuckDB file, then writes it
+    # out as Parquet; no table is held in memory whole
+    from database_utils import backend_name, execute_query, iter_query_chunks
+
+    require_duckdb()
+    if backend_name() != 'postgres':
+        raise ValueError("Snapshots are taken from the postgres backend; unset READMISSION_BACKEND")
+    os.makedirs(output_dir, exist_ok=True)
+    scratch = os.path.join(output_dir, '.snapshot.duckdb')
+    conn = duckdb.connect(scratch)
+    try:
+        for table in tables:
+            created = False
+            for chunk in iter_query_chunks(f"SELECT * FROM {table}", chunksize=chunksize):
+                conn.register('chunk', chunk)
+                if created:
+                    conn.execute(f"INSERT INTO {table} SELECT * FROM chunk")
+                else:
+                    conn.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM chunk")
+                    created = True
+                conn.unregister('chunk')
+            if not created:
+                logging.warning(f"{table} is empty; no Parquet file written.")
+                continue
+            conn.execute(f"COPY {table} TO '{parquet_path(output_dir, table)}' (FORMAT parquet)")
+            comment = execute_query("SELECT obj_description(to_regclass(%(table)s), 'pg_class') AS comment",
+                                    {'table': table})['comment'].iloc[0]
+            write_stamp(output_dir, table, comment)
+            logging.info(f"Snapshotted {table} to {parquet_path(output_dir, table)}")
+    finally:
+        conn.close()
+        os.remove(scratch)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create Parquet snapshots for the embedded DuckDB backend.")
+    parser.add_argument('output_dir', help="Directory for the <table>.parquet files")
+    parser.add_argument('--from-duckdb', action='store_true',
+                        help="Export the DuckDB database (DUCKDB_PATH) instead of the Postgres database")
+    parser.add_argument('--chunksize', type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    if args.from_duckdb:
+        export_parquet(args.output_dir)
+    else:
+        snapshot_postgres(args.output_dir, chunksize=args.chunksize)
+    print(f"Snapshot written; analyze it with READMISSION_BACKEND=duckdb DUCKDB_PARQUET_DIR={args.output_dir}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,157 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+# Readmission episodes computed from the raw visits. A visit is a readmission
+# within w days when it starts at most w days after the patient's previous
+# discharge; overlapping stays (negative gaps) are transfers, not readmissions.
+WINDOWS = (30, 60, 90)
+
+# The (PatientID, AdmissionDate) index returns these rows already in order
+VISITS_TEMPLATE = """
+    SELECT
+        PatientID AS "PatientID",
+        AdmissionDate AS "AdmissionDate",
+        DischargeDate AS "DischargeDate"
+    FROM hospital_visits{visit_filter}
+    ORDER BY PatientID, AdmissionDate, DischargeDate
+    """
+VISITS_QUERY = VISITS_TEMPLATE.format(visit_filter='')
+
+def day_numbers(values):
+    # Dates as float day numbers, NaN for missing ones
+    days = pd.to_datetime(pd.Series(values)).to_numpy().astype('datetime64[D]')
+    missing = np.isnat(days)
+    days = days.astype(np.int64).astype(float)
+    days[missing] = np.nan
+    return days
+
+def is_grouped(patient, admission):
+    # Each patient's visits must be contiguous and in admission order; the
+    # order of the patients themselves does not matter
+    if len(patient) < 2:
+        return True
+    same = patient[1:] == patient[:-1]
+    return (int((~same).sum()) + 1 == len(pd.unique(patient))
+            and not np.any(np.diff(admission)[same] < 0))
+
+def visit_arrays(visits):
+    patient = visits['PatientID'].to_numpy()
+    admission = day_numbers(visits['AdmissionDate'])
+    discharge = day_numbers(visits['DischargeDate'])
+    if not is_grouped(patient, admission):
+        # Only unordered input (not VISITS_QUERY) pays for a sort
+        codes, _ = pd.factorize(patient)
+        order = np.lexsort((discharge, admission, codes))
+        patient, admission, discharge = patient[order], admission[order], discharge[order]
+    return patient, admission, discharge
+
+def compute_episodes(patient, admission, discharge, windows=WINDOWS, first_day=None):
+    # One pass over visits sorted by (patient, admission): group boundaries
+    # mark each patient's first visit, np.diff gives the gap to the previous discharge.
+    # Visits admitted before first_day (a day number) only supply the previous
+    # discharge; they are not counted, and patients with no later visit are dropped.
+    n = len(patient)
+    if n == 0:
+        return empty_episodes(windows)
+
+    first = np.ones(n, dtype=bool)
+    first[1:] = patient[1:] != patient[:-1]
+    starts = np.flatnonzero(first)
+
+    gap = np.full(n, np.nan)
+    gap[1:] = admission[1:] - discharge[:-1]
+    gap[first] = np.nan
+    # NaN gaps (first visits, missing dates) compare False, so they never count
+    with np.errstate(invalid='ignore'):
+        readmission = gap >= 0
+        counted = admission >= first_day if first_day is not None else np.ones(n, dtype=bool)
+    readmission &= counted
+
+    episodes = pd.DataFrame({
+        'PatientID': patient[starts],
+        'VisitCount': np.add.reduceat(counted, starts),
+        'Readmissions': np.add.reduceat(readmission, starts),
+    })
+    with np.errstate(invalid='ignore'):
+        for window in windows:
+            within = readmission & (gap <= window)
+            episodes[f'Readmissions{window}'] = np.add.reduceat(within, starts)
+            episodes[f'Readmitted{window}'] = episodes[f'Readmissions{window}'] > 0
+
+    # Days to the first readmission: the gap before each patient's first
+    # readmission, found as the smallest readmission position in the group
+    position = np.where(readmission, np.arange(n), n)
+    first_position = np.minimum.reduceat(position, starts)
+    has_readmission = first_position < n
+    days = np.full(len(starts), np.nan)
+    days[has_readmission] = gap[first_position[has_readmission]]
+    episodes['DaysToReadmission'] = days
+    if first_day is not None:
+        episodes = episodes[episodes['VisitCount'] > 0].reset_index(drop=True)
+    return episodes
+
+def empty_episodes(windows=WINDOWS):
+    columns = {'PatientID': pd.Series(dtype=object), 'VisitCount': pd.Series(dtype=np.int64),
+               'Readmissions': pd.Series(dtype=np.int64)}
+    for window in windows:
+        columns[f'Readmissions{window}'] = pd.Series(dtype=np.int64)
+        columns[f'Readmitted{window}'] = pd.Series(dtype=bool)
+    columns['DaysToReadmission'] = pd.Series(dtype=float)
+    return pd.DataFrame(columns)
+
+def first_day_number(start):
+    return None if start is None else float(np.datetime64(start, 'D').astype(np.int64))
+
+def episodes_from_frame(visits, windows=WINDOWS, start=None):
+    return compute_episodes(*visit_arrays(visits), windows=windows, first_day=first_day_number(start))
+
+def iter_patient_groups(chunks):
+    # Chunks must arrive in (PatientID, AdmissionDate) order. The last patient
+    # of each chunk may continue in the next one, so their visits are carried
+    # over and only frames of patients known to be complete are yielded.
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if chunk.empty:
+            continue
+        patient = chunk['PatientID'].to_numpy()
+        tail = patient == patient[-1]
+        # Start of the trailing run of the chunk's last patient
+        last = 0 if tail.all() else len(chunk) - int(np.argmin(tail[::-1]))
+        carry = chunk.iloc[last:]
+        if last:
+            yield chunk.iloc[:last]
+    if carry is not None and not carry.empty:
+        yield carry
+
+def iter_episode_chunks(chunks, windows=WINDOWS, start=None):
+    for visits in iter_patient_groups(chunks):
+        yield episodes_from_frame(visits, windows, start)
+
+def episodes_from_chunks(chunks, windows=WINDOWS, start=None):
+    try:
+        parts = list(iter_episode_chunks(chunks, windows, start))
+        episodes = pd.concat(parts, ignore_index=True) if parts else empty_episodes(windows)
+        logging.info(f"Computed readmission episodes for {len(episodes)} patients "
+                     f"from {int(episodes['VisitCount'].sum())} visits")
+        return episodes
+    except Exception as e:
+        logging.error(f"Error computing readmission episodes: {e}")
+        raise
+
+def attach_episodes(df, episodes, window=30):
+    # Replaces the SQL readmission columns with the episode-based ones:
+    # IsReadmission means readmitted within `window` days of a discharge
+    df = df.drop(columns=['IsReadmission', 'DaysToReadmission'], errors='ignore')
+    df = df.merge(episodes, on='PatientID', how='left')
+    # Patients without visits get no episode row
+    for column in episodes.columns.drop(['PatientID', 'DaysToReadmission']):
+        if episodes[column].dtype == bool:
+            df[column] = df[column].fillna(False).astype(bool)
+        else:
+            df[column] = df[column].fillna(0).astype(np.int64)
+    df['IsReadmission'] = df[f'Readmitted{window}']
+    return df
@@ -1,22 +1,293 @@
-from data_loading import load_data
-from analysis import analyze_results
-from visualizations import create_visualizations
+import argparse
 import logging
+import os
+import pickle
+import sys
+from datetime import date
+
+import tracing
+
+# Heavy modules (pandas, scipy, matplotlib, seaborn, psycopg2) are imported
+# inside the stage that needs them, so --help and light stages start fast.
+
+DEFAULT_ARTIFACTS_DIR = 'artifacts'
+PATIENTS_ARTIFACT = 'patients.pkl'
+ARM_STATS_ARTIFACT = 'arm_stats.pkl'
+BINS_ARTIFACT = 'bins.pkl'
+RESULTS_ARTIFACT = 'results.pkl'
+MATCHED_ARTIFACT = 'matched.pkl'
+MATCH_DIAGNOSTICS_ARTIFACT = 'match_diagnostics.pkl'
+STATS_STORE_ARTIFACT = 'stats_store.json'
+MONITOR_ARTIFACT = 'monitor.pkl'
+ROLLING_ARTIFACT = 'rolling.pkl'
+
+def save_artifact(args, name, obj):
+    os.makedirs(args.artifacts_dir, exist_ok=True)
+    path = os.path.join(args.artifacts_dir, name)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    logging.info(f"Wrote {path}")
+
+def load_artifact(args, name):
+    path = os.path.join(args.artifacts_dir, name)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found; run the stage that produces it first")
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def run_load(args):
+    from data_loading import distribution_bins, load_arm_statistics, load_data, load_distribution_bins
+
+    if args.pushdown:
+        if args.readmission_window or args.study_end:
+            raise ValueError("--readmission-window and --study-end need patient-level rows; they cannot be "
+                             "combined with --pushdown")
+        # Aggregate in the database; only per-arm statistics and plot bins are transferred
+        save_artifact(args, ARM_STATS_ARTIFACT,
+                      load_arm_statistics(args.from_view, not args.no_cache, args.start, args.end))
+        save_artifact(args, BINS_ARTIFACT,
+                      load_distribution_bins(args.from_view, not args.no_cache, args.start, args.end))
+        return None
+
+    df = load_data(stream=args.stream, from_view=args.from_view, use_cache=not args.no_cache,
+                   readmission_window=args.readmission_window, prior_period_end=args.prior_period_end,
+                   start=args.start, end=args.end, study_end=args.study_end)
+    save_artifact(args, PATIENTS_ARTIFACT, df)
+    save_artifact(args, BINS_ARTIFACT, distribution_bins(df))
+    return df
+
+def run_match(args, df=None):
+    from matching import match_patients
+
+    df = load_artifact(args, PATIENTS_ARTIFACT) if df is None else df
+    matched, diagnostics = match_patients(df, args.neighbors, args.caliper, workers=args.workers, seed=args.seed)
+    save_artifact(args, MATCHED_ARTIFACT, matched)
+    save_artifact(args, MATCH_DIAGNOSTICS_ARTIFACT, diagnostics)
+    return matched
+
+def run_analyze(args, df=None):
+    from analysis import analyze_results, analyze_results_from_stats
+
+    if args.pushdown:
+        results = analyze_results_from_stats(load_artifact(args, ARM_STATS_ARTIFACT))
+    else:
+        if df is None:
+            df = load_artifact(args, MATCHED_ARTIFACT if args.matched else PATIENTS_ARTIFACT)
+        results = analyze_results(df, args.bootstrap, args.permutations, args.seed, args.workers,
+                                  args.metrics, args.arms, args.adjusted, args.survival)
+    save_artifact(args, RESULTS_ARTIFACT, results)
+    return results
+
+def run_rolling(args):
+    from analysis import analyze_rolling_windows
+    from data_loading import load_rolling_arm_statistics
+
+    rolling_stats = load_rolling_arm_statistics(args.start, args.end, args.months, args.step, not args.no_cache)
+    windows = analyze_rolling_windows(rolling_stats)
+    save_artifact(args, ROLLING_ARTIFACT, windows)
+    return windows
+
+def run_monitor(args):
+    from stats_store import monitor
+
+    path = args.store or os.path.join(args.artifacts_dir, STATS_STORE_ARTIFACT)
+    table = monitor(path, args.window, args.alpha, args.mixing_sd, dict(args.planned), update=not args.no_update)
+    save_artifact(args, MONITOR_ARTIFACT, table)
+    return table
+
+def planned_size(value):
+    metric, _, size = value.partition('=')
+    if not size:
+        raise argparse.ArgumentTypeError(f"expected METRIC=N, got {value!r}")
+    return metric, int(size)
+
+def run_plot(args, results=None):
+    from visualizations import create_visualizations
+
+    results = load_artifact(args, RESULTS_ARTIFACT) if results is None else results
+    bins = load_artifact(args, BINS_ARTIFACT)
+    os.makedirs(args.output_dir, exist_ok=True)
+    create_visualizations(None, results, bins=bins, output_dir=args.output_dir,
+                          workers=args.workers, force=args.force)
+
+def run_all(args):
+    if args.matched and args.pushdown:
+        raise ValueError("--matched needs patient-level rows; it cannot be combined with --pushdown")
+    if args.matched:
+        from analysis import check_matched_analyses
+        check_matched_analyses(args.bootstrap, args.permutations, args.metrics, args.adjusted, args.survival)
+    with tracing.span('stage:load', profile=True):
+        df = run_load(args)
+    if args.matched:
+        with tracing.span('stage:match', profile=True):
+            df = run_match(args, df)
+    with tracing.span('stage:analyze', profile=True):
+        results = run_analyze(args, df)
+    with tracing.span('stage:plot', profile=True):
+        run_plot(args, results)
+    logging.info("A/B testing analysis completed successfully.")
+
+def run_populate(args):
+    from populate_db import main as populate_main
+    populate_main(args.extra)
+
+def run_create_tables(args):
+    from create_tables import main as create_tables_main
+    create_tables_main(args.extra)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Hospital readmission reduction A/B test pipeline.")
+    parser.add_argument('--artifacts-dir', default=DEFAULT_ARTIFACTS_DIR,
+                        help="Directory for intermediate results passed between stages")
+    parser.add_argument('--backend', choices=['postgres', 'duckdb'], default=None,
+                        help="Query engine (default: READMISSION_BACKEND, else postgres)")
+    parser.add_argument('--parquet-dir', default=None,
+                        help="With --backend duckdb, read the tables from this Parquet snapshot")
+    parser.add_argument('--trace', action='store_true',
+                        help="Record per-stage and per-step timings, memory and row counts (or set READMISSION_TRACE=1)")
+    parser.add_argument('--trace-report', default=None,
+                        help="Path of the JSON run report (default: <artifacts-dir>/trace_<stage>.json)")
+    parser.add_argument('--profile-dir', default=None,
+                        help="Also write a cProfile (or pyinstrument) profile per stage into this directory")
+    parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'], default='cprofile')
+    subparsers = parser.add_subparsers(dest='stage', required=True)
+
+    load_options = argparse.ArgumentParser(add_help=False)
+    load_options.add_argument('--pushdown', action='store_true',
+                              help="Compute the test statistics in SQL instead of loading every patient row")
+    load_options.add_argument('--stream', action='store_true',
+                              help="Stream rows through a server-side cursor into a compact frame")
+    load_options.add_argument('--from-view', action='store_true',
+                              help="Read from the patient_outcomes materialized view")
+    load_options.add_argument('--no-cache', action='store_true',
+                              help="Bypass the on-disk query cache")
+    load_options.add_argument('--readmission-window', type=int, choices=[30, 60, 90], default=None,
+                              help="Define readmission as a visit within this many days of a discharge, "
+                                   "computed from the raw visits (not with --pushdown)")
+    load_options.add_argument('--start', type=date.fromisoformat, default=None, metavar='YYYY-MM-DD',
+                              help="Only count visits admitted and surveys answered on or after this date")
+    load_options.add_argument('--end', type=date.fromisoformat, default=None, metavar='YYYY-MM-DD',
+                              help="Only count visits admitted and surveys answered before this date")
+    load_options.add_argument('--study-end', type=date.fromisoformat, default=None, metavar='YYYY-MM-DD',
+                              help="Add time from first discharge to readmission, censored at this date, for "
+                                   "'analyze --survival' (not with --pushdown)")
+    load_options.add_argument('--prior-period-end', type=date.fromisoformat, default=None, metavar='YYYY-MM-DD',
+                              help="Add PriorVisits, the visits admitted before this date, for CUPED in "
+                                   "'analyze --adjusted' (enrollment opens 2024-01-01)")
+
+    analyze_options = argparse.ArgumentParser(add_help=False)
+    analyze_options.add_argument('--bootstrap', type=int, default=0,
+                                 help="Bootstrap replicates for confidence intervals (0 disables)")
+    analyze_options.add_argument('--permutations', type=int, default=0,
+                                 help="Permutation test replicates (0 disables)")
+    analyze_options.add_argument('--metrics', nargs='*', default=None,
+                                 help="Test these outcome metrics across treatment arms with FDR control "
+                                      "(no names: all survey and readmission metrics)")
+    analyze_options.add_argument('--adjusted', nargs='*', default=None, metavar='OUTCOME',
+                                 help="Covariate-adjusted effects (regression, and CUPED when the load used "
+                                      "--prior-period-end); no names: IsReadmission and Satisfaction")
+    analyze_options.add_argument('--survival', action='store_true',
+                                 help="Kaplan-Meier curves, log-rank tests and a Cox model of time to readmission "
+                                      "(needs 'load --study-end')")
+    analyze_options.add_argument('--arms', nargs='+', choices=['any', 'program'], default=['any', 'program'],
+                                 help="Treatment arms for --metrics: any program, and/or each program, vs not enrolled")
+
+    match_options = argparse.ArgumentParser(add_help=False)
+    match_options.add_argument('--neighbors', type=int, default=1,
+                               help="Controls matched to each treated patient (with replacement)")
+    match_options.add_argument('--caliper', type=float, default=0.2,
+                               help="Caliper in standard deviations of the propensity logit")
+
+    plot_options = argparse.ArgumentParser(add_help=False)
+    plot_options.add_argument('--output-dir', default='.', help="Directory for the PNG files")
+    plot_options.add_argument('--force', action='store_true', help="Re-render plots even if unchanged")
+
+    seed_options = argparse.ArgumentParser(add_help=False)
+    seed_options.add_argument('--seed', type=int, default=12345,
+                              help="Random seed (resampling, and ties between matched controls)")
+
+    worker_options = argparse.ArgumentParser(add_help=False)
+    worker_options.add_argument('--workers', type=int, default=None,
+                                help="Worker processes (default: one per CPU)")
+
+    stage = subparsers.add_parser('load', parents=[load_options], help="Load the dataset into the artifacts directory")
+    stage.set_defaults(run=run_load)
+    stage = subparsers.add_parser('analyze', parents=[analyze_options, seed_options, worker_options],
+                                  help="Analyze the loaded dataset")
+    stage.add_argument('--pushdown', action='store_true', help="Analyze the per-arm statistics from 'load --pushdown'")
+    stage.add_argument('--matched', action='store_true', help="Analyze the matched cohort from the match stage")
+    stage.set_defaults(run=run_analyze)
+    stage = subparsers.add_parser('match', parents=[match_options, seed_options, worker_options],
+                                  help="Propensity-score match the loaded patients")
+    stage.set_defaults(run=run_match)
+    stage = subparsers.add_parser('rolling', help="Readmission rates and tests over rolling windows (pushed down)")
+    stage.add_argument('--start', type=date.fromisoformat, required=True, metavar='YYYY-MM-DD')
+    stage.add_argument('--end', type=date.fromisoformat, required=True, metavar='YYYY-MM-DD')
+    stage.add_argument('--months', type=int, default=3, help="Window length in months")
+    stage.add_argument('--step', type=int, default=1, help="Months between window starts")
+    stage.add_argument('--no-cache', action='store_true', help="Bypass the query result cache")
+    stage.set_defaults(run=run_rolling)
+    stage = subparsers.add_parser('monitor', help="Fold new visits and surveys into the statistics store and run "
+                                                  "the sequential tests")
+    stage.add_argument('--store', default=None,
+                       help=f"Statistics store file (default: <artifacts-dir>/{STATS_STORE_ARTIFACT})")
+    stage.add_argument('--window', type=int, default=30, help="Readmission window in days; fixed per store")
+    stage.add_argument('--alpha', type=float, default=0.05)
+    stage.add_argument('--mixing-sd', type=float, default=0.1,
+                       help="mSPRT mixing standard deviation, in standard deviations of the metric")
+    stage.add_argument('--planned', nargs='*', type=planned_size, default=[], metavar='METRIC=N',
+                       help="Planned admissions or surveys (both arms) per metric, for O'Brien-Fleming "
+                            "alpha spending, e.g. readmission=200000")
+    stage.add_argument('--no-update', action='store_true', help="Test the stored statistics without updating them")
+    stage.set_defaults(run=run_monitor)
+    stage = subparsers.add_parser('plot', parents=[plot_options, worker_options], help="Render the plots")
+    stage.set_defaults(run=run_plot)
+    stage = subparsers.add_parser('all', parents=[load_options, analyze_options, match_options, plot_options,
+                                                  seed_options, worker_options],
+                                  help="Run load, analyze and plot")
+    stage.add_argument('--matched', action='store_true', help="Match the patients before analyzing them")
+    stage.set_defaults(run=run_all)
+    stage = subparsers.add_parser('populate', add_help=False, help="Populate the database (see populate_db.py --help)")
+    stage.set_defaults(run=run_populate, forward=True)
+    stage = subparsers.add_parser('create-tables', add_help=False,
+                                  help="Create the schema (see create_tables.py --help)")
+    stage.set_defaults(run=run_create_tables, forward=True)
+    return parser
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = build_parser()
+    args, extra = parser.parse_known_args(argv)
+    if extra and not getattr(args, 'forward', False):
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    args.extra = extra
+
+    # Set through the environment so forwarded stages and worker processes see it too
+    if args.backend:
+        os.environ['READMISSION_BACKEND'] = args.backend
+    if args.parquet_dir:
+        os.environ['DUCKDB_PARQUET_DIR'] = args.parquet_dir
+
+    if args.trace or args.profile_dir:
+        tracing.enable(args.profile_dir, args.profiler)
 
-def main():
     try:
-        # Load data
-        df = load_data()
-        
-        # Analyze results
-        results = analyze_results(df)
-        
-        # Create visualizations
-        create_visualizations(df, results)
-
-        logging.info("A/B testing analysis completed successfully.")
+        # 'all' profiles each of its stages separately; profilers cannot nest
+        with tracing.span(f'stage:{args.stage}', profile=args.stage != 'all'):
+            args.run(args)
+    except SystemExit as e:
+        # argparse in forwarded stages exits on --help or bad arguments
+        return e.code if isinstance(e.code, int) else 1
     except Exception as e:
-        logging.error(f"An error occurred during the A/B testing analysis: {e}")
+        logging.error(f"Stage '{args.stage}' failed: {e}")
+        return 1
+    finally:
+        if tracing.enabled():
+            report = args.trace_report or os.path.join(args.artifacts_dir, f'trace_{args.stage}.json')
+            tracing.write_report(report, stage=args.stage)
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
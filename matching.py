@@ -0,0 +1,231 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.special import expit
+
+from adjusted import COVARIATES, NUMERIC_COVARIATES, TREATMENT, covariate_levels, design_matrix, fit_logistic
+from tracing import traced
+
+DEFAULT_NEIGHBORS = 1
+# Caliper in standard deviations of the propensity logit (Austin, 2011)
+DEFAULT_CALIPER = 0.2
+BLOCK_COLUMN = 'ChronicCondition'
+# Largest acceptable |standardized mean difference| after matching
+BALANCE_THRESHOLD = 0.1
+DEFAULT_SEED = 12345
+MATCH_WEIGHT = 'MatchWeight'
+MATCHED_OUTCOMES = ['IsReadmission', 'Satisfaction', 'DaysToReadmission']
+
+def propensity_logits(df, levels, covariates=COVARIATES):
+    # Propensity model: enrollment on the covariates, with the adjusted.py
+    # sparse design and IRLS solver. df must hold complete rows only.
+    beta, _, _, _ = fit_logistic(df, TREATMENT, levels, covariates, treatment=None)
+    logits = []
+    for start in range(0, len(df), 500000):
+        X, _ = design_matrix(df.iloc[start:start + 500000], TREATMENT, levels, covariates, treatment=None)
+        logits.append(X @ beta)
+    return np.concatenate(logits) if logits else np.empty(0)
+
+def match_block(task):
+    # 1:k nearest-neighbour matching with replacement on a sorted-array index:
+    # the k nearest controls of a treated patient lie within k positions of
+    # its insertion point, so no pairwise distances are computed
+    treated_scores, control_scores, k, caliper, seed = task
+    empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0))
+    if len(treated_scores) == 0 or len(control_scores) == 0:
+        return empty
+
+    # Categorical covariates give many tied scores. Ties are broken at random,
+    # both in the control order and in where each treated patient lands among
+    # them, so tied controls are shared out instead of one being reused.
+    rng = np.random.default_rng(seed)
+    shuffled = rng.permutation(len(control_scores))
+    order = shuffled[np.argsort(control_scores[shuffled], kind='stable')]
+    sorted_scores = control_scores[order]
+    low = np.searchsorted(sorted_scores, treated_scores, side='left')
+    high = np.searchsorted(sorted_scores, treated_scores, side='right')
+    position = low + (rng.random(len(treated_scores)) * (high - low + 1)).astype(np.int64)
+    candidates = position[:, None] + np.arange(-k, k)[None, :]
+    valid = (candidates >= 0) & (candidates < len(sorted_scores))
+    candidates = np.clip(candidates, 0, len(sorted_scores) - 1)
+    distance = np.abs(sorted_scores[candidates] - treated_scores[:, None])
+    distance[~valid | (distance > caliper)] = np.inf
+
+    nearest = np.argsort(distance, axis=1, kind='stable')[:, :k]
+    chosen = np.take_along_axis(distance, nearest, axis=1)
+    matched = np.isfinite(chosen)
+    treated_index = np.broadcast_to(np.arange(len(treated_scores))[:, None], matched.shape)[matched]
+    control_index = order[np.take_along_axis(candidates, nearest, axis=1)[matched]]
+    return treated_index, control_index, chosen[matched]
+
+def match_blocks(logits, treated, blocks, neighbors, caliper, workers=None, seed=DEFAULT_SEED):
+    # Exact matching on the block column: every block is matched on its own,
+    # in parallel across processes
+    tasks, positions = [], []
+    for block in np.unique(blocks):
+        in_block = blocks == block
+        t = np.flatnonzero(in_block & treated)
+        c = np.flatnonzero(in_block & ~treated)
+        tasks.append((logits[t], logits[c], neighbors, caliper, [seed, int(block)]))
+        positions.append((t, c))
+
+    workers = min(len(tasks), workers or os.cpu_count() or 1)
+    if workers <= 1:
+        results = list(map(match_block, tasks))
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(match_block, tasks))
+
+    treated_rows, control_rows, distances = [], [], []
+    for (t, c), (treated_index, control_index, distance) in zip(positions, results):
+        treated_rows.append(t[treated_index])
+        control_rows.append(c[control_index])
+        distances.append(distance)
+    return np.concatenate(treated_rows), np.concatenate(control_rows), np.concatenate(distances)
+
+def balance_features(df, levels, covariates=COVARIATES):
+    # One numeric array per balance row: numeric covariates, every level of
+    # the categorical ones, and the propensity logit
+    for covariate in covariates:
+        if covariate in NUMERIC_COVARIATES:
+            yield covariate, pd.to_numeric(df[covariate]).to_numpy(dtype=float)
+        else:
+            values = df[covariate].astype(object).to_numpy()
+            for level in levels[covariate]:
+                yield f'{covariate}[{level}]', (values == level).astype(float)
+    yield 'PropensityLogit', df['PropensityLogit'].to_numpy(dtype=float)
+
+def arm_moments(values, treated, weights):
+    moments = []
+    for arm in (treated, ~treated):
+        mean = np.average(values[arm], weights=weights[arm])
+        moments.append((mean, np.average((values[arm] - mean) ** 2, weights=weights[arm])))
+    return moments
+
+def balance_table(before, after, levels, covariates=COVARIATES):
+    # Standardized mean differences before and after matching; both use the
+    # pooled standard deviation of the unmatched sample as the scale
+    treated_before = before[TREATMENT].to_numpy(dtype=bool)
+    treated_after = after[TREATMENT].to_numpy(dtype=bool)
+    weights_before = np.ones(len(before))
+    weights_after = after[MATCH_WEIGHT].to_numpy(dtype=float)
+    rows = []
+    features_after = dict(balance_features(after, levels, covariates))
+    for name, values in balance_features(before, levels, covariates):
+        (mt, vt), (mc, vc) = arm_moments(values, treated_before, weights_before)
+        (mt_after, _), (mc_after, _) = arm_moments(features_after[name], treated_after, weights_after)
+        scale = np.sqrt((vt + vc) / 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rows.append({
+                'covariate': name,
+                'mean_treatment_before': mt,
+                'mean_control_before': mc,
+                'smd_before': (mt - mc) / scale,
+                'mean_treatment_after': mt_after,
+                'mean_control_after': mc_after,
+                'smd_after': (mt_after - mc_after) / scale,
+            })
+    return pd.DataFrame(rows)
+
+@traced()
+def match_patients(df, neighbors=DEFAULT_NEIGHBORS, caliper=DEFAULT_CALIPER, covariates=COVARIATES, workers=None,
+                   seed=DEFAULT_SEED):
+    # Returns a patient-level frame for analyze_results: the matched treated
+    # patients plus their controls (a control matched twice appears twice),
+    # with MatchGroup, MatchWeight (1 / matches of the treated patient) and
+    # PropensityScore columns, and balance diagnostics
+    try:
+        complete = df.dropna(subset=[TREATMENT] + list(covariates)).reset_index(drop=True)
+        complete[TREATMENT] = complete[TREATMENT].astype(bool)
+        levels = covariate_levels(complete, covariates)
+        logits = propensity_logits(complete, levels, covariates)
+        complete['PropensityLogit'] = logits
+        complete['PropensityScore'] = expit(logits)
+
+        treated = complete[TREATMENT].to_numpy()
+        if treated.all() or not treated.any():
+            raise ValueError("One or both groups are empty. Cannot perform matching.")
+        width = caliper * logits.std()
+        blocks, _ = pd.factorize(complete[BLOCK_COLUMN])
+        treated_rows, control_rows, distances = match_blocks(logits, treated, blocks, neighbors, width, workers, seed)
+
+        matches = np.bincount(treated_rows, minlength=len(complete))
+        matched_treated = np.flatnonzero(matches)
+        treated_frame = complete.iloc[matched_treated].assign(MatchGroup=matched_treated, **{MATCH_WEIGHT: 1.0})
+        control_frame = complete.iloc[control_rows].assign(
+            MatchGroup=treated_rows, **{MATCH_WEIGHT: 1.0 / matches[treated_rows]}
+        )
+        matched = pd.concat([treated_frame, control_frame], ignore_index=True)
+
+        balance = balance_table(complete, matched, levels, covariates)
+        summary = {
+            'treated': int(treated.sum()),
+            'treated_matched': len(matched_treated),
+            'controls': int((~treated).sum()),
+            'controls_used': len(np.unique(control_rows)),
+            'neighbors': neighbors,
+            'caliper_logit': float(width),
+            'mean_distance': float(distances.mean()) if len(distances) else np.nan,
+            'max_abs_smd_before': float(balance['smd_before'].abs().max()),
+            'max_abs_smd_after': float(balance['smd_after'].abs().max()),
+        }
+        logging.info(f"Matched {summary['treated_matched']} of {summary['treated']} treated patients to "
+                     f"{summary['controls_used']} distinct controls (1:{neighbors}, caliper {width:.4f} on the logit)")
+        logging.info(f"Max |SMD| {summary['max_abs_smd_before']:.3f} before, {summary['max_abs_smd_after']:.3f} after; "
+                     f"{int((balance['smd_after'].abs() > BALANCE_THRESHOLD).sum())} covariates above {BALANCE_THRESHOLD}")
+        return matched, {'balance': balance, 'summary': summary}
+    except Exception as e:
+        logging.error(f"Error in match_patients: {e}")
+        raise
+
+def matched_effect(values, treated, weights, patients):
+    # Effect on the treated from a matched frame: the treated mean minus the
+    # MatchWeight-weighted control mean. A control matched several times is
+    # one patient with the summed weight K, and adds K^2 (not K) times its
+    # variance, so reused controls do not count as independent patients.
+    present = ~np.isnan(values)
+    t, c = present & treated, present & ~treated
+    y_t, y_c, w = values[t], values[c], weights[c]
+    if len(y_t) < 2 or w.sum() <= 0:
+        return None
+    mean_t = y_t.mean()
+    mean_c = np.average(y_c, weights=w)
+    _, codes = np.unique(patients[c], return_inverse=True)
+    k = np.bincount(codes, weights=w)
+    var_c = np.average((y_c - mean_c) ** 2, weights=w)
+    se = np.sqrt(y_t.var(ddof=1) / len(y_t) + var_c * (k ** 2).sum() / w.sum() ** 2)
+    z = (mean_t - mean_c) / se if se > 0 else np.nan
+    return {
+        'n_treatment': len(y_t),
+        'n_control_rows': len(y_c),
+        'n_control_patients': len(k),
+        'mean_treatment': mean_t,
+        'mean_control': mean_c,
+        'effect': mean_t - mean_c,
+        'se': se,
+        'z': z,
+        'p_value': 2 * stats.norm.sf(abs(z)) if se > 0 else np.nan,
+    }
+
+def matched_effects(matched, outcomes=MATCHED_OUTCOMES):
+    treated = matched[TREATMENT].to_numpy(dtype=bool)
+    weights = matched[MATCH_WEIGHT].to_numpy(dtype=float)
+    patients = matched['PatientID'].astype(str).to_numpy()
+    rows = []
+    for outcome in outcomes:
+        if outcome not in matched:
+            continue
+        values = pd.to_numeric(matched[outcome]).to_numpy(dtype=float, na_value=np.nan)
+        effect = matched_effect(values, treated, weights, patients)
+        if effect is not None:
+            rows.append({'outcome': outcome, **effect})
+    return pd.DataFrame(rows)
+
+def reused_control_rows(matched):
+    # Control rows beyond the first of each control patient
+    controls = matched.loc[~matched[TREATMENT].to_numpy(dtype=bool), 'PatientID']
+    return int(controls.duplicated().sum()), len(controls)
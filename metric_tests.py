@@ -0,0 +1,113 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from stat_tests import adjust_pvalues, moments, proportion_ztest, welch_ttest
+from tracing import traced
+
+DEFAULT_METRICS = ['IsReadmission', 'Satisfaction', 'CareQuality', 'CommunicationRating', 'WouldRecommend',
+                   'DaysToReadmission']
+
+# 'any': every enrolled patient against those not enrolled;
+# 'program': each ProgramType on its own against those not enrolled
+ARM_DEFINITIONS = ['any', 'program']
+CONTROL = 'Not enrolled'
+ANY_PROGRAM = 'Any program'
+UNSPECIFIED_PROGRAM = 'Unspecified program'
+
+def arm_cells(df):
+    # Disjoint cells: not enrolled, then one per ProgramType. Every arm is a union of cells.
+    enrolled = df['EnrolledInProgram'].fillna(False).astype(bool).to_numpy()
+    program = df['ProgramType'].astype(object) if 'ProgramType' in df else pd.Series(None, index=df.index)
+    labels = np.where(enrolled, program.fillna(UNSPECIFIED_PROGRAM).to_numpy(), CONTROL)
+    codes, cells = pd.factorize(labels, sort=True)
+    return codes, list(cells)
+
+def cell_statistics(df, metrics, codes, size):
+    # One grouped pass per metric: count, sum and sum of squares of every cell.
+    # Missing values are left out of that metric only.
+    shape = (size, len(metrics))
+    n, total, sumsq = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    for j, metric in enumerate(metrics):
+        values = pd.to_numeric(df[metric]).to_numpy(dtype=float, na_value=np.nan)
+        present = ~np.isnan(values)
+        x = np.where(present, values, 0.0)
+        n[:, j] = np.bincount(codes, weights=present, minlength=size)
+        total[:, j] = np.bincount(codes, weights=x, minlength=size)
+        sumsq[:, j] = np.bincount(codes, weights=x * x, minlength=size)
+    return n, total, sumsq
+
+def arm_membership(cells, definitions):
+    # Rows: (definition, arm, cell mask). Sufficient statistics add up, so an
+    # arm's statistics are the sums over its cells.
+    treated = np.array([cell != CONTROL for cell in cells])
+    arms = []
+    for definition in definitions:
+        if definition == 'any':
+            arms.append((definition, ANY_PROGRAM, treated))
+        elif definition == 'program':
+            arms.extend((definition, cell, np.array(cells) == cell) for cell in cells if cell != CONTROL)
+        else:
+            raise ValueError(f"Unknown arm definition: {definition}")
+    return arms
+
+def metric_comparisons(df, metrics, definitions=ARM_DEFINITIONS):
+    codes, cells = arm_cells(df)
+    if CONTROL not in cells:
+        raise ValueError("No patients outside the program. Cannot perform analysis.")
+    n, total, sumsq = cell_statistics(df, metrics, codes, len(cells))
+    arms = arm_membership(cells, definitions)
+    if not arms:
+        raise ValueError("No treatment arms to compare.")
+
+    # (arms x metrics) arrays; every comparison is tested at once
+    weights = np.array([mask for _, _, mask in arms], dtype=float)
+    control = cells.index(CONTROL)
+    n_t, sum_t, sumsq_t = weights @ n, weights @ total, weights @ sumsq
+    n_c, sum_c, sumsq_c = n[control], total[control], sumsq[control]
+    mean_t, var_t = moments(n_t, sum_t, sumsq_t)
+    mean_c, var_c = moments(n_c, sum_c, sumsq_c)
+
+    binary = np.array([pd.api.types.is_bool_dtype(df[metric]) for metric in metrics])
+    t, _, p_welch = welch_ttest(mean_t, var_t, n_t, mean_c, var_c, n_c)
+    z, p_z = proportion_ztest(sum_t, n_t, sum_c, n_c)
+
+    shape = mean_t.shape
+    return pd.DataFrame({
+        'definition': np.repeat([d for d, _, _ in arms], len(metrics)),
+        'arm': np.repeat([a for _, a, _ in arms], len(metrics)),
+        'metric': np.tile(metrics, len(arms)),
+        'test': np.tile(np.where(binary, 'z', 'welch'), len(arms)),
+        'n_treatment': n_t.ravel().astype(np.int64),
+        'n_control': np.broadcast_to(n_c, shape).ravel().astype(np.int64),
+        'mean_treatment': mean_t.ravel(),
+        'mean_control': np.broadcast_to(mean_c, shape).ravel(),
+        'difference': (mean_t - mean_c).ravel(),
+        'statistic': np.where(binary, z, t).ravel(),
+        'p_value': np.where(binary, p_z, p_welch).ravel(),
+    })
+
+@traced()
+def analyze_metrics(df, metrics=None, definitions=ARM_DEFINITIONS, method='fdr_bh', alpha=0.05):
+    try:
+        if metrics is None:
+            metrics = [metric for metric in DEFAULT_METRICS if metric in df]
+        missing = [metric for metric in metrics if metric not in df]
+        if missing:
+            raise ValueError(f"Unknown metrics: {missing}")
+
+        table = metric_comparisons(df, list(metrics), definitions)
+        table['p_adjusted'] = adjust_pvalues(table['p_value'].to_numpy(), method)
+        table['significant'] = table['p_adjusted'] < alpha
+
+        logging.info(f"Metric tests: {len(table)} comparisons ({len(metrics)} metrics x "
+                     f"{len(table) // max(len(metrics), 1)} arms), {int(table['significant'].sum())} "
+                     f"significant after {method} correction")
+        for row in table[table['significant']].itertuples(index=False):
+            logging.info(f"{row.arm} vs {CONTROL}, {row.metric}: {row.mean_treatment:.4f} vs {row.mean_control:.4f} "
+                         f"({row.test} p={row.p_value:.4g}, adjusted {row.p_adjusted:.4g})")
+        return table
+    except Exception as e:
+        logging.error(f"Error in analyze_metrics: {e}")
+        raise
@@ -0,0 +1,111 @@
+import numpy as np
+from scipy import stats
+
+# Array versions of the tests analysis.py runs one at a time through scipy.
+# Every function takes equal-length arrays and tests all elements at once.
+
+FISHER_BATCH_BYTES = 64 * 1024 ** 2
+
+def chi2_2x2(a, b, c, d, correction=True):
+    # Table [[a, b], [c, d]]; matches scipy.stats.chi2_contingency, including
+    # Yates' continuity correction
+    a, b, c, d = (np.asarray(x, dtype=float) for x in (a, b, c, d))
+    n = a + b + c + d
+    margins = (a + b) * (c + d) * (a + c) * (b + d)
+    diff = np.abs(a * d - b * c)
+    if correction:
+        diff = np.maximum(diff - n / 2, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chi2 = np.where(margins > 0, n * diff ** 2 / margins, np.nan)
+    return chi2, stats.chi2.sf(chi2, 1)
+
+def expected_min_2x2(a, b, c, d):
+    a, b, c, d = (np.asarray(x, dtype=float) for x in (a, b, c, d))
+    n = a + b + c + d
+    rows = np.minimum(a + b, c + d)
+    cols = np.minimum(a + c, b + d)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(n > 0, rows * cols / n, np.nan)
+
+def fisher_2x2(a, b, c, d):
+    # Two-sided Fisher exact test, matching scipy.stats.fisher_exact: sums the
+    # hypergeometric probabilities of all tables no more likely than the one observed
+    a, b, c, d = (np.asarray(x, dtype=np.int64) for x in (a, b, c, d))
+    p = np.full(a.shape, np.nan)
+    if a.size == 0:
+        return p
+    n = a + b + c + d
+    row = a + b
+    col = a + c
+    lo = np.maximum(0, row + col - n)
+    hi = np.minimum(row, col)
+    width = int((hi - lo).max()) + 1
+
+    # Tables are evaluated as a padded (cells x support) matrix, in batches
+    batch = max(1, FISHER_BATCH_BYTES // (8 * width * 4))
+    for start in range(0, a.size, batch):
+        s = slice(start, start + batch)
+        k = lo[s, None] + np.arange(width)[None, :]
+        valid = k <= hi[s, None]
+        logpmf = stats.hypergeom.logpmf(np.where(valid, k, lo[s, None]), n[s, None], col[s, None], row[s, None])
+        observed = stats.hypergeom.logpmf(a[s], n[s], col[s], row[s])
+        keep = valid & (logpmf <= observed[:, None] + np.log1p(1e-7))
+        p[s] = np.minimum(np.where(keep, np.exp(logpmf), 0).sum(axis=1), 1.0)
+    p[n == 0] = np.nan
+    return p
+
+def adjust_pvalues(p_values, method='fdr_bh'):
+    p = np.asarray(p_values, dtype=float)
+    adjusted = np.full(p.shape, np.nan)
+    mask = ~np.isnan(p)
+    pv = p[mask]
+    m = pv.size
+    if m == 0:
+        return adjusted
+
+    if method == 'bonferroni':
+        result = np.minimum(pv * m, 1.0)
+    elif method == 'holm':
+        order = np.argsort(pv)
+        stepped = np.maximum.accumulate(pv[order] * (m - np.arange(m)))
+        result = np.empty(m)
+        result[order] = np.minimum(stepped, 1.0)
+    elif method == 'fdr_bh':
+        order = np.argsort(pv)[::-1]
+        stepped = np.minimum.accumulate(pv[order] * m / np.arange(m, 0, -1))
+        result = np.empty(m)
+        result[order] = np.minimum(stepped, 1.0)
+    else:
+        raise ValueError(f"Unknown p-value adjustment method: {method}")
+
+    adjusted[mask] = result
+    return adjusted
+
+def moments(n, total, sumsq):
+    # Mean and sample variance from the count, sum and sum of squares
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / n
+        variance = np.maximum(sumsq - total * mean, 0) / (n - 1)
+    return mean, variance
+
+def welch_ttest(mean1, var1, n1, mean2, var2, n2):
+    # Unequal-variance t-test from summary statistics, matching
+    # scipy.stats.ttest_ind_from_stats(..., equal_var=False)
+    mean1, var1, n1, mean2, var2, n2 = (np.asarray(x, dtype=float) for x in (mean1, var1, n1, mean2, var2, n2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        se1 = var1 / n1
+        se2 = var2 / n2
+        t = (mean1 - mean2) / np.sqrt(se1 + se2)
+        df = (se1 + se2) ** 2 / (se1 ** 2 / (n1 - 1) + se2 ** 2 / (n2 - 1))
+    p = 2 * stats.t.sf(np.abs(t), df)
+    return t, df, p
+
+def proportion_ztest(x1, n1, x2, n2):
+    # Two-sided two-proportion z-test with the pooled proportion under H0
+    x1, n1, x2, n2 = (np.asarray(x, dtype=float) for x in (x1, n1, x2, n2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pooled = (x1 + x2) / (n1 + n2)
+        se = np.sqrt(pooled * (1 - pooled) * (1 / n1 + 1 / n2))
+        z = (x1 / n1 - x2 / n2) / se
+    p = 2 * stats.norm.sf(np.abs(z))
+    return z, p
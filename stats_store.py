@@ -0,0 +1,396 @@
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.integrate import trapezoid
+from scipy.optimize import brentq
+
+from database_utils import execute_query
+from stat_tests import adjust_pvalues, moments
+from tracing import traced
+
+# Persistent, mergeable sufficient statistics for continuous monitoring. The
+# store keeps count, sum and sum of squares of every metric per (arm,
+# ChronicCondition) cell. Those add up, so a daily update only aggregates the
+# visits and surveys that arrived since the last one, and overall or per-arm
+# figures are sums of cells.
+#
+# The units are admissions and survey responses rather than patients: a
+# patient-level flag (readmitted at least once) cannot be updated without
+# per-patient state, a per-admission one can. A new admission is a
+# readmission when it starts at most `window` days after the patient's
+# previous discharge, the same rule as episodes.py. Visits are assumed to
+# arrive in admission order per patient.
+
+DEFAULT_STORE = 'stats_store.json'
+STORE_VERSION = 1
+DEFAULT_WINDOW = 30
+OVERALL = 'All'
+
+# Rows arrive with increasing numeric IDs (V00001, R0001, ...). The IDs are
+# zero-padded to a minimum width only, so they are compared as numbers.
+# create_tables indexes these expressions on Postgres.
+VISIT_SEQUENCE = "CAST(SUBSTR(VisitID, 2) AS BIGINT)"
+SURVEY_SEQUENCE = "CAST(SUBSTR(ResponseID, 2) AS BIGINT)"
+
+WATERMARK_QUERY = f"""
+    SELECT
+        (SELECT MAX({VISIT_SEQUENCE}) FROM hospital_visits) AS hospital_visits,
+        (SELECT MAX({SURVEY_SEQUENCE}) FROM survey_responses) AS survey_responses
+    """
+
+# Every lookup is per new row and index-backed: the patient's arm, their
+# condition, and (LATERAL) the discharge of their previous visit
+VISIT_STATISTICS_QUERY = f"""
+    WITH new_visits AS (
+        SELECT PatientID, AdmissionDate
+        FROM hospital_visits
+        WHERE {VISIT_SEQUENCE} > %(after)s AND {VISIT_SEQUENCE} <= %(upto)s
+    ),
+    visit_gaps AS (
+        SELECT
+            (SELECT BOOL_OR(pe.EnrolledInProgram) FROM program_enrollment pe
+             WHERE pe.PatientID = nv.PatientID) AS arm,
+            p.ChronicCondition AS subgroup,
+            nv.AdmissionDate - prev.DischargeDate AS gap
+        FROM new_visits nv
+        JOIN patients p ON p.PatientID = nv.PatientID
+        LEFT JOIN LATERAL (
+            SELECT hv.DischargeDate
+            FROM hospital_visits hv
+            WHERE hv.PatientID = nv.PatientID AND hv.AdmissionDate < nv.AdmissionDate
+            ORDER BY hv.AdmissionDate DESC
+            LIMIT 1
+        ) prev ON TRUE
+    ),
+    flagged AS (
+        SELECT arm, subgroup, gap, gap BETWEEN 0 AND %(window)s AS readmitted
+        FROM visit_gaps
+    )
+    SELECT
+        arm AS "arm",
+        subgroup AS "subgroup",
+        COUNT(*) AS readmission_n,
+        COUNT(*) FILTER (WHERE readmitted) AS readmission_sum,
+        COUNT(*) FILTER (WHERE readmitted) AS readmission_sumsq,
+        COUNT(*) FILTER (WHERE readmitted) AS days_n,
+        SUM(gap) FILTER (WHERE readmitted)::float8 AS days_sum,
+        SUM(gap::float8 * gap) FILTER (WHERE readmitted)::float8 AS days_sumsq
+    FROM flagged
+    WHERE arm IS NOT NULL
+    GROUP BY arm, subgroup
+    """
+
+SURVEY_STATISTICS_QUERY = f"""
+    WITH new_surveys AS (
+        SELECT
+            PatientID,
+            Satisfaction,
+            CareQuality,
+            CommunicationRating,
+            CASE WHEN Recommendation = 'Yes' THEN 1 ELSE 0 END AS WouldRecommend
+        FROM survey_responses
+        WHERE {SURVEY_SEQUENCE} > %(after)s AND {SURVEY_SEQUENCE} <= %(upto)s
+    ),
+    surveys AS (
+        SELECT
+            (SELECT BOOL_OR(pe.EnrolledInProgram) FROM program_enrollment pe
+             WHERE pe.PatientID = ns.PatientID) AS arm,
+            p.ChronicCondition AS subgroup,
+            ns.*
+        FROM new_surveys ns
+        JOIN patients p ON p.PatientID = ns.PatientID
+    )
+    SELECT
+        arm AS "arm",
+        subgroup AS "subgroup",
+        COUNT(Satisfaction) AS satisfaction_n,
+        SUM(Satisfaction)::float8 AS satisfaction_sum,
+        SUM(Satisfaction::float8 * Satisfaction)::float8 AS satisfaction_sumsq,
+        COUNT(CareQuality) AS care_quality_n,
+        SUM(CareQuality)::float8 AS care_quality_sum,
+        SUM(CareQuality::float8 * CareQuality)::float8 AS care_quality_sumsq,
+        COUNT(CommunicationRating) AS communication_n,
+        SUM(CommunicationRating)::float8 AS communication_sum,
+        SUM(CommunicationRating::float8 * CommunicationRating)::float8 AS communication_sumsq,
+        COUNT(*) AS would_recommend_n,
+        SUM(WouldRecommend)::float8 AS would_recommend_sum,
+        SUM(WouldRecommend)::float8 AS would_recommend_sumsq
+    FROM surveys
+    WHERE arm IS NOT NULL
+    GROUP BY arm, subgroup
+    """
+
+# Binary metrics are 0/1, so their sum of squares equals their sum
+METRICS = ['readmission', 'days', 'satisfaction', 'care_quality', 'communication', 'would_recommend']
+CELL_COLUMNS = ['arm', 'subgroup', 'metric', 'n', 'sum', 'sumsq']
+
+# Sequential testing. The mSPRT mixes over effects N(0, tau^2), with tau in
+# standard deviations of the metric; its always-valid p-values stay valid
+# however often they are looked at. Alpha spending (Lan-DeMets, O'Brien-
+# Fleming type) needs the planned sample size of a metric.
+DEFAULT_ALPHA = 0.05
+DEFAULT_MIXING_SD = 0.1
+GRID_POINTS = 401
+# Boundaries beyond this many standard deviations hold no probability to speak of
+MAX_BOUNDARY = 8.0
+
+def empty_store(window=DEFAULT_WINDOW):
+    return {
+        'version': STORE_VERSION,
+        'window': window,
+        'watermarks': {'hospital_visits': 0, 'survey_responses': 0},
+        'cells': [],
+        'sequential': {},
+        'looks': [],
+    }
+
+def load_store(path=DEFAULT_STORE, window=DEFAULT_WINDOW):
+    if not os.path.exists(path):
+        logging.info(f"No statistics store at {path}; starting a new one")
+        return empty_store(window)
+    with open(path) as f:
+        store = json.load(f)
+    if store.get('version') != STORE_VERSION:
+        raise ValueError(f"{path} has store version {store.get('version')}, expected {STORE_VERSION}")
+    if store['window'] != window:
+        raise ValueError(f"{path} counts {store['window']}-day readmissions, not {window}-day; use another store")
+    return store
+
+def save_store(store, path=DEFAULT_STORE):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(store, f, indent=1)
+    os.replace(tmp_path, path)
+    logging.info(f"Wrote {path}")
+
+def cells_frame(cells):
+    df = pd.DataFrame(cells, columns=CELL_COLUMNS)
+    df['arm'] = df['arm'].astype(bool)
+    return df
+
+def cell_record(arm, subgroup, metric, n, total, sumsq):
+    return {
+        'arm': bool(arm),
+        'subgroup': subgroup if pd.notna(subgroup) and subgroup != '' else None,
+        'metric': metric,
+        'n': int(n),
+        'sum': float(np.nan_to_num(total)),
+        'sumsq': float(np.nan_to_num(sumsq)),
+    }
+
+def merge_cells(*cell_lists):
+    # Cells with the same (arm, subgroup, metric) add up
+    df = cells_frame([cell for cells in cell_lists for cell in cells])
+    # groupby drops None keys; patients without a condition still count overall
+    df['subgroup'] = df['subgroup'].fillna('')
+    merged = df.groupby(['arm', 'subgroup', 'metric'], as_index=False)[['n', 'sum', 'sumsq']].sum()
+    return [cell_record(*row) for row in merged.itertuples(index=False)]
+
+def merge_stores(stores):
+    # For stores built over disjoint ID ranges, e.g. a backfill split in parts.
+    # Sequential-test state is not merged; the merged store starts a new sequence.
+    windows = {store['window'] for store in stores}
+    if len(windows) != 1:
+        raise ValueError(f"Cannot merge stores with different readmission windows: {sorted(windows)}")
+    merged = empty_store(windows.pop())
+    merged['cells'] = merge_cells(*(store['cells'] for store in stores))
+    for table in merged['watermarks']:
+        merged['watermarks'][table] = max(store['watermarks'][table] for store in stores)
+    return merged
+
+def long_cells(wide):
+    # One row per (arm, subgroup) with <metric>_n/_sum/_sumsq columns -> cell records
+    return [
+        cell_record(row['arm'], row['subgroup'], metric, row[f'{metric}_n'], row[f'{metric}_sum'],
+                    row[f'{metric}_sumsq'])
+        for row in wide.to_dict('records') for metric in METRICS if f'{metric}_n' in row
+    ]
+
+def current_watermarks():
+    row = execute_query(WATERMARK_QUERY).iloc[0]
+    return {table: int(np.nan_to_num(row[table])) for table in ('hospital_visits', 'survey_responses')}
+
+@traced()
+def update_store(store):
+    # Aggregates the rows with IDs in (stored watermark, current maximum]; rows
+    # inserted while this runs are left for the next update
+    try:
+        upto = current_watermarks()
+        after = store['watermarks']
+        new_cells = []
+        for table, query in [('hospital_visits', VISIT_STATISTICS_QUERY), ('survey_responses', SURVEY_STATISTICS_QUERY)]:
+            if upto[table] <= after[table]:
+                continue
+            params = {'after': after[table], 'upto': upto[table]}
+            if table == 'hospital_visits':
+                params['window'] = store['window']
+            new_cells += long_cells(execute_query(query, params))
+        # Every visit counts towards readmission and every survey towards would_recommend
+        new_rows = {
+            'hospital_visits': sum(cell['n'] for cell in new_cells if cell['metric'] == 'readmission'),
+            'survey_responses': sum(cell['n'] for cell in new_cells if cell['metric'] == 'would_recommend'),
+        }
+        store['cells'] = merge_cells(store['cells'], new_cells)
+        store['watermarks'] = {table: max(upto[table], after[table]) for table in upto}
+        logging.info(f"Statistics store updated with IDs up to {store['watermarks']} "
+                     f"({new_rows['hospital_visits']} new visits, {new_rows['survey_responses']} new surveys)")
+        return new_rows
+    except Exception as e:
+        logging.error(f"Error updating the statistics store: {e}")
+        raise
+
+def arm_statistics(cells):
+    # (subgroup, metric) rows with control and treatment columns; the
+    # OVERALL subgroup is the sum over all conditions
+    df = cells_frame(cells)
+    overall = df.groupby(['arm', 'metric'], as_index=False)[['n', 'sum', 'sumsq']].sum().assign(subgroup=OVERALL)
+    df = pd.concat([overall, df.dropna(subset=['subgroup'])], ignore_index=True)
+    wide = df.pivot_table(index=['subgroup', 'metric'], columns='arm', values=['n', 'sum', 'sumsq'],
+                          aggfunc='sum', fill_value=0)
+    table = pd.DataFrame(index=wide.index)
+    for arm, label in [(False, 'control'), (True, 'treatment')]:
+        for column in ['n', 'sum', 'sumsq']:
+            table[f'{column}_{label}'] = wide[(column, arm)] if (column, arm) in wide else 0.0
+    return table.reset_index()
+
+def msprt_log_likelihood_ratio(difference, variance, tau2):
+    # Normal-mixture SPRT for a difference in means (Johari et al.): with
+    # V = var(difference), log L = 1/2 log(V / (V + tau2)) + tau2 d^2 / (2 V (V + tau2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 0.5 * np.log(variance / (variance + tau2)) + tau2 * difference ** 2 / (2 * variance * (variance + tau2))
+
+def obrien_fleming_spent(t, alpha=DEFAULT_ALPHA):
+    # Lan-DeMets O'Brien-Fleming-type spending function, two-sided
+    t = np.clip(t, 1e-12, 1.0)
+    return 2 * stats.norm.sf(stats.norm.isf(alpha / 2) / np.sqrt(t))
+
+def continuation_density(times, boundaries):
+    # Density of the score process S(t) = Z(t) sqrt(t) at the last look, over
+    # the paths that crossed no earlier boundary (Armitage-McPherson-Rowe recursion)
+    edge = min(boundaries[0], MAX_BOUNDARY) * np.sqrt(times[0])
+    grid = np.linspace(-edge, edge, GRID_POINTS)
+    density = stats.norm.pdf(grid, scale=np.sqrt(times[0]))
+    for previous, t, boundary in zip(times[:-1], times[1:], boundaries[1:]):
+        sd = np.sqrt(t - previous)
+        edge = min(boundary, MAX_BOUNDARY) * np.sqrt(t)
+        next_grid = np.linspace(-edge, edge, GRID_POINTS)
+        kernel = stats.norm.pdf((next_grid[:, None] - grid[None, :]) / sd) / sd
+        density = trapezoid(kernel * density[None, :], grid, axis=1)
+        grid = next_grid
+    return grid, density
+
+def spending_boundary(times, boundaries, t, alpha=DEFAULT_ALPHA):
+    # |Z| boundary at information fraction t, given the earlier looks: the
+    # crossing probability under H0 equals the alpha spent since the last look
+    spent = obrien_fleming_spent(t, alpha) - (obrien_fleming_spent(times[-1], alpha) if times else 0.0)
+    if spent <= 0:
+        return np.inf
+    if not times:
+        return float(stats.norm.isf(spent / 2))
+    grid, density = continuation_density(times, boundaries)
+    sd = np.sqrt(t - times[-1])
+
+    def excess(boundary):
+        edge = boundary * np.sqrt(t)
+        crossing = stats.norm.sf((edge - grid) / sd) + stats.norm.cdf((-edge - grid) / sd)
+        return trapezoid(density * crossing, grid) - spent
+
+    if excess(MAX_BOUNDARY) >= 0:
+        return MAX_BOUNDARY
+    return float(brentq(excess, 0.0, MAX_BOUNDARY))
+
+def sequential_key(subgroup, metric):
+    return f'{subgroup}|{metric}'
+
+def sequential_tests(store, alpha=DEFAULT_ALPHA, mixing_sd=DEFAULT_MIXING_SD, planned=None, record=True,
+                     method='fdr_bh'):
+    # planned: {metric: total planned units (both arms)} for alpha spending on
+    # the OVERALL rows. record=False evaluates the look without storing it.
+    planned = planned or {}
+    table = arm_statistics(store['cells'])
+    mean_c, var_c = moments(table['n_control'], table['sum_control'], table['sumsq_control'])
+    mean_t, var_t = moments(table['n_treatment'], table['sum_treatment'], table['sumsq_treatment'])
+    n = table['n_control'] + table['n_treatment']
+    variance = var_t / table['n_treatment'] + var_c / table['n_control']
+    pooled = ((table['n_control'] - 1) * var_c + (table['n_treatment'] - 1) * var_t) / (n - 2)
+    difference = mean_t - mean_c
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = difference / np.sqrt(variance)
+    log_lr = msprt_log_likelihood_ratio(difference, variance, mixing_sd ** 2 * pooled)
+
+    state = store['sequential']
+    always_valid, information, boundary = [], [], []
+    for i, (subgroup, metric) in enumerate(zip(table['subgroup'], table['metric'])):
+        entry = state.setdefault(sequential_key(subgroup, metric), {'p_value': 1.0, 'times': [], 'boundaries': []})
+        # Running minimum of 1 / likelihood ratio over all looks so far
+        p = min(entry['p_value'], float(np.exp(min(0.0, -log_lr[i])))) if np.isfinite(log_lr[i]) else entry['p_value']
+        always_valid.append(p)
+        t, b = np.nan, np.nan
+        if subgroup == OVERALL and metric in planned:
+            t = min(float(n[i]) / planned[metric], 1.0)
+            if entry['times'] and t <= entry['times'][-1]:
+                # No new information since the last look: no alpha is spent
+                b = entry['boundaries'][-1]
+            else:
+                b = spending_boundary(entry['times'], entry['boundaries'], t, alpha)
+                if record:
+                    entry['times'].append(t)
+                    entry['boundaries'].append(b)
+        information.append(t)
+        boundary.append(b)
+        if record:
+            entry['p_value'] = p
+
+    result = pd.DataFrame({
+        'subgroup': table['subgroup'],
+        'metric': table['metric'],
+        'n_control': table['n_control'].astype(np.int64),
+        'n_treatment': table['n_treatment'].astype(np.int64),
+        'mean_control': mean_c,
+        'mean_treatment': mean_t,
+        'difference': difference,
+        'z': z,
+        'always_valid_p': always_valid,
+        'information': information,
+        'boundary': boundary,
+    })
+    result['p_adjusted'] = adjust_pvalues(result['always_valid_p'].to_numpy(), method)
+    result['significant'] = result['p_adjusted'] < alpha
+    result['crossed'] = np.abs(result['z']) >= result['boundary']
+    if record:
+        store['looks'].append({'time': time.time(), 'watermarks': dict(store['watermarks'])})
+    return result
+
+@traced()
+def monitor(path=DEFAULT_STORE, window=DEFAULT_WINDOW, alpha=DEFAULT_ALPHA, mixing_sd=DEFAULT_MIXING_SD,
+            planned=None, update=True):
+    # The daily check: fold in the new rows, test, and persist the store
+    try:
+        store = load_store(path, window)
+        if update:
+            update_store(store)
+        if not store['cells']:
+            raise ValueError("The statistics store is empty; nothing to test.")
+        table = sequential_tests(store, alpha, mixing_sd, planned)
+        save_store(store, path)
+
+        for row in table[table['subgroup'] == OVERALL].itertuples(index=False):
+            stop = ''
+            if np.isfinite(row.boundary):
+                stop = f", |z| boundary {row.boundary:.3f} at {row.information:.0%} information"
+            logging.info(f"{row.metric}: {row.mean_treatment:.4f} vs {row.mean_control:.4f} "
+                         f"(z={row.z:.3f}, always-valid p={row.always_valid_p:.4g}{stop})")
+        logging.info(f"{int(table['significant'].sum())} of {len(table)} comparisons significant after "
+                     f"{len(store['looks'])} looks; {int(table['crossed'].sum())} crossed a spending boundary")
+        return table
+    except Exception as e:
+        logging.error(f"Error in monitor: {e}")
+        raise
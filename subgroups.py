@@ -0,0 +1,144 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from matching import MATCH_WEIGHT, matched_effect
+from stat_tests import adjust_pvalues, chi2_2x2, expected_min_2x2, fisher_2x2
+from tracing import traced
+
+AGE_BAND_EDGES = [0, 35, 50, 65, np.inf]
+AGE_BAND_LABELS = ['18-34', '35-49', '50-64', '65+']
+
+DEFAULT_DIMENSIONS = ['ChronicCondition']
+
+# Cells whose smallest expected count is below this use Fisher's exact test
+FISHER_THRESHOLD = 5
+
+def add_age_band(df):
+    df = df.copy()
+    df['AgeBand'] = pd.cut(df['Age'], AGE_BAND_EDGES, labels=AGE_BAND_LABELS, right=False)
+    return df
+
+def dimension_codes(series):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy(), series.cat.categories
+    codes, uniques = pd.factorize(series, sort=True)
+    return codes, uniques
+
+def subgroup_table(df, dimensions=DEFAULT_DIMENSIONS):
+    if 'AgeBand' in dimensions and 'AgeBand' not in df:
+        df = add_age_band(df)
+
+    arm = df['EnrolledInProgram']
+    keep = arm.notna().to_numpy()
+    codes, uniques = [], []
+    for dimension in dimensions:
+        c, u = dimension_codes(df[dimension])
+        codes.append(c)
+        uniques.append(u)
+        keep = keep & (c >= 0)
+
+    # One pass: every (cell, arm) pair maps to a single bincount slot
+    shape = tuple(len(u) for u in uniques)
+    cell = np.ravel_multi_index([c[keep] for c in codes], shape)
+    slot = cell * 2 + arm.to_numpy()[keep].astype(np.int64)
+    size = 2 * int(np.prod(shape))
+    counts = np.bincount(slot, minlength=size).reshape(-1, 2)
+    readmissions = np.bincount(
+        slot, weights=df['IsReadmission'].to_numpy()[keep].astype(float), minlength=size
+    ).reshape(-1, 2)
+
+    present = np.flatnonzero(counts.sum(axis=1))
+    index = np.unravel_index(present, shape)
+    table = pd.DataFrame({
+        dimension: np.asarray(u)[i] for dimension, u, i in zip(dimensions, uniques, index)
+    })
+    table['n_control'] = counts[present, 0]
+    table['readmissions_control'] = readmissions[present, 0].astype(np.int64)
+    table['n_treatment'] = counts[present, 1]
+    table['readmissions_treatment'] = readmissions[present, 1].astype(np.int64)
+    return add_rates(table)
+
+def subgroup_table_from_counts(counts, dimensions=DEFAULT_DIMENSIONS):
+    # counts: one row per (dimensions, EnrolledInProgram) with n and readmissions,
+    # e.g. the subgroup rows of data_loading.load_arm_statistics
+    wide = counts.pivot_table(index=dimensions, columns='EnrolledInProgram', values=['n', 'readmissions'],
+                              aggfunc='sum', fill_value=0)
+    table = wide.index.to_frame(index=False)
+    for arm, suffix in [(False, 'control'), (True, 'treatment')]:
+        for value in ['n', 'readmissions']:
+            column = wide.get((value, arm))
+            table[f'{value}_{suffix}'] = 0 if column is None else column.to_numpy().astype(np.int64)
+    return add_rates(table)
+
+def matched_subgroup_table(df, dimensions=DEFAULT_DIMENSIONS):
+    # A matched cohort (matching.match_patients): a control counts in the cell
+    # of the treated patient it was matched to, weighted by MatchWeight, and
+    # each cell is tested with the matched effect and its K^2 variance
+    if 'AgeBand' in dimensions and 'AgeBand' not in df:
+        df = add_age_band(df)
+
+    treated = df['EnrolledInProgram'].to_numpy(dtype=bool)
+    cells = df.loc[treated].set_index('MatchGroup')[dimensions].loc[df['MatchGroup']].reset_index(drop=True)
+    values = pd.to_numeric(df['IsReadmission']).to_numpy(dtype=float, na_value=np.nan)
+    weights = df[MATCH_WEIGHT].to_numpy(dtype=float)
+    patients = df['PatientID'].astype(str).to_numpy()
+
+    rows = []
+    for key, index in cells.groupby(dimensions, observed=True, sort=True).indices.items():
+        effect = matched_effect(values[index], treated[index], weights[index], patients[index])
+        if effect is None:
+            continue
+        key = key if isinstance(key, tuple) else (key,)
+        rows.append({
+            **dict(zip(dimensions, key)),
+            'n_control': effect['n_control_patients'],
+            'n_treatment': effect['n_treatment'],
+            'control_rate': effect['mean_control'],
+            'treatment_rate': effect['mean_treatment'],
+            'z': effect['z'],
+            'test': 'matched',
+            'p_value': effect['p_value'],
+        })
+    return pd.DataFrame(rows, columns=dimensions + ['n_control', 'n_treatment', 'control_rate', 'treatment_rate',
+                                                   'z', 'test', 'p_value'])
+
+def add_rates(table):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['control_rate'] = table['readmissions_control'] / table['n_control']
+        table['treatment_rate'] = table['readmissions_treatment'] / table['n_treatment']
+    return table
+
+def subgroup_tests(table, method='fdr_bh', alpha=0.05, fisher_threshold=FISHER_THRESHOLD):
+    table = table.copy()
+    a = table['readmissions_control'].to_numpy()
+    b = table['n_control'].to_numpy() - a
+    c = table['readmissions_treatment'].to_numpy()
+    d = table['n_treatment'].to_numpy() - c
+
+    chi2, p_value = chi2_2x2(a, b, c, d)
+    small = expected_min_2x2(a, b, c, d) < fisher_threshold
+    p_value = p_value.copy()
+    p_value[small] = fisher_2x2(a[small], b[small], c[small], d[small])
+
+    table['chi2'] = chi2
+    table['test'] = np.where(small, 'fisher', 'chi2')
+    table['p_value'] = p_value
+    return add_adjusted(table, method, alpha)
+
+def add_adjusted(table, method='fdr_bh', alpha=0.05):
+    table['p_adjusted'] = adjust_pvalues(table['p_value'].to_numpy(dtype=float), method)
+    table['significant'] = table['p_adjusted'] < alpha
+    return table
+
+@traced()
+def analyze_subgroups(df, dimensions=DEFAULT_DIMENSIONS, method='fdr_bh', alpha=0.05, counts=None):
+    if counts is None and MATCH_WEIGHT in df:
+        table = add_adjusted(matched_subgroup_table(df, dimensions), method, alpha)
+    else:
+        table = subgroup_table(df, dimensions) if counts is None else subgroup_table_from_counts(counts, dimensions)
+        table = subgroup_tests(table, method, alpha)
+    logging.info(f"Subgroup analysis over {' x '.join(dimensions)}: {len(table)} cells, "
+                 f"{int(table['significant'].sum())} significant after {method} correction")
+    return table
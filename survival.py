@@ -0,0 +1,273 @@
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from adjusted import COVARIATES, TREATMENT, covariate_levels, design_matrix, design_names, solve
+from episodes import iter_patient_groups, visit_arrays
+from stat_tests import adjust_pvalues
+from tracing import traced
+
+# Time to readmission with censoring. Follow-up starts at a patient's first
+# discharge and ends at their next admission (the event) or at the study end
+# date (censored); like a window end, admissions on or after the study end are
+# not observed. Patients without visits have no index stay and no follow-up.
+DURATION = 'FollowUpDays'
+EVENT = 'ReadmissionEvent'
+STRATUM_COLUMN = 'ChronicCondition'
+OVERALL = 'All'
+ARMS = {False: 'Control', True: 'Treatment'}
+
+MAX_ITERATIONS = 25
+TOLERANCE = 1e-9
+Z_95 = stats.norm.isf(0.025)
+
+def follow_up(patient, admission, discharge, study_end):
+    # Arrays sorted by (patient, admission), as from episodes.visit_arrays;
+    # dates and study_end are day numbers. One value per patient.
+    n = len(patient)
+    if n == 0:
+        return np.empty(0, dtype=object), np.empty(0), np.empty(0, dtype=bool)
+    first = np.ones(n, dtype=bool)
+    first[1:] = patient[1:] != patient[:-1]
+    starts = np.flatnonzero(first)
+    index_discharge = discharge[starts]
+    counts = np.diff(np.append(starts, n))
+
+    # The earliest later admission starting on or after the index discharge
+    # (overlapping stays are transfers); NaN dates never qualify
+    with np.errstate(invalid='ignore'):
+        later = ~first & (admission >= np.repeat(index_discharge, counts))
+    next_admission = np.minimum.reduceat(np.where(later, admission, np.inf), starts)
+
+    with np.errstate(invalid='ignore'):
+        event = next_admission < study_end
+    duration = np.where(event, next_admission - index_discharge, study_end - index_discharge)
+    with np.errstate(invalid='ignore'):
+        valid = duration >= 0
+    return patient[starts][valid], duration[valid], event[valid]
+
+def study_end_day(study_end):
+    return float(np.datetime64(study_end, 'D').astype(np.int64))
+
+def survival_from_frame(visits, study_end):
+    patient, duration, event = follow_up(*visit_arrays(visits), study_end_day(study_end))
+    return pd.DataFrame({'PatientID': patient, DURATION: duration, EVENT: event})
+
+def survival_from_chunks(chunks, study_end):
+    parts = [survival_from_frame(visits, study_end) for visits in iter_patient_groups(chunks)]
+    if not parts:
+        return pd.DataFrame({'PatientID': pd.Series(dtype=object), DURATION: pd.Series(dtype=float),
+                             EVENT: pd.Series(dtype=bool)})
+    return pd.concat(parts, ignore_index=True)
+
+def attach_survival(df, survival):
+    # Patients without an index stay keep NaN follow-up and are left out of the survival analysis
+    df = df.drop(columns=[DURATION, EVENT], errors='ignore')
+    return df.merge(survival, on='PatientID', how='left')
+
+def event_counts(duration, event, group, n_groups):
+    # (groups x distinct times) events and exits in one bincount each, and the
+    # number at risk as a reverse cumulative sum over the sorted times
+    times, inverse = np.unique(duration, return_inverse=True)
+    slot = group * len(times) + inverse
+    size = n_groups * len(times)
+    deaths = np.bincount(slot, weights=event, minlength=size).reshape(n_groups, -1)
+    exits = np.bincount(slot, minlength=size).reshape(n_groups, -1).astype(float)
+    at_risk = np.cumsum(exits[:, ::-1], axis=1)[:, ::-1]
+    return times, deaths, at_risk
+
+def kaplan_meier(duration, event, group=None, n_groups=1):
+    # Product-limit estimate for every group at once, with Greenwood variance
+    # and log-log 95% confidence limits
+    group = np.zeros(len(duration), dtype=np.int64) if group is None else group
+    times, deaths, at_risk = event_counts(duration, event.astype(float), group, n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hazard = np.where(at_risk > 0, deaths / at_risk, 0.0)
+        survival = np.cumprod(1 - hazard, axis=1)
+        greenwood = np.cumsum(np.where(at_risk > deaths, deaths / (at_risk * (at_risk - deaths)), 0.0), axis=1)
+        log_survival = np.log(survival)
+        se_loglog = np.sqrt(greenwood) / np.abs(log_survival)
+        loglog = np.log(-log_survival)
+        lower = np.exp(-np.exp(loglog + Z_95 * se_loglog))
+        upper = np.exp(-np.exp(loglog - Z_95 * se_loglog))
+    # At S = 1 (no events yet) the limits are 1 as well
+    lower = np.where(survival >= 1, 1.0, lower)
+    upper = np.where(survival >= 1, 1.0, upper)
+    return times, survival, lower, upper, at_risk, deaths
+
+def median_survival(times, survival):
+    # First time the curve reaches 0.5; NaN when it never does
+    reached = survival <= 0.5
+    return np.where(reached.any(axis=1), times[np.argmax(reached, axis=1)], np.nan)
+
+def logrank(duration, event, treated, stratum, n_strata):
+    # Two-arm log-rank test within every stratum at once: observed minus
+    # expected treatment events and the hypergeometric variance, summed over time
+    group = stratum * 2 + treated.astype(np.int64)
+    _, deaths, at_risk = event_counts(duration, event.astype(float), group, 2 * n_strata)
+    deaths = deaths.reshape(n_strata, 2, -1)
+    at_risk = at_risk.reshape(n_strata, 2, -1)
+    total_deaths = deaths.sum(axis=1)
+    total_at_risk = at_risk.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = np.where(total_at_risk > 0, at_risk[:, 1] / total_at_risk, 0.0)
+        ties = np.where(total_at_risk > 1, (total_at_risk - total_deaths) / (total_at_risk - 1), 0.0)
+    observed = deaths[:, 1].sum(axis=1)
+    expected = (total_deaths * share).sum(axis=1)
+    variance = (total_deaths * share * (1 - share) * ties).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chi2 = np.where(variance > 0, (observed - expected) ** 2 / variance, np.nan)
+    return observed, expected, chi2, stats.chi2.sf(chi2, 1)
+
+def fit_cox(duration, event, X, max_iterations=MAX_ITERATIONS, tolerance=TOLERANCE):
+    # Cox proportional hazards, Breslow ties, Newton-Raphson. Subjects are
+    # sorted by time once; risk-set sums are reverse cumulative sums over the
+    # distinct times, and the information matrix is a single weighted X'X.
+    order = np.argsort(duration, kind='stable')
+    event = event[order].astype(float)
+    X = X[order]
+    X = X - X.mean(axis=0)
+    _, starts, counts = np.unique(duration[order], return_index=True, return_counts=True)
+    bucket = np.repeat(np.arange(len(starts)), counts)
+    deaths = np.add.reduceat(event, starts)
+    event_x = event @ X
+
+    def evaluate(beta):
+        eta = X @ beta
+        w = np.exp(eta)
+        s0 = np.cumsum(np.add.reduceat(w, starts)[::-1])[::-1]
+        s1 = np.cumsum(np.add.reduceat(w[:, None] * X, starts, axis=0)[::-1], axis=0)[::-1]
+        mean = s1 / s0[:, None]
+        loglik = event @ eta - deaths @ np.log(s0)
+        gradient = event_x - deaths @ mean
+        # Subject i is in every risk set up to its own time
+        weight = w * np.cumsum(deaths / s0)[bucket]
+        information = (X.T * weight) @ X - (mean.T * deaths) @ mean
+        return loglik, gradient, information
+
+    beta = np.zeros(X.shape[1])
+    loglik, gradient, information = evaluate(beta)
+    null_loglik = loglik
+    for iteration in range(1, max_iterations + 1):
+        step = solve(information, gradient)
+        # Step halving keeps the partial likelihood from decreasing
+        for _ in range(20):
+            candidate = evaluate(beta + step)
+            if candidate[0] >= loglik - 1e-12:
+                break
+            step = step / 2
+        beta = beta + step
+        loglik, gradient, information = candidate
+        if np.max(np.abs(step)) < tolerance:
+            break
+    else:
+        logging.warning(f"Cox model did not converge in {max_iterations} iterations")
+    return beta, np.linalg.pinv(information), loglik, null_loglik, iteration
+
+def survival_curves(duration, event, treated, stratum, strata):
+    # Long table of the step curves: overall per arm, then per stratum and arm.
+    # Patients with no stratum (code -1) only count overall.
+    arm = treated.astype(np.int64)
+    keep = stratum >= 0
+    rows = []
+    for mask, codes, names in [
+        (np.ones(len(duration), dtype=bool), arm, [(OVERALL, a) for a in (False, True)]),
+        (keep, stratum[keep] * 2 + arm[keep], [(s, a) for s in strata for a in (False, True)]),
+    ]:
+        times, survival, lower, upper, at_risk, deaths = kaplan_meier(duration[mask], event[mask], codes, len(names))
+        for g, (subgroup, a) in enumerate(names):
+            present = at_risk[g] > 0
+            rows.append(pd.DataFrame({
+                'subgroup': subgroup,
+                'arm': ARMS[a],
+                'time': times[present],
+                'at_risk': at_risk[g, present].astype(np.int64),
+                'events': deaths[g, present].astype(np.int64),
+                'survival': survival[g, present],
+                'lower': lower[g, present],
+                'upper': upper[g, present],
+            }))
+    return pd.concat(rows, ignore_index=True)
+
+@traced()
+def survival_analysis(df, covariates=COVARIATES, method='fdr_bh'):
+    # df: patient-level frame with the FollowUpDays and ReadmissionEvent
+    # columns of data_loading.load_data(study_end=...)
+    try:
+        missing = [column for column in (DURATION, EVENT) if column not in df]
+        if missing:
+            raise ValueError(f"Missing survival columns {missing}; load the data with a study end date")
+        frame = df.dropna(subset=[DURATION, EVENT, TREATMENT])
+        duration = frame[DURATION].to_numpy(dtype=float)
+        event = frame[EVENT].to_numpy(dtype=bool)
+        treated = frame[TREATMENT].to_numpy(dtype=bool)
+        if treated.all() or not treated.any():
+            raise ValueError("One or both groups are empty. Cannot perform survival analysis.")
+        stratum, strata = pd.factorize(frame[STRATUM_COLUMN].astype(object), sort=True)
+        strata = list(strata)
+
+        curves = survival_curves(duration, event, treated, stratum, strata)
+        overall_curves = curves[curves['subgroup'] == OVERALL]
+        medians = {
+            arm: float(median_survival(part['time'].to_numpy(), part['survival'].to_numpy()[None, :])[0])
+            for arm, part in overall_curves.groupby('arm')
+        }
+
+        # Overall test, then one per condition with multiplicity control
+        observed, expected, chi2, p_value = logrank(duration, event, treated, np.zeros(len(duration), dtype=np.int64), 1)
+        keep = stratum >= 0
+        s_observed, s_expected, s_chi2, s_p = logrank(duration[keep], event[keep], treated[keep], stratum[keep],
+                                                      len(strata))
+        logrank_table = pd.DataFrame({
+            'subgroup': [OVERALL] + strata,
+            'observed_treatment': np.concatenate([observed, s_observed]),
+            'expected_treatment': np.concatenate([expected, s_expected]),
+            'chi2': np.concatenate([chi2, s_chi2]),
+            'p_value': np.concatenate([p_value, s_p]),
+        })
+        logrank_table['p_adjusted'] = np.concatenate([p_value, adjust_pvalues(s_p, method)])
+
+        complete = frame.dropna(subset=list(covariates))
+        levels = covariate_levels(complete, covariates)
+        X, _ = design_matrix(complete, EVENT, levels, covariates)
+        # The intercept drops out of the partial likelihood
+        X = X[:, 1:].toarray()
+        beta, covariance, loglik, null_loglik, iterations = fit_cox(
+            complete[DURATION].to_numpy(dtype=float), complete[EVENT].to_numpy(dtype=bool), X
+        )
+        se = np.sqrt(np.clip(np.diag(covariance), 0, None))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = beta / se
+        cox = pd.DataFrame({
+            'coefficient': beta,
+            'se': se,
+            'hazard_ratio': np.exp(beta),
+            'lower': np.exp(beta - Z_95 * se),
+            'upper': np.exp(beta + Z_95 * se),
+            'p_value': 2 * stats.norm.sf(np.abs(z)),
+        }, index=design_names(levels, covariates)[1:])
+
+        logging.info(f"Survival: {int(event.sum())} readmissions in {len(duration)} patients, median time to "
+                     f"readmission {medians.get('Control', np.nan):.0f} (control) vs "
+                     f"{medians.get('Treatment', np.nan):.0f} days (treatment)")
+        logging.info(f"Log-rank chi-square {chi2[0]:.4f}, p-value {p_value[0]:.4g}")
+        logging.info(f"Cox hazard ratio for {TREATMENT}: {cox.loc[TREATMENT, 'hazard_ratio']:.4f} "
+                     f"(95% CI {cox.loc[TREATMENT, 'lower']:.4f}-{cox.loc[TREATMENT, 'upper']:.4f}, "
+                     f"p={cox.loc[TREATMENT, 'p_value']:.4g}) after {iterations} iterations")
+        return {
+            'curves': curves,
+            'median_days': medians,
+            'logrank': logrank_table.to_dict('records'),
+            'cox': {
+                'n': len(complete),
+                'events': int(complete[EVENT].sum()),
+                'log_likelihood': float(loglik),
+                'likelihood_ratio': float(2 * (loglik - null_loglik)),
+                'coefficients': cox,
+            },
+        }
+    except Exception as e:
+        logging.error(f"Error in survival_analysis: {e}")
+        raise
@@ -0,0 +1,193 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Lightweight stage tracing. Off unless READMISSION_TRACE=1 or enable() is
+# called (main.py --trace); when off, span() costs one environment lookup.
+TRACE_ENV = 'READMISSION_TRACE'
+MEMORY_ENV = 'READMISSION_TRACE_MEMORY'
+PROFILE_DIR_ENV = 'READMISSION_PROFILE_DIR'
+PROFILER_ENV = 'READMISSION_PROFILER'
+
+_spans = []
+_spans_lock = threading.Lock()
+_local = threading.local()
+
+def enabled():
+    return os.environ.get(TRACE_ENV, '0') == '1'
+
+def enable(profile_dir=None, profiler=None):
+    # Set through the environment so worker processes inherit the settings
+    os.environ[TRACE_ENV] = '1'
+    if profile_dir:
+        os.environ[PROFILE_DIR_ENV] = profile_dir
+    if profiler:
+        os.environ[PROFILER_ENV] = profiler
+
+def trace_memory():
+    return os.environ.get(MEMORY_ENV, '1') == '1'
+
+def span_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def current_span():
+    stack = span_stack()
+    return stack[-1] if stack else None
+
+def record_frame(df, record=None, prefix='frame'):
+    record = record if record is not None else current_span()
+    if record is None or not hasattr(df, 'shape'):
+        return
+    record[f'{prefix}_shape'] = list(df.shape)
+    if hasattr(df, 'memory_usage'):
+        record[f'{prefix}_bytes'] = int(df.memory_usage(deep=True).sum())
+
+def record_rows(rows, record=None):
+    record = record if record is not None else current_span()
+    if record is not None:
+        record['db_rows'] = record.get('db_rows', 0) + rows
+
+@contextmanager
+def profiled(name):
+    profile_dir = os.environ.get(PROFILE_DIR_ENV)
+    if not profile_dir:
+        yield
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    base = os.path.join(profile_dir, name.replace(':', '_').replace('/', '_'))
+
+    if os.environ.get(PROFILER_ENV) == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logging.warning("pyinstrument is not installed; falling back to cProfile.")
+        else:
+            profiler = Profiler()
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                with open(f'{base}.html', 'w') as f:
+                    f.write(profiler.output_html())
+            return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(f'{base}.prof')
+
+@contextmanager
+def span(name, profile=False, **attributes):
+    if not enabled():
+        yield None
+        return
+
+    stack = span_stack()
+    parent = stack[-1] if stack else None
+    record = {
+        'name': name,
+        'parent': parent['name'] if parent else None,
+        'depth': len(stack),
+        'pid': os.getpid(),
+        'start': time.time(),
+        **attributes,
+    }
+    memory = trace_memory()
+    if memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        current, peak = tracemalloc.get_traced_memory()
+        # A nested span resets the peak, so fold the parent's peak so far into it first
+        if parent is not None:
+            parent['_peak'] = max(parent.get('_peak', 0), peak)
+        tracemalloc.reset_peak()
+        record['_base'] = current
+
+    stack.append(record)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        if profile:
+            with profiled(name):
+                yield record
+        else:
+            yield record
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        record['wall_seconds'] = time.perf_counter() - wall
+        record['cpu_seconds'] = time.process_time() - cpu
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        record['max_rss_bytes'] = maxrss if sys.platform == 'darwin' else maxrss * 1024
+        if memory:
+            _, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, record.pop('_peak', 0))
+            record['peak_traced_bytes'] = max(0, peak - record.pop('_base'))
+            if parent is not None:
+                parent['_peak'] = max(parent.get('_peak', 0), peak)
+        stack.pop()
+        with _spans_lock:
+            _spans.append(record)
+
+def traced(name=None, profile=False):
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            with span(span_name, profile=profile) as record:
+                result = func(*args, **kwargs)
+                record_frame(result, record, 'result')
+                return result
+        return wrapper
+    return decorator
+
+def reset():
+    # Pool initializer: a forked worker inherits the parent's finished spans,
+    # which must not be handed back (and merged) a second time
+    with _spans_lock:
+        _spans.clear()
+
+def drain():
+    # Spans recorded so far in this process; worker processes return these to the parent
+    with _spans_lock:
+        spans = list(_spans)
+        _spans.clear()
+    return spans
+
+def merge(spans):
+    with _spans_lock:
+        _spans.extend(spans or [])
+
+def write_report(path, **metadata):
+    spans = sorted(drain(), key=lambda s: s['start'])
+    report = {
+        'created': time.time(),
+        'argv': sys.argv,
+        'pid': os.getpid(),
+        **metadata,
+        'spans': spans,
+    }
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    logging.info(f"Wrote trace report with {len(spans)} spans to {path}")
+    return report
@@ -1,46 +1,147 @@
+import matplotlib
+matplotlib.use('Agg')  # Headless rendering; must be selected before pyplot is imported
 import matplotlib.pyplot as plt
 import seaborn as sns
+import pandas as pd
+import hashlib
+import json
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from data_loading import distribution_bins
+import tracing
+from tracing import traced
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def create_visualizations(df, results):
+# Replaces plt.style.use('seaborn'), which current matplotlib no longer ships.
+# Part of every plot's content hash, so changing it re-renders everything.
+PLOT_STYLE = {'style': 'darkgrid', 'context': 'notebook'}
+PLOT_MANIFEST = '.plot_manifest.json'
+
+@traced()
+def create_visualizations(df, results, bins=None, output_dir='.', workers=None, force=False):
     try:
-        # Set style for all plots
-        plt.style.use('seaborn')
+        # Age and gender plots only need counts; pushdown mode passes them pre-binned
+        if bins is None:
+            bins = distribution_bins(df)
+
+        # Each worker gets only the small payload its plot needs
+        tasks = plot_tasks(results, bins, output_dir)
+        manifest_path = os.path.join(output_dir, PLOT_MANIFEST)
+        manifest = read_manifest(manifest_path)
+        pending = [
+            task for task in tasks
+            if force or manifest.get(task[2]) != task[3] or not os.path.exists(task[2])
+        ]
+        for task in tasks:
+            if task not in pending:
+                logging.info(f"{os.path.basename(task[2])} is unchanged; skipping.")
 
-        # Create all visualizations
-        create_overall_readmission_plot(results)
-        create_subgroup_analysis_plot(results)
-        create_age_distribution_plot(df)
-        create_gender_distribution_plot(df)
-        create_satisfaction_plot(results)
-        create_days_to_readmission_plot(results)
+        if pending:
+            workers = min(len(pending), workers or os.cpu_count() or 1)
+            if workers <= 1:
+                for task in pending:
+                    render_plot(task)
+            else:
+                with ProcessPoolExecutor(workers, initializer=tracing.reset) as pool:
+                    for spans in pool.map(render_plot_in_worker, pending):
+                        tracing.merge(spans)
+            manifest.update({task[2]: task[3] for task in pending})
+            write_manifest(manifest_path, manifest)
 
         logging.info("All visualizations have been created and saved successfully.")
     except Exception as e:
         logging.error(f"Error in create_visualizations: {e}")
         raise
 
-def create_overall_readmission_plot(results):
+def frame_payload(df):
+    return {column: df[column].tolist() for column in df.columns}
+
+def plot_tasks(results, bins, output_dir='.'):
+    subgroups = results['subgroup_results']
+    conditions = list(subgroups.keys())
+    payloads = [
+        ('overall_readmission_rates.png', 'overall_readmission', {
+            'rates': [results['control_readmission_rate'], results['treatment_readmission_rate']],
+        }),
+        ('subgroup_analysis.png', 'subgroup_analysis', {
+            'conditions': [str(c) for c in conditions],
+            'control_rates': [subgroups[c]['control_rate'] for c in conditions],
+            'treatment_rates': [subgroups[c]['treatment_rate'] for c in conditions],
+        }),
+        ('age_distribution.png', 'age_distribution', frame_payload(bins['age'])),
+        ('gender_distribution.png', 'gender_distribution', frame_payload(bins['gender'])),
+        ('satisfaction_scores.png', 'satisfaction', {
+            'scores': [results['satisfaction_scores'][False], results['satisfaction_scores'][True]],
+        }),
+        ('days_to_readmission.png', 'days_to_readmission', {
+            'days': [results['days_to_readmission'][False], results['days_to_readmission'][True]],
+        }),
+    ]
+    if 'survival' in results:
+        curves = results['survival']['curves']
+        overall = curves[curves['subgroup'] == 'All']
+        payloads.append(('readmission_survival.png', 'survival', {
+            arm: frame_payload(part[['time', 'survival', 'lower', 'upper']]) for arm, part in overall.groupby('arm')
+        }))
+    tasks = []
+    for filename, plot, payload in payloads:
+        payload = json.loads(json.dumps(payload, default=to_builtin))
+        tasks.append((plot, payload, os.path.join(output_dir, filename), content_hash(plot, payload)))
+    return tasks
+
+def to_builtin(value):
+    # numpy scalars, pandas NA and similar
+    return value.item() if hasattr(value, 'item') else str(value)
+
+def content_hash(plot, payload):
+    text = json.dumps({'plot': plot, 'payload': payload, 'style': PLOT_STYLE}, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def read_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(path, manifest):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def render_plot(task):
+    plot, payload, path, _ = task
+    sns.set_theme(**PLOT_STYLE)
+    PLOTS[plot](payload, path)
+
+def render_plot_in_worker(task):
+    # Spans recorded in a worker process are handed back to the parent's trace
+    render_plot(task)
+    return tracing.drain()
+
+@traced()
+def create_overall_readmission_plot(payload, path='overall_readmission_rates.png'):
     try:
         plt.figure(figsize=(10, 6))
-        sns.barplot(x=['Control', 'Treatment'], 
-                    y=[results['control_readmission_rate'], results['treatment_readmission_rate']])
+        sns.barplot(x=['Control', 'Treatment'], y=payload['rates'])
         plt.title('Readmission Rates: Control vs Treatment')
         plt.ylabel('Readmission Rate')
-        plt.savefig('overall_readmission_rates.png')
+        plt.savefig(path)
         plt.close()
         logging.info("Overall readmission plot created successfully.")
     except Exception as e:
         logging.error(f"Error creating overall readmission plot: {e}")
         raise
 
-def create_subgroup_analysis_plot(results):
+@traced()
+def create_subgroup_analysis_plot(payload, path='subgroup_analysis.png'):
     try:
-        conditions = list(results['subgroup_results'].keys())
-        control_rates = [results['subgroup_results'][c]['control_rate'] for c in conditions]
-        treatment_rates = [results['subgroup_results'][c]['treatment_rate'] for c in conditions]
+        conditions = payload['conditions']
+        control_rates = payload['control_rates']
+        treatment_rates = payload['treatment_rates']
 
         plt.figure(figsize=(12, 6))
         x = range(len(conditions))
@@ -53,61 +154,94 @@ def create_subgroup_analysis_plot(results):
         plt.xticks(x, conditions, rotation=45)
         plt.legend()
         plt.tight_layout()
-        plt.savefig('subgroup_analysis.png')
+        plt.savefig(path)
         plt.close()
         logging.info("Subgroup analysis plot created successfully.")
     except Exception as e:
         logging.error(f"Error creating subgroup analysis plot: {e}")
         raise
 
-def create_age_distribution_plot(df):
+@traced()
+def create_age_distribution_plot(age_bins, path='age_distribution.png'):
     try:
         plt.figure(figsize=(10, 6))
-        sns.histplot(data=df, x='Age', hue='EnrolledInProgram', multiple='stack')
+        sns.histplot(data=pd.DataFrame(age_bins), x='Age', weights='Count', hue='EnrolledInProgram', multiple='stack',
+                     discrete=True)
         plt.title('Age Distribution: Control vs Treatment')
-        plt.savefig('age_distribution.png')
+        plt.savefig(path)
         plt.close()
         logging.info("Age distribution plot created successfully.")
     except Exception as e:
         logging.error(f"Error creating age distribution plot: {e}")
         raise
 
-def create_gender_distribution_plot(df):
+@traced()
+def create_gender_distribution_plot(gender_bins, path='gender_distribution.png'):
     try:
         plt.figure(figsize=(10, 6))
-        sns.countplot(data=df, x='Gender', hue='EnrolledInProgram')
+        sns.barplot(data=pd.DataFrame(gender_bins), x='Gender', y='Count', hue='EnrolledInProgram')
         plt.title('Gender Distribution: Control vs Treatment')
-        plt.savefig('gender_distribution.png')
+        plt.savefig(path)
         plt.close()
         logging.info("Gender distribution plot created successfully.")
     except Exception as e:
         logging.error(f"Error creating gender distribution plot: {e}")
         raise
 
-def create_satisfaction_plot(results):
+@traced()
+def create_satisfaction_plot(payload, path='satisfaction_scores.png'):
     try:
         plt.figure(figsize=(10, 6))
-        sns.barplot(x=['Control', 'Treatment'], 
-                    y=[results['satisfaction_scores'][False], results['satisfaction_scores'][True]])
+        sns.barplot(x=['Control', 'Treatment'], y=payload['scores'])
         plt.title('Average Satisfaction Scores: Control vs Treatment')
         plt.ylabel('Satisfaction Score')
-        plt.savefig('satisfaction_scores.png')
+        plt.savefig(path)
         plt.close()
         logging.info("Satisfaction plot created successfully.")
     except Exception as e:
         logging.error(f"Error creating satisfaction plot: {e}")
         raise
 
-def create_days_to_readmission_plot(results):
+@traced()
+def create_days_to_readmission_plot(payload, path='days_to_readmission.png'):
     try:
         plt.figure(figsize=(10, 6))
-        sns.barplot(x=['Control', 'Treatment'], 
-                    y=[results['days_to_readmission'][False], results['days_to_readmission'][True]])
+        sns.barplot(x=['Control', 'Treatment'], y=payload['days'])
         plt.title('Average Days to Readmission: Control vs Treatment')
         plt.ylabel('Days to Readmission')
-        plt.savefig('days_to_readmission.png')
+        plt.savefig(path)
         plt.close()
         logging.info("Days to readmission plot created successfully.")
     except Exception as e:
         logging.error(f"Error creating days to readmission plot: {e}")
-        raise
\ No newline at end of file
+        raise
+
+@traced()
+def create_survival_plot(payload, path='readmission_survival.png'):
+    try:
+        plt.figure(figsize=(10, 6))
+        for arm, curve in payload.items():
+            # Curves start at day 0 with nobody readmitted
+            time = [0] + curve['time']
+            plt.step(time, [1.0] + curve['survival'], where='post', label=arm)
+            plt.fill_between(time, [1.0] + curve['lower'], [1.0] + curve['upper'], step='post', alpha=0.2)
+        plt.title('Time to Readmission (Kaplan-Meier): Control vs Treatment')
+        plt.xlabel('Days since first discharge')
+        plt.ylabel('Proportion not readmitted')
+        plt.legend()
+        plt.savefig(path)
+        plt.close()
+        logging.info("Survival plot created successfully.")
+    except Exception as e:
+        logging.error(f"Error creating survival plot: {e}")
+        raise
+
+PLOTS = {
+    'overall_readmission': create_overall_readmission_plot,
+    'subgroup_analysis': create_subgroup_analysis_plot,
+    'age_distribution': create_age_distribution_plot,
+    'gender_distribution': create_gender_distribution_plot,
+    'satisfaction': create_satisfaction_plot,
+    'days_to_readmission': create_days_to_readmission_plot,
+    'survival': create_survival_plot,
+}